@@ -10,6 +10,9 @@
 #
 # Equivalent targets for the Verilog version of the project, using Icarus, will
 # be added eventually.
+#
+# To build all the SW projects and their GHDL simulations at once, in parallel
+# and skipping the steps that are up to date, use tools/build/build_sw.py.
 #-------------------------------------------------------------------------------
 
 # Use bash for shell commands like echo.
@@ -48,9 +51,23 @@ WAVE 		:= gtkwave
 
 # ihex-to-vhdl/verilog object code conversion script -- part of light8080.
 ROM_RTL 	:= $(PROJECTDIR)/tools/build_rom/src/build_rom.py
-ROM_RTL_FLAGS 	:= --quiet 
-# TODO This is an example, it's not used yet.
+# Outputs already built from the same object code are not rewritten, so that
+# the RTL does not need to be re-analyzed.
+ROM_RTL_CACHE 	:= .build_rom_cache.json
+ROM_RTL_FLAGS 	:= --quiet --cache=$(ROM_RTL_CACHE)
+# Each +define+NAME=VALUE replaces tag @NAME@ in the build_rom templates.
+# This is an example, the stock templates have no such tag.
 ROM_RTL_DEFINES := +define+A=45
+# Microcode-level simulator -- part of light8080. Runs the object code on the 
+# microcode assembled from source, no HDL simulation needed.
+USIM 		:= $(PROJECTDIR)/tools/uasm/ucode_sim.py
+USIM_FLAGS 	:= -t sw_sim_log.txt -c sw_sim_con.txt
+# Instruction-level 8080 reference emulator and trace comparison tool. 
+EMU 		:= $(PROJECTDIR)/tools/emu8080/emu8080.py
+EMU_FLAGS 	:= -t sw_emu_log.txt -c sw_emu_con.txt
+TRACE_DIFF 	:= $(PROJECTDIR)/tools/emu8080/trace_diff.py
+# Trace profiler: flat profile, call graph and folded stacks for flamegraphs.
+TRACE_PROF 	:= $(PROJECTDIR)/tools/trace/trace_prof.py
 
 
 #---- Defaults. ----------------------------------------------------------------
@@ -58,6 +75,7 @@ ROM_RTL_DEFINES := +define+A=45
 # Default values for RTL files.
 VHDL_PKG_NAME 	?= obj_code_pkg.vhdl
 VLOG_INC_NAME 	?= obj_code.inc.v
+MEM_FILE_NAME 	?= obj_code.mem
 
 
 
@@ -72,6 +90,11 @@ help:
 	@echo "   sw  ..................... Build program \$$PROJ_NAME (defaults to 'diagnostic')"
 	@echo "                             Object code is generated as a ROM-able constant "
 	@echo "                             within a VHDL package and a Verilog include file"
+	@echo "   mem  .................... Build \$$readmemh memory file with the object code"
+	@echo "   usim  ................... Run program on the microcode-level simulator"
+	@echo "   emu  .................... Run program on the 8080 reference emulator"
+	@echo "   emudiff  ................ Compare microcode simulator and emulator traces"
+	@echo "   prof  ................... Profile program run on the emulator"
 	@echo "   help  ................... Show this help text"
 	@echo "   clean  .................. Regular clean goal"
 	@echo
@@ -89,6 +112,7 @@ ASM_SRC 		:= $(wildcard *.${ASM_EXT})
 # This is how asXXXX worked, we do the same for ASL. Doesn't matter. 
 OBJ 			:= $(addsuffix .${OBJ_EXT}, $(basename $(word 1, ${ASM_SRC})))
 HEX 			:= $(addsuffix .ihx, $(basename $(word 1, ${ASM_SRC})))
+LST 			:= $(addsuffix .lst, $(basename $(word 1, ${ASM_SRC})))
 
 # Will be nonempty if ASL assembler is actually there.
 ASL_INSTALLED 		:= $(shell command -v ${ASM} 2> /dev/null)
@@ -127,10 +151,47 @@ vhdl: bin
 		$(ROM_RTL_DEFINES)
 
 # Verilog include file generator.
-# TODO add support for Verilog! 
 .PHONY: verilog
 verilog: bin
 	@echo Building Verilog include file \'$(VLOG_INC_NAME)\'
+	@$(ROM_RTL) --project=$(PROJ_NAME) --output=$(VLOG_INC_NAME) \
+		--format=verilog $(ROM_RTL_FLAGS) \
+		$(HEX) \
+		$(ROM_RTL_DEFINES)
+
+# Memory file generator, for $readmemh. Simulations can load a new memory file
+# without the RTL having to be recompiled.
+.PHONY: mem
+mem: bin
+	@echo Building memory file \'$(MEM_FILE_NAME)\'
+	@$(ROM_RTL) --project=$(PROJ_NAME) --output=$(MEM_FILE_NAME) \
+		--format=memh $(ROM_RTL_FLAGS) \
+		$(HEX) \
+		$(ROM_RTL_DEFINES)
+
+# Run the SW on the microcode simulator. The trace and console files have the
+# same format as the TB's hw_sim_log.txt and hw_sim_con.txt.
+.PHONY: usim
+usim: bin
+	@$(USIM) $(USIM_FLAGS) $(HEX)
+
+# Run the SW on the reference emulator. Its trace can be compared with the TB
+# or microcode simulator traces to find the first instruction where the core 
+# misbehaves.
+.PHONY: emu
+emu: bin
+	@$(EMU) $(EMU_FLAGS) $(HEX)
+
+.PHONY: emudiff
+emudiff: usim emu
+	@$(TRACE_DIFF) sw_emu_log.txt sw_sim_log.txt
+
+# Profile the SW as run on the emulator; works on the TB's hw_sim_log.txt too.
+.PHONY: prof
+prof: emu
+	@$(TRACE_PROF) -l $(LST) -x $(HEX) -o sw_emu_prof.txt \
+		-f sw_emu_prof.folded sw_emu_log.txt
+	@echo Profile written to sw_emu_prof.txt
 
 # Build SW, generate ROM files for RTL simulation.
 .PHONY: sw
@@ -138,6 +199,6 @@ sw: vhdl verilog
 
 .PHONY: clean
 clean:
-	rm -rf *.lst *.map *.rel *.sym *.p *.ihx *.vhdl *.v
+	rm -rf *.lst *.map *.rel *.sym *.p *.ihx *.vhdl *.v *.mem $(ROM_RTL_CACHE) sw_sim_*.txt sw_emu_*
 	$(GHDLC) --clean
 	rm -rf *.vcd *.ghw *.cf
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""
+bench.py: Benchmark suite for the microcode assembler (ucode_asm.py) and the
+ROM builder (build_rom.py).
+
+Times the assembly of the light8080 microcode end to end and pass by pass, and
+the conversion of synthetic Intel HEX images of 4, 16 and 64 KB, dense (one
+contiguous block of code) and sparse (small blocks scattered over the image),
+to each of the build_rom output formats. Everything runs in-process and
+offline; nothing is written outside a temporary directory.
+
+Each benchmark is run a number of times after a warm-up run; the best time is
+the figure of merit, the median is reported too. The results can be written
+to a JSON file and compared with a baseline file written earlier by this same
+script: a benchmark whose best time grows by more than the threshold is a
+regression and makes the script exit with status 1.
+
+A baseline may carry per-benchmark thresholds, in percent, in a 'thresholds'
+object mapping benchmark names to values; they override --threshold.
+Please use with --help to get some brief usage instructions.
+"""
+
+import sys
+import os
+import re
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+import platform
+import timeit
+import cStringIO
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(TOOLS_DIR, "uasm"))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "build_rom", "src"))
+import ucode_asm
+import build_rom
+
+DEFAULT_MICROCODE = os.path.join(TOOLS_DIR, "..", "src", "ucode", "light8080.m80")
+
+# Version of the result file format.
+RESULTS_VERSION = 1
+
+# Synthetic HEX image sizes and layouts.
+IMAGE_SIZES = [4 * 1024, 16 * 1024, 64 * 1024]
+IMAGE_LAYOUTS = ["dense", "sparse"]
+
+# uCodeROM methods timed within the end to end assembly.
+ASM_PASSES = ["_pass_1", "_pass_2", "_build_decoding_table"]
+
+# Bytes per data record in the synthetic HEX images.
+HEX_RECORD_BYTES = 16
+
+timer = timeit.default_timer
+
+
+class BenchError(Exception):
+    pass
+
+
+def synthetic_hex(size, layout, seed=0):
+    """Return Intel HEX object code of a synthetic image of size bytes.
+    A dense image is a single block of random bytes filling it. A sparse image
+    holds blocks of 16 to 256 random bytes separated by gaps of up to 2 KB,
+    about one eighth of the image, so that build_rom collapses fill runs.
+    The content only depends on the arguments.
+    """
+    rng = random.Random("%d-%s-%d" % (size, layout, seed))
+    if layout == "dense":
+        blocks = [(0, size)]
+    elif layout == "sparse":
+        blocks = []
+        address = 0
+        while True:
+            length = rng.randint(16, 256)
+            if address + length > size:
+                break
+            blocks.append((address, length))
+            address += length + rng.randint(length, 2048)
+    else:
+        raise BenchError("unknown image layout '%s'" % layout)
+
+    lines = []
+    for (address, length) in blocks:
+        data = bytearray(rng.getrandbits(8) for i in range(length))
+        for offset in range(0, length, HEX_RECORD_BYTES):
+            chunk = data[offset:offset + HEX_RECORD_BYTES]
+            record = bytearray([len(chunk), (address + offset) >> 8,
+                                (address + offset) & 0xff, 0]) + chunk
+            record.append(-sum(record) & 0xff)
+            lines.append(":" + str(record).encode("hex").upper())
+    lines.append(":00000001FF")
+    return "\n".join(lines) + "\n"
+
+
+def _time(function, repeat):
+    """Run function once to warm up, then repeat times; return run times."""
+    function()
+    times = []
+    for i in range(repeat):
+        start = timer()
+        function()
+        times.append(timer() - start)
+    return times
+
+
+def _time_passes(srcfile, repeat):
+    """Time assembly passes by wrapping the uCodeROM methods that implement
+    them during repeated end to end assemblies. Return dict name -> times.
+    """
+    times = dict((name, []) for name in ASM_PASSES)
+    originals = dict((name, getattr(ucode_asm.uCodeROM, name)) for name in ASM_PASSES)
+
+    def wrap(name):
+        method = originals[name]
+        def timed(self, *args, **kwargs):
+            start = timer()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                times[name].append(timer() - start)
+        return timed
+
+    try:
+        for name in ASM_PASSES:
+            setattr(ucode_asm.uCodeROM, name, wrap(name))
+        ucode_asm.uCodeROM(srcfile, verbose=False)
+        for name in ASM_PASSES:
+            del times[name][:]
+        for i in range(repeat):
+            ucode_asm.uCodeROM(srcfile, verbose=False)
+    finally:
+        for name in ASM_PASSES:
+            setattr(ucode_asm.uCodeROM, name, originals[name])
+    return times
+
+
+def asm_benchmarks(srcfile, tmpdir):
+    """Return list of (name, function) for the assembler benchmarks that are
+    timed as a whole."""
+    listing = os.path.join(tmpdir, "ucode.lst")
+    rom = ucode_asm.uCodeROM(srcfile, verbose=False)
+
+    def build_listing():
+        # build_listing leaves an identical file alone; time a full write.
+        if os.path.exists(listing):
+            os.remove(listing)
+        rom.build_listing(listing)
+
+    return [
+        ("ucode_asm.assemble",
+            lambda: ucode_asm.uCodeROM(srcfile, verbose=False)),
+        ("ucode_asm.assemble_optimized",
+            lambda: ucode_asm.uCodeROM(srcfile, True, verbose=False)),
+        ("ucode_asm.build_listing", build_listing),
+    ]
+
+
+def rom_benchmarks():
+    """Return list of (name, function) for the build_rom benchmarks."""
+    benchmarks = []
+    for size in IMAGE_SIZES:
+        for layout in IMAGE_LAYOUTS:
+            tag = "%s_%dk" % (layout, size // 1024)
+            text = synthetic_hex(size, layout)
+            benchmarks.append(("build_rom.parse.%s" % tag,
+                               lambda text=text: build_rom.parse_ihex(text)))
+            for format in build_rom.FORMAT_CHOICES:
+                def convert(text=text, format=format):
+                    image = build_rom.parse_ihex(text)
+                    build_rom.write_rom(cStringIO.StringIO(), image, format)
+                benchmarks.append(("build_rom.%s.%s" % (format, tag), convert))
+    return benchmarks
+
+
+def _summary(times):
+    ordered = sorted(times)
+    return {"best": ordered[0], "median": ordered[len(ordered) // 2],
+            "runs": len(ordered)}
+
+
+def run_benchmarks(srcfile, repeat=5, select=None, progress=None):
+    """Run the benchmarks whose name matches regex select (all by default).
+    Return dict benchmark name -> {'best', 'median', 'runs'}, times in
+    seconds. progress(name, summary) is called after each benchmark if given.
+    """
+    match = re.compile(select or "").search
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix="bench")
+    try:
+        benchmarks = asm_benchmarks(srcfile, tmpdir) + rom_benchmarks()
+        for (name, function) in benchmarks:
+            if match(name):
+                results[name] = _summary(_time(function, repeat))
+                if progress:
+                    progress(name, results[name])
+        if any(match("ucode_asm.%s" % name) for name in ASM_PASSES):
+            for (name, times) in sorted(_time_passes(srcfile, repeat).items()):
+                name = "ucode_asm.%s" % name
+                if match(name):
+                    results[name] = _summary(times)
+                    if progress:
+                        progress(name, results[name])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold, min_delta=0.0):
+    """Compare results with baseline results.
+    Return list of (name, baseline best, best, change ratio, status) sorted by
+    name, where status is 'ok', 'REGRESSION', 'faster', 'new' or 'missing'. A
+    benchmark regresses if its best time grows by more than the threshold, in
+    percent, and by more than min_delta seconds.
+    """
+    thresholds = baseline.get("thresholds", {})
+    base = baseline.get("results", {})
+    rows = []
+    for name in sorted(set(results) | set(base)):
+        if name not in base:
+            rows.append((name, None, results[name]["best"], None, "new"))
+            continue
+        if name not in results:
+            rows.append((name, base[name]["best"], None, None, "missing"))
+            continue
+        (old, new) = (base[name]["best"], results[name]["best"])
+        change = (new - old) / old if old else 0.0
+        limit = thresholds.get(name, threshold) / 100.0
+        if change > limit and new - old > min_delta:
+            status = "REGRESSION"
+        elif change < -limit and old - new > min_delta:
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append((name, old, new, change, status))
+    return rows
+
+
+def _ms(seconds):
+    return "-" if seconds is None else "%.3f" % (seconds * 1000.0)
+
+
+def _write_comparison(fo, rows, baseline_filename):
+    print >> fo, "Comparison with baseline '%s' (best times in ms):" % baseline_filename
+    fmt = "%-36s %11s %11s %8s  %s"
+    print >> fo, fmt % ("benchmark", "baseline", "current", "change", "")
+    for (name, old, new, change, status) in rows:
+        change = "" if change is None else "%+.1f%%" % (change * 100.0)
+        print >> fo, fmt % (name, _ms(old), _ms(new), change, status)
+
+
+def _load_results(filename):
+    try:
+        with open(filename, "r") as f:
+            data = json.load(f)
+    except ValueError as e:
+        raise BenchError("%s: %s" % (filename, e))
+    if not isinstance(data, dict) or not isinstance(data.get("results"), dict):
+        raise BenchError("%s: not a benchmark results file" % filename)
+    return data
+
+
+def _parse_cmdline(argv):
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark ucode_asm.py and build_rom.py.')
+    parser.add_argument(
+            '-r', '--repeat',
+            type=int,
+            default=5,
+            help='Timed runs per benchmark, after one warm-up run.')
+    parser.add_argument(
+            '-k', '--select',
+            type=str,
+            default=None,
+            metavar='REGEX',
+            help='Only run the benchmarks whose name matches REGEX.')
+    parser.add_argument(
+            '-m', '--microcode',
+            type=str,
+            default=DEFAULT_MICROCODE,
+            help='Microcode source file to assemble.')
+    parser.add_argument(
+            '-o', '--output',
+            type=str,
+            default=None,
+            help='Write results to this JSON file; can be used as baseline.')
+    parser.add_argument(
+            '-b', '--baseline',
+            type=str,
+            default=None,
+            help='Compare results with this JSON file written by -o.')
+    parser.add_argument(
+            '-t', '--threshold',
+            type=float,
+            default=10.0,
+            help='Regression threshold in percent. Defaults to 10%%.')
+    parser.add_argument(
+            '--min-delta',
+            type=float,
+            default=0.5,
+            help='Ignore changes smaller than this many ms. Defaults to 0.5.')
+    parser.add_argument(
+            '-l', '--list',
+            action='store_true',
+            default=False,
+            help='List the benchmark names and quit.')
+    parser.add_argument(
+            '-q', '--quiet',
+            action='store_true',
+            default=False,
+            help='Only print the comparison with the baseline, if any.')
+
+    opts = parser.parse_args(argv)
+    if opts.repeat < 1:
+        parser.error("the number of runs must be 1 or more")
+    try:
+        re.compile(opts.select or "")
+    except re.error as e:
+        parser.error("invalid benchmark selection regex: %s" % e)
+    return opts
+
+
+def _main(argv):
+
+    opts = _parse_cmdline(argv)
+
+    if opts.list:
+        names = [name for (name, f) in asm_benchmarks(opts.microcode, "")]
+        names += ["ucode_asm.%s" % name for name in ASM_PASSES]
+        names += [name for (name, f) in rom_benchmarks()]
+        for name in sorted(names):
+            if re.search(opts.select or "", name):
+                print name
+        return 0
+
+    def progress(name, summary):
+        print "%-36s best %9s ms  median %9s ms" % (name,
+            _ms(summary["best"]), _ms(summary["median"]))
+        sys.stdout.flush()
+
+    try:
+        baseline = _load_results(opts.baseline) if opts.baseline else None
+        results = run_benchmarks(opts.microcode, opts.repeat, opts.select,
+                                 None if opts.quiet else progress)
+        if opts.output:
+            data = {
+                "version": RESULTS_VERSION,
+                "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "repeat": opts.repeat,
+                "results": results,
+            }
+            if baseline and "thresholds" in baseline:
+                data["thresholds"] = baseline["thresholds"]
+            with open(opts.output, "w") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+    except (BenchError, ucode_asm.SyntaxError, EnvironmentError) as e:
+        print >> sys.stderr, "error: %s" % e
+        return 2
+
+    if baseline:
+        # Benchmarks left out by the selection are not missing.
+        match = re.compile(opts.select or "").search
+        baseline["results"] = dict((name, result) for (name, result)
+                                   in baseline["results"].items() if match(name))
+        rows = compare(results, baseline, opts.threshold, opts.min_delta / 1000.0)
+        if not opts.quiet:
+            print
+        _write_comparison(sys.stdout, rows, opts.baseline)
+        if any(row[4] == "REGRESSION" for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
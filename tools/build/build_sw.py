@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+"""
+build_sw.py: Parallel, cached build driver for the test SW and its RTL
+simulation: ASL assembly, p2hex formatting, build_rom conversion and GHDL
+analysis, elaboration and run.
+
+Does the same job as src/sw/common/common.mk for all the SW projects at once.
+The steps of every project are modelled as a dependency graph of tasks; tasks
+whose dependencies are done run concurrently in a pool of worker threads, so
+independent projects and stages (e.g. the VHDL and Verilog ROM files) build in
+parallel. Each project is built in its own directory within the build dir,
+GHDL work library included.
+
+A task is skipped if its key -- a hash of its command lines and of the
+contents of its inputs, the outputs of the tasks it depends on and the tools
+it runs -- matches the key it was last built with and its outputs are
+untouched. A task whose outputs come out unchanged does not trigger the tasks
+that depend on it.
+
+The tool commands can be replaced (--tool NAME=COMMAND) so that stand-in
+executables can take the place of asl or ghdl. The output of each task is
+logged to a file next to its outputs. A per-stage timing summary is printed
+at the end.
+Please use with --help to get some brief usage instructions.
+"""
+
+import sys
+import os
+import re
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import Queue
+
+PROJECT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+SW_DIR = os.path.join(PROJECT_DIR, "src", "sw")
+VHDL_DIR = os.path.join(PROJECT_DIR, "src", "vhdl")
+
+# Default tool commands, see --tool.
+DEFAULT_TOOLS = {
+    "asl": [os.path.join(PROJECT_DIR, "tools", "asl", "install", "bin", "asl")],
+    "p2hex": [os.path.join(PROJECT_DIR, "tools", "asl", "install", "bin", "p2hex")],
+    "build_rom": [sys.executable, os.path.join(PROJECT_DIR, "tools", "build_rom", "src", "build_rom.py")],
+    "ghdl": ["ghdl"],
+}
+
+# Tool flags, as in common.mk.
+AFLAGS = ["-L", "-G"]
+OFLAGS = ["-F", "Intel"]
+GHDLFLAGS = []
+GHDLSIMFLAGS = ["--ieee-asserts=disable"]
+
+# Assembly extension is 'mac' for ASL by convention in light8080.
+ASM_EXT = ".mac"
+
+# RTL files in analysis order. The object code package goes after the MCU
+# package, which it uses.
+RTL_SOURCES = [os.path.join(VHDL_DIR, "rtl", "mcu", "mcu80_pkg.vhdl")]
+RTL_SOURCES_AFTER_OBJ = [os.path.join(VHDL_DIR, name) for name in [
+    "rtl/light8080_ucode_pkg.vhdl",
+    "rtl/light8080.vhdl",
+    "rtl/mcu/mcu80_uart.vhdl",
+    "rtl/mcu/mcu80_irq.vhdl",
+    "rtl/mcu/mcu80.vhdl",
+    "testbench/txt_util.vhdl",
+    "testbench/light8080_tb_pkg.vhdl",
+    "testbench/mcu80_tb.vhdl",
+]]
+TB_ENTITY = "mcu80_tb"
+
+# ROM files, as in common.mk.
+VHDL_PKG_NAME = "obj_code_pkg.vhdl"
+VLOG_INC_NAME = "obj_code.inc.v"
+
+# Stages in build order. Goal 'sw' stops short of the simulation.
+STAGES = ["asm", "hex", "vhdl", "verilog", "analyze", "elaborate", "run"]
+GOAL_STAGES = {
+    "sw": ["asm", "hex", "vhdl", "verilog"],
+    "sim": STAGES,
+}
+
+CACHE_NAME = ".build_sw_cache.json"
+
+# Task states.
+STATE_BUILT = "built"
+STATE_CACHED = "cached"
+STATE_FAILED = "FAILED"
+STATE_SKIPPED = "skipped"
+
+
+class BuildError(Exception):
+    pass
+
+
+class Task(object):
+    """Build step: a list of commands run in directory cwd.
+    Files in copies, a list of (source, destination) pairs, are copied before
+    running the commands. The task is built when all the tasks in deps are.
+    """
+
+    def __init__(self, project, stage, cwd, commands, inputs=(), outputs=(),
+                 deps=(), copies=()):
+        self.project = project
+        self.stage = stage
+        self.name = "%s/%s" % (project, stage)
+        self.cwd = cwd
+        self.commands = commands
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.copies = list(copies)
+        self.log = os.path.join(cwd, "%s.log" % stage)
+        self.state = None
+        self.run_time = 0.0
+        self.error = None
+
+    def key(self):
+        """Hash of everything the outputs depend on. Tool executables named by
+        path in the commands count as inputs too.
+        """
+        h = hashlib.sha1()
+        for command in self.commands:
+            h.update("command=%r\n" % (command,))
+            for word in command:
+                if os.path.isabs(word) and os.path.isfile(word):
+                    h.update("tool=%s\n" % _file_digest(word))
+        inputs = self.inputs + [src for (src, dst) in self.copies]
+        for dep in self.deps:
+            # A task with no outputs passes on what it was built from.
+            if dep.outputs:
+                inputs.extend(dep.outputs)
+            else:
+                h.update("dep=%s\n" % dep.key())
+        for filename in inputs:
+            h.update("input=%s %s\n" % (os.path.basename(filename), _file_digest(filename)))
+        return h.hexdigest()
+
+    def run(self):
+        """Run the commands, logging their output. Raise BuildError if any
+        fails or if an output is missing afterwards.
+        """
+        for dirname in set([self.cwd] + [os.path.dirname(f) for f in self.outputs]):
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+        for (src, dst) in self.copies:
+            shutil.copyfile(src, dst)
+        with open(self.log, "w") as log:
+            for (n, command) in enumerate(self.commands, 1):
+                print >> log, "$ %s" % " ".join(command)
+                log.flush()
+                try:
+                    status = subprocess.call(command, cwd=self.cwd, stdout=log,
+                                             stderr=subprocess.STDOUT)
+                except OSError as e:
+                    raise BuildError("can't run '%s': %s" % (command[0], e.strerror))
+                if status != 0:
+                    raise BuildError("command %d exited with status %d" % (n, status))
+        for filename in self.outputs:
+            if not os.path.isfile(filename):
+                raise BuildError("output '%s' was not built" % os.path.basename(filename))
+
+
+def _file_digest(filename):
+    """Return SHA-1 hex digest of file contents or None if it can't be read."""
+    h = hashlib.sha1()
+    try:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    except IOError:
+        return None
+    return h.hexdigest()
+
+
+def _load_cache(cache_filename):
+    """Load build cache from file. A missing or corrupt cache is empty."""
+    try:
+        with open(cache_filename, "r") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_cache(cache_filename, cache):
+    """Save build cache to file, replacing the old one atomically."""
+    tmp_filename = cache_filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.rename(tmp_filename, cache_filename)
+
+
+def _cache_hit(cache, task, key):
+    """True if task was built with this key and its outputs are untouched."""
+    entry = cache.get(task.name)
+    if not entry or entry.get("key") != key:
+        return False
+    digests = entry.get("outputs", {})
+    for filename in task.outputs:
+        if _file_digest(filename) != digests.get(filename):
+            return False
+    return True
+
+
+def find_projects(sw_dir=SW_DIR):
+    """Return dict project name -> SW dir for all SW projects, i.e. the dirs
+    with a makefile and assembly sources. The name is the makefile PROJ_NAME.
+    """
+    projects = {}
+    for makefile in sorted(glob.glob(os.path.join(sw_dir, "*", "makefile"))):
+        sw = os.path.dirname(makefile)
+        if not glob.glob(os.path.join(sw, "*" + ASM_EXT)):
+            continue
+        name = os.path.basename(sw)
+        with open(makefile) as f:
+            match = re.search(r"^\s*PROJ_NAME\s*:?=\s*(\S+)", f.read(), re.MULTILINE)
+        if match:
+            name = match.group(1)
+        projects[name] = sw
+    return projects
+
+
+def project_tasks(name, sw_dir, build_dir, tools, stages):
+    """Return list of Tasks building project name from the sources in sw_dir
+    within build_dir, up to the given stages.
+    All assembly files get assembled at once; output is named after the
+    first, as in common.mk.
+    """
+    out = os.path.join(build_dir, name)
+    sources = sorted(glob.glob(os.path.join(sw_dir, "*" + ASM_EXT)))
+    base = os.path.splitext(os.path.basename(sources[0]))[0]
+    obj = os.path.join(out, base + ".p")
+    hexfile = os.path.join(out, base + ".ihx")
+    workdir = os.path.join(out, "work")
+    ghdl_workdir = "--workdir=%s" % workdir
+
+    tasks = {}
+    copies = [(src, os.path.join(out, os.path.basename(src))) for src in sources]
+    tasks["asm"] = Task(name, "asm", out,
+        [tools["asl"] + AFLAGS + [os.path.basename(src) for src in sources]],
+        outputs=[obj, os.path.join(out, base + ".lst")], copies=copies)
+    tasks["hex"] = Task(name, "hex", out,
+        [tools["p2hex"] + [os.path.basename(obj), os.path.basename(hexfile)] + OFLAGS],
+        outputs=[hexfile], deps=[tasks["asm"]])
+    for (stage, rom, format) in [("vhdl", VHDL_PKG_NAME, "vhdl"),
+                                 ("verilog", VLOG_INC_NAME, "verilog")]:
+        tasks[stage] = Task(name, stage, out,
+            [tools["build_rom"] + ["--project=%s" % name, "--output=%s" % rom,
+             "--format=%s" % format, "--quiet", os.path.basename(hexfile)]],
+            outputs=[os.path.join(out, rom)], deps=[tasks["hex"]])
+    pkg = os.path.join(out, VHDL_PKG_NAME)
+    analyzed = RTL_SOURCES + [pkg] + RTL_SOURCES_AFTER_OBJ
+    tasks["analyze"] = Task(name, "analyze", out,
+        [tools["ghdl"] + ["-a", ghdl_workdir] + GHDLFLAGS + [src] for src in analyzed],
+        inputs=RTL_SOURCES + RTL_SOURCES_AFTER_OBJ,
+        outputs=[os.path.join(workdir, "work-obj93.cf")], deps=[tasks["vhdl"]])
+    # Only some GHDL backends write an executable, so elaborate has no outputs.
+    tasks["elaborate"] = Task(name, "elaborate", out,
+        [tools["ghdl"] + ["-e", ghdl_workdir] + GHDLFLAGS + [TB_ENTITY]],
+        deps=[tasks["analyze"]])
+    tasks["run"] = Task(name, "run", out,
+        [tools["ghdl"] + ["-r", ghdl_workdir] + GHDLFLAGS + [TB_ENTITY] + GHDLSIMFLAGS],
+        outputs=[os.path.join(out, "hw_sim_log.txt"), os.path.join(out, "hw_sim_con.txt")],
+        deps=[tasks["elaborate"]])
+    return [tasks[stage] for stage in STAGES if stage in stages]
+
+
+def build(tasks, jobs, cache_filename=None, force=False, keep_going=False,
+          report=None):
+    """Build tasks, up to jobs at a time, in dependency order.
+    Each task ends up with a state: built, cached (up to date), FAILED or
+    skipped (a dependency failed or the build stopped on a failure, unless
+    keep_going). report(task) is called as each task is done. Return True
+    if all tasks were built or up to date.
+    """
+    cache = _load_cache(cache_filename) if cache_filename else {}
+    lock = threading.Lock()
+    stopping = threading.Event()
+    work = Queue.Queue()
+    done = Queue.Queue()
+
+    def worker():
+        while True:
+            task = work.get()
+            if task is None:
+                return
+            if stopping.is_set():
+                task.state = STATE_SKIPPED
+                done.put(task)
+                continue
+            start = time.time()
+            try:
+                key = task.key()
+                with lock:
+                    hit = not force and _cache_hit(cache, task, key)
+                if hit:
+                    task.state = STATE_CACHED
+                else:
+                    task.run()
+                    task.state = STATE_BUILT
+                    digests = dict((f, _file_digest(f)) for f in task.outputs)
+                    with lock:
+                        cache[task.name] = {"key": key, "outputs": digests}
+            except (BuildError, EnvironmentError) as e:
+                task.state = STATE_FAILED
+                task.error = str(e)
+            task.run_time = time.time() - start
+            done.put(task)
+
+    dependents = dict((task, []) for task in tasks)
+    waiting = {}
+    for task in tasks:
+        waiting[task] = len([dep for dep in task.deps if dep in dependents])
+        for dep in task.deps:
+            if dep in dependents:
+                dependents[dep].append(task)
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(jobs, len(tasks))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    in_flight = 0
+    for task in tasks:
+        if waiting[task] == 0:
+            work.put(task)
+            in_flight += 1
+    try:
+        while in_flight:
+            task = done.get()
+            in_flight -= 1
+            if report:
+                report(task)
+            if task.state in (STATE_FAILED, STATE_SKIPPED):
+                if task.state == STATE_FAILED and not keep_going:
+                    stopping.set()
+                _skip(task, dependents, report)
+                continue
+            for dependent in dependents[task]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0 and dependent.state is None:
+                    work.put(dependent)
+                    in_flight += 1
+    finally:
+        for thread in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        if cache_filename:
+            with lock:
+                _save_cache(cache_filename, cache)
+
+    for task in tasks:
+        if task.state is None:
+            task.state = STATE_SKIPPED
+    return all(task.state in (STATE_BUILT, STATE_CACHED) for task in tasks)
+
+
+def _skip(task, dependents, report):
+    """Mark the tasks depending on task as skipped."""
+    pending = list(dependents[task])
+    while pending:
+        task = pending.pop()
+        if task.state is not None:
+            continue
+        task.state = STATE_SKIPPED
+        if report:
+            report(task)
+        pending.extend(dependents[task])
+
+
+def write_summary(fo, tasks, wall_time):
+    """Write per-stage timing summary of a build."""
+    fmt = "%-10s %6s %6s %7s %7s %10s %10s"
+    print >> fo, fmt % ("stage", "tasks", "built", "cached", "failed", "total s", "max s")
+    for stage in STAGES:
+        staged = [task for task in tasks if task.stage == stage]
+        if not staged:
+            continue
+        count = lambda state: len([task for task in staged if task.state == state])
+        times = [task.run_time for task in staged]
+        print >> fo, fmt % (stage, len(staged), count(STATE_BUILT), count(STATE_CACHED),
+                            count(STATE_FAILED), "%.3f" % sum(times), "%.3f" % max(times))
+    task_time = sum(task.run_time for task in tasks)
+    print >> fo, "Wall time %.3f s, task time %.3f s (%.1fx)." % (wall_time,
+        task_time, task_time / wall_time if wall_time else 0.0)
+    for task in tasks:
+        if task.state == STATE_FAILED:
+            print >> fo, "%s FAILED: %s (see %s)" % (task.name, task.error, task.log)
+
+
+def _parse_tool(text):
+    (name, sep, command) = text.partition("=")
+    if not sep or name not in DEFAULT_TOOLS or not command.strip():
+        raise argparse.ArgumentTypeError(
+            "expected NAME=COMMAND with NAME one of %s" % ", ".join(sorted(DEFAULT_TOOLS)))
+    return (name, shlex.split(command))
+
+
+def _parse_cmdline(argv):
+
+    parser = argparse.ArgumentParser(
+        description='Build the test SW and run it on the RTL simulation, '
+                    'in parallel and skipping up to date steps.')
+
+    parser.add_argument(
+            'projects',
+            nargs='*',
+            help='SW projects to build (PROJ_NAME). Defaults to all of them.')
+    parser.add_argument(
+            '--goal',
+            choices=sorted(GOAL_STAGES),
+            default='sim',
+            help="'sw' builds the object code and ROM files, 'sim' runs the "
+                 "RTL simulation too. Defaults to 'sim'.")
+    parser.add_argument(
+            '-j', '--jobs',
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help='Number of tasks run at once. Defaults to the number of CPUs.')
+    parser.add_argument(
+            '-k', '--keep-going',
+            action='store_true',
+            default=False,
+            help='Keep building the tasks not affected by a failure.')
+    parser.add_argument(
+            '-B', '--force',
+            action='store_true',
+            default=False,
+            help='Build all tasks even if they are up to date.')
+    parser.add_argument(
+            '--build-dir',
+            type=str,
+            default=os.path.join(PROJECT_DIR, "build"),
+            help='Build directory. Defaults to build/ in the project root.')
+    parser.add_argument(
+            '--tool',
+            type=_parse_tool,
+            action='append',
+            default=[],
+            metavar='NAME=COMMAND',
+            help='Command for tool NAME (%s).' % ", ".join(sorted(DEFAULT_TOOLS)))
+    parser.add_argument(
+            '-l', '--list',
+            action='store_true',
+            default=False,
+            help='List the tasks with their commands and quit.')
+    parser.add_argument(
+            '-q', '--quiet',
+            action='store_true',
+            default=False,
+            help='Only print the summary.')
+
+    opts = parser.parse_args(argv)
+    if opts.jobs < 1:
+        parser.error("the number of jobs must be 1 or more")
+    return opts
+
+
+def _main(argv):
+
+    opts = _parse_cmdline(argv)
+
+    tools = dict(DEFAULT_TOOLS)
+    tools.update(dict(opts.tool))
+
+    projects = find_projects()
+    for name in opts.projects:
+        if name not in projects:
+            print >> sys.stderr, "error: unknown SW project '%s'" % name
+            return 2
+    names = opts.projects or sorted(projects)
+    build_dir = os.path.abspath(opts.build_dir)
+    tasks = []
+    for name in names:
+        tasks.extend(project_tasks(name, projects[name], build_dir, tools,
+                                   GOAL_STAGES[opts.goal]))
+
+    if opts.list:
+        for task in tasks:
+            print "%s:" % task.name
+            for command in task.commands:
+                print "    %s" % " ".join(command)
+        return 0
+
+    def report(task):
+        if opts.quiet:
+            return
+        if task.state in (STATE_BUILT, STATE_CACHED, STATE_FAILED):
+            print "%8.3fs  %-20s %s" % (task.run_time, task.name, task.state)
+        else:
+            print "%9s  %-20s %s" % ("", task.name, task.state)
+        sys.stdout.flush()
+
+    try:
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir)
+        start = time.time()
+        ok = build(tasks, opts.jobs, os.path.join(build_dir, CACHE_NAME),
+                   opts.force, opts.keep_going, report)
+        wall_time = time.time() - start
+    except EnvironmentError as e:
+        print >> sys.stderr, "error: %s" % e
+        return 2
+
+    if not opts.quiet:
+        print
+    write_summary(sys.stdout, tasks, wall_time)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
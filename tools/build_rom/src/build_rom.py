@@ -2,12 +2,35 @@
 """
 build_rom.py: Create VHDL package with ROM initialization constant from 
 Intel-HEX object code file.
+Can also create a Verilog include file with the same data, or a plain memory
+file to be loaded by a Verilog simulator with $readmemh or $readmemb.
+For firmware updates without resynthesis it can create Quartus MIF files, 
+Vivado COE files and Xilinx BRAM INIT_xx attribute blocks, along with a report
+of the address range held by each BRAM.
 Please use with --help to get some brief usage instructions.
+
+The module can also be imported by other tools. Function parse_ihex (or 
+read_ihex_file) builds a MemoryImage from the object code, and write_rom (or
+format_rom) emits it in any of the output formats. Nothing in the library 
+prints to the console or exits; errors are raised as BuildRomError.
 """
 
 import sys
 import os
 import argparse
+import binascii
+import hashlib
+import json
+import time
+import filecmp
+import tempfile
+import re
+import multiprocessing
+import cStringIO
+
+__all__ = ['BuildRomError', 'HexFileError', 'MemoryMapError', 'TemplateError',
+           'MemoryImage', 'parse_ihex', 'read_ihex_file', 'write_rom', 
+           'format_rom', 'write_map_report', 'FORMAT_CHOICES']
 
 TAG_BOTTOM_ADDR = "@bottom_addr@"
 TAG_TOP_ADDR = "@top_addr@"
@@ -15,132 +38,665 @@ TAG_PKGNAME = "@obj_pkg_name@"
 TAG_CODEBYTES = "@obj_bytes@"
 TAG_PROJNAME = "@project_name@"
 
+# Intel HEX record types.
+IHEX_DATA = 0x00
+IHEX_EOF = 0x01
+IHEX_EXT_SEGMENT_ADDR = 0x02
+IHEX_START_SEGMENT_ADDR = 0x03
+IHEX_EXT_LINEAR_ADDR = 0x04
+IHEX_START_LINEAR_ADDR = 0x05
+
 
 DEFAULT_VHDL_OUTPUT_NAME = "obj_code_pkg.vhdl"
 DEFAULT_VERILOG_OUTPUT_NAME = "obj_code.inc.v"
+DEFAULT_MEM_OUTPUT_NAME = "obj_code.mem"
+DEFAULT_MIF_OUTPUT_NAME = "obj_code.mif"
+DEFAULT_COE_OUTPUT_NAME = "obj_code.coe"
+DEFAULT_INIT_OUTPUT_NAME = "obj_code.init"
 
 FORMAT_VERILOG = 'verilog'
 FORMAT_VHDL = 'vhdl'
-FORMAT_CHOICES = [FORMAT_VHDL, FORMAT_VERILOG]
+FORMAT_MEMH = 'memh'
+FORMAT_MEMB = 'memb'
+FORMAT_MIF = 'mif'
+FORMAT_COE = 'coe'
+FORMAT_INIT = 'init'
+FORMAT_CHOICES = [FORMAT_VHDL, FORMAT_VERILOG, FORMAT_MEMH, FORMAT_MEMB,
+                  FORMAT_MIF, FORMAT_COE, FORMAT_INIT]
+
+# Bytes per Xilinx BRAM INIT_xx attribute.
+INIT_ATTR_BYTES = 32
+
+# Template used by each output format, if any.
+FORMAT_TEMPLATES = {
+    FORMAT_VHDL: "template.vhdl",
+    FORMAT_VERILOG: "template.v",
+}
+
+# Options that have no effect on the output and are left out of the cache key.
+CACHE_NEUTRAL_OPTIONS = ['quiet', 'cache', 'batch', 'manifest', 'jobs', 
+                         'keep_going', 'key', 'defines']
+
+
+class BuildRomError(Exception):
+    """Base class of all the errors raised by this module."""
+    pass
+
+
+class HexFileError(BuildRomError):
+    """Malformed Intel HEX object code. Attribute lineno is the offending line
+    number, if known.
+    """
+    def __init__(self, message, lineno=None):
+        BuildRomError.__init__(self, message)
+        self.lineno = lineno
+
 
-def _build_vhdl_package(data_array, bottom, top, opts):
-    """ """
+class MemoryMapError(BuildRomError):
+    """Object code does not fit in the target memory block."""
+    pass
+
+
+class TemplateError(BuildRomError):
+    """Output template missing or unreadable."""
+    pass
+
+
+# VHDL literal for each byte value, as used in all but the last array element.
+VHDL_BYTES = ['X"%02x", ' % b for b in range(256)]
+# VHDL literal for each byte value.
+VHDL_HEX_BYTES = ['X"%02x"' % b for b in range(256)]
+# Verilog/memory file literals for each byte value.
+HEX_BYTES = ["%02x" % b for b in range(256)]
+BIN_BYTES = ["{0:08b}".format(b) for b in range(256)]
+
+# Templates already read and split, by name. Batch conversions read them once.
+_templates = {}
 
-    # Open template file and read it into a list of lines.
+def _read_template(name):
+    """Read template file from the templates dir and split it in two at the
+    object code tag.
+    Return (head, tail) strings; any other tags are still to be replaced.
+    """
+    if name in _templates:
+        return _templates[name]
     script_dir = os.path.dirname(__file__)
-    template_filename = os.path.join(script_dir, "..","templates", "template.vhdl")
+    template_filename = os.path.join(script_dir, "..","templates", name)
     try:
         fin = open(template_filename, "r")
-        lines = fin.readlines()
+        text = fin.read()
         fin.close()
     except IOError as e:
-        print e 
-        sys.exit(e.errno)
-
-    code_bytes = ""
-    code_line = " "*4
-    i = 0
-    print "Range: %d to %d" %(bottom, top)
-    for addr in range(bottom, top+1):
-        b = data_array[addr]
-        if addr < top:
-            code_line += "X\"%02x\", " % b
-        else:
-            code_line += "X\"%02x\"  " % b
-        if (i % 8) == 7:
-            code_bytes += code_line + " -- %04xh : %04xh\n" % (addr-7, addr)
-            code_line = " "*4
-            i = 0
+        raise TemplateError(str(e))
+    (head, sep, tail) = text.partition(TAG_CODEBYTES)
+    _templates[name] = (head, tail)
+    return _templates[name]
+
+
+def _replace_tags(text, tags):
+    """Replace tags in template text; only lines with some tag are touched."""
+    if "@" not in text:
+        return text
+    lines = text.splitlines(True)
+    for i, line in enumerate(lines):
+        if "@" in line:
+            for (tag, value) in tags:
+                line = line.replace(tag, value)
+            lines[i] = line
+    return "".join(lines)
+
+
+def _write_template(fo, name, tags, write_code):
+    """Write template to file object, with the object code written in place by 
+    function write_code(fo) and the other tags replaced.
+    """
+    (head, tail) = _read_template(name)
+    fo.write(_replace_tags(head, tags))
+    write_code(fo)
+    fo.write(_replace_tags(tail, tags))
+
+
+def _byte_runs(data_array, bottom, top, min_run):
+    """Return list of (first, last, value) tuples for all the runs of at least
+    min_run equal bytes within data_array[bottom:top+1].
+    """
+    if min_run < 2:
+        return []
+    data = bytes(data_array[bottom:top+1])
+    runs = []
+    for m in re.finditer(r"(.)\1{%d,}" % (min_run - 1), data, re.DOTALL):
+        runs.append((bottom + m.start(), bottom + m.end() - 1, ord(m.group(1))))
+    return runs
+
+
+def _vhdl_named_rows(data_array, bottom, top, runs, fill):
+    """Yield (text, first, last) rows of a VHDL aggregate in named association.
+    Runs of the fill byte are left to the 'others' choice, runs of any other
+    value get a ranged choice and the rest of the bytes go 8 to a row.
+    """
+    byte = VHDL_HEX_BYTES
+    others = False
+    addr = bottom
+    for run in runs + [(top + 1, top, None)]:
+        (first, last, value) = run
+        for row_addr in xrange(addr, first, 8):
+            row_last = min(row_addr + 7, first - 1)
+            row = ", ".join(["16#%04x# => %s" % (a, byte[data_array[a]]) 
+                             for a in xrange(row_addr, row_last + 1)])
+            yield (row, row_addr, row_last)
+        if value is None:
+            break
+        if value == fill:
+            others = True
         else:
-            i = i + 1
-    if len(code_line.strip()) > 0:
-      code_bytes += " "*4 + "%-56s -- %04xh : %04xh\n" % (code_line.strip(), addr-i+1, addr)
+            yield ("16#%04x# to 16#%04x# => %s" % (first, last, byte[value]), first, last)
+        addr = last + 1
+    if others:
+        yield ("others => %s" % byte[fill], None, None)
+
 
-    vhdl = ""
-    for line in lines:
-        line = line.replace(TAG_BOTTOM_ADDR, "%d" % bottom)
-        line = line.replace(TAG_TOP_ADDR, "%d" % top)
-        line = line.replace(TAG_PKGNAME, "obj_code_pkg")
-        line = line.replace(TAG_PROJNAME, opts.project)
-        line = line.replace(TAG_CODEBYTES, code_bytes)
-        vhdl += line
+def _write_vhdl_package(fo, data_array, bottom, top, opts):
+    """Write VHDL package with the object code constant to file object.
+    The constant is a positional aggregate unless there are runs of at least 
+    opts.fill_run equal bytes, which are collapsed into ranged choices or, if
+    they are made of the fill byte, into an 'others' choice.
+    """
 
-    return vhdl
+    runs = _byte_runs(data_array, bottom, top, opts.fill_run)
 
+    def write_positional(fo):
+        # Rows of 8 bytes; the last element of the array has no comma.
+        byte = VHDL_BYTES
+        rows = []
+        for addr in xrange(bottom, top+1, 8):
+            last = min(addr + 7, top)
+            if last < top:
+                row = "".join([byte[b] for b in data_array[addr:last+1]])
+            else:
+                row = "".join([byte[b] for b in data_array[addr:last]]) 
+                row += 'X"%02x"' % data_array[last]
+            rows.append("    %-56s -- %04xh : %04xh\n" % (row.rstrip(), addr, last))
+            if len(rows) >= 1024:
+                fo.writelines(rows)
+                rows = []
+        fo.writelines(rows)
+
+    def write_named(fo):
+        # Each row is written once the next one is known to add the comma.
+        prev = None
+        for row in _vhdl_named_rows(data_array, bottom, top, runs, opts.fill):
+            if prev:
+                _write_vhdl_named_row(fo, prev, ",")
+            prev = row
+        _write_vhdl_named_row(fo, prev, "")
+
+    tags = [(TAG_BOTTOM_ADDR, "%d" % bottom),
+            (TAG_TOP_ADDR, "%d" % top),
+            (TAG_PKGNAME, "obj_code_pkg"),
+            (TAG_PROJNAME, opts.project)] + opts.defines
+    write_code = write_named if runs else write_positional
+    _write_template(fo, FORMAT_TEMPLATES[FORMAT_VHDL], tags, write_code)
+    fo.write("\n")
+
+
+def _write_vhdl_named_row(fo, row, sep):
+    """Write row of named aggregate as yielded by _vhdl_named_rows."""
+    (text, first, last) = row
+    if first is None:
+        fo.write("    %s%s\n" % (text, sep))
+    else:
+        fo.write("    %-152s -- %04xh : %04xh\n" % (text + sep, first, last))
+
+
+def _write_verilog_include(fo, data_array, bottom, top, opts):
+    """Write Verilog include file with one initial block that loads the 
+    object code into array 'object_code' word by word.
+    """
+
+    def write_code(fo):
+        byte = HEX_BYTES
+        rows = []
+        for addr in xrange(bottom, top+1, 8):
+            last = min(addr + 7, top)
+            words = ["object_code[%d] = 8'h%s;" % (a, byte[data_array[a]]) 
+                     for a in xrange(addr, last+1)]
+            rows.append("    %s // %04xh : %04xh" % (" ".join(words), addr, last))
+        fo.write("\n".join(rows))
+
+    tags = [(TAG_BOTTOM_ADDR, "%d" % bottom),
+            (TAG_TOP_ADDR, "%d" % top),
+            (TAG_PROJNAME, opts.project)] + opts.defines
+    _write_template(fo, FORMAT_TEMPLATES[FORMAT_VERILOG], tags, write_code)
+    fo.write("\n")
+
+
+def _write_mem_file(fo, data_array, bottom, top, opts):
+    """Write memory file to be read with $readmemh or $readmemb.
+    The file starts with an address specifier so the data will be loaded at 
+    the right place even if the target array starts at 0.
+    """
+
+    if opts.format == FORMAT_MEMH:
+        byte = HEX_BYTES
+        per_line = 16
+    else:
+        byte = BIN_BYTES
+        per_line = 8
+
+    fo.write("// Object code for project '%s', written by build_rom.py.\n" % opts.project)
+    fo.write("// Load with $readmem%s; range %04xh to %04xh.\n" % (opts.format[-1], bottom, top))
+    fo.write("@%04x\n" % bottom)
+    rows = []
+    for addr in xrange(bottom, top+1, per_line):
+        last = min(addr + per_line - 1, top)
+        words = [byte[b] for b in data_array[addr:last+1]]
+        rows.append("%s // %04xh" % (" ".join(words), addr))
+    fo.write("\n".join(rows))
+    fo.write("\n")
+
+
+def _write_mif_file(fo, data_array, bottom, top, opts):
+    """Write Quartus Memory Initialization File (MIF).
+    Addresses in the file are relative to the bottom of the data, and runs of
+    at least opts.fill_run equal bytes are collapsed into address ranges.
+    """
+
+    byte = HEX_BYTES
+    fo.write("-- Object code for project '%s', written by build_rom.py.\n" % opts.project)
+    fo.write("-- Range %04xh to %04xh.\n" % (bottom, top))
+    fo.write("WIDTH=8;\n")
+    fo.write("DEPTH=%d;\n" % (top - bottom + 1))
+    fo.write("ADDRESS_RADIX=HEX;\n")
+    fo.write("DATA_RADIX=HEX;\n\n")
+    fo.write("CONTENT BEGIN\n")
+    runs = _byte_runs(data_array, bottom, top, opts.fill_run)
+    addr = bottom
+    for (first, last, value) in runs + [(top + 1, top, None)]:
+        for row_addr in xrange(addr, first, 16):
+            row_last = min(row_addr + 15, first - 1)
+            words = [byte[b] for b in data_array[row_addr:row_last+1]]
+            fo.write("    %04x : %s;\n" % (row_addr - bottom, " ".join(words)))
+        if value is not None:
+            fo.write("    [%04x..%04x] : %s;\n" % (first - bottom, last - bottom, byte[value]))
+            addr = last + 1
+    fo.write("END;\n")
+
+
+def _write_coe_file(fo, data_array, bottom, top, opts):
+    """Write Vivado/ISE memory coefficients file (COE) for block memory IPs.
+    The first value in the file goes to address 0 of the memory block.
+    """
+
+    byte = HEX_BYTES
+    fo.write("; Object code for project '%s', written by build_rom.py.\n" % opts.project)
+    fo.write("; Range %04xh to %04xh.\n" % (bottom, top))
+    fo.write("memory_initialization_radix=16;\n")
+    fo.write("memory_initialization_vector=\n")
+    rows = []
+    for addr in xrange(bottom, top+1, 16):
+        last = min(addr + 15, top)
+        rows.append(", ".join([byte[b] for b in data_array[addr:last+1]]))
+    fo.write(",\n".join(rows))
+    fo.write(";\n")
+
+
+def _write_init_file(fo, data_array, bottom, top, opts):
+    """Write one block of INIT_xx attributes per Xilinx BRAM, for a memory made
+    of opts.bram_size-byte, 8-bit wide BRAMs. The blocks are formatted as VHDL
+    generic map associations. The last BRAM is padded with the fill byte.
+    """
+
+    byte = HEX_BYTES
+    fo.write("-- Object code for project '%s', written by build_rom.py.\n" % opts.project)
+    fo.write("-- Range %04xh to %04xh, %d-byte BRAMs.\n" % (bottom, top, opts.bram_size))
+    for (index, first, last) in _bram_map(bottom, top, opts.bram_size):
+        fo.write("\n-- BRAM %d: %04xh to %04xh\n" % (index, first, last))
+        block = data_array[first:last+1]
+        block.extend(bytearray([opts.fill]) * (opts.bram_size - len(block)))
+        attrs = []
+        for attr in xrange(opts.bram_size // INIT_ATTR_BYTES):
+            words = block[attr*INIT_ATTR_BYTES:(attr+1)*INIT_ATTR_BYTES]
+            # Lowest address is the rightmost byte of the attribute value.
+            words.reverse()
+            attrs.append('INIT_%02X => X"%s"' % (attr, "".join([byte[b] for b in words])))
+        fo.write(",\n".join(attrs))
+        fo.write("\n")
+
+
+def _bram_map(bottom, top, bram_size):
+    """Return list of (BRAM index, first address, last address) tuples for a 
+    memory made of bram_size-byte BRAMs, holding the data at bottom..top.
+    """
+    return [(i, addr, min(addr + bram_size - 1, top)) 
+            for (i, addr) in enumerate(xrange(bottom, top+1, bram_size))]
+
+
+def _write_map_report(fo, bottom, top, opts):
+    """Write report with the address range held by each BRAM."""
+    fo.write("BRAM map for project '%s', output file '%s':\n" % (opts.project, opts.output))
+    fo.write("%d-byte BRAMs, 8 bits wide, range %04xh to %04xh.\n" % (opts.bram_size, bottom, top))
+    attrs = opts.bram_size // INIT_ATTR_BYTES
+    for (index, first, last) in _bram_map(bottom, top, opts.bram_size):
+        used = (last - first) // INIT_ATTR_BYTES
+        fo.write("BRAM %3d: %04xh to %04xh, %5d bytes, INIT_00 to INIT_%02X (%d used)\n" % 
+                 (index, first, last, last - first + 1, attrs - 1, used + 1))
+
+
+# Writer of each output format.
+_WRITERS = {
+    FORMAT_VHDL: _write_vhdl_package,
+    FORMAT_VERILOG: _write_verilog_include,
+    FORMAT_MEMH: _write_mem_file,
+    FORMAT_MEMB: _write_mem_file,
+    FORMAT_MIF: _write_mif_file,
+    FORMAT_COE: _write_coe_file,
+    FORMAT_INIT: _write_init_file,
+}
 
-def _build_verilog_include(data_array, bottom, top, opts):
-    pass
 
 def _parse_hex_line(line):
-    """Parse code line in HEX object file."""
+    """Parse record in HEX object file.
+    Return tuple (record type, 16-bit load offset, record data) where data is
+    a memoryview on the decoded record, or None if the record is malformed or
+    has a checksum error.
+    """
     line = line.strip()
-    slen = int(line[1:3],16)
-    sloc = int(line[3:7],16)
-    stype = line[7:9]
-    sdata = line[9:len(line)-2]
-    schk = int(line[len(line)-2:],16)
-        
-    csum = slen + int(sloc / 256) + (sloc % 256) + int(stype,16)
-    bytes = [0, ] * slen
-    for i in range(slen):
-        sbyte = int(sdata[i*2:i*2+2],16)
-        bytes[i] = sbyte;
-        csum = csum + sbyte
-    
-    csum = ~csum
-    csum = csum + 1
-    csum = csum % 256
-    if csum != schk:
-        return (None, None)
-        
-    return (sloc, bytes)
+    if not line.startswith(':'):
+        return None
+    # Decode the whole record in one go: length, offset, type, data, checksum.
+    try:
+        record = bytearray(binascii.unhexlify(line[1:]))
+    except (TypeError, binascii.Error):
+        return None
+    if len(record) < 5 or len(record) != record[0] + 5:
+        return None
+    # The sum of all bytes in a valid record, checksum included, is zero.
+    if (sum(record) & 0xff) != 0:
+        return None
 
-    
-def _read_ihex_file(ihex_filename, quiet=False, fill=0):
+    return (record[3], (record[1] << 8) | record[2], memoryview(record)[4:-1])
+
+
+class MemoryImage(object):
+    """Memory image loaded from object code.
+    Attribute data is a bytearray indexed by address, never smaller than 64KB,
+    in which locations not initialized by the object code hold the fill byte.
+    Attributes bottom and top bound the object code, top being exclusive; both
+    are 0 if there is no object code. Attribute start is the start address 
+    given by the object code, if any, and eof tells if an EOF record was seen.
     """
-    Read Intel HEX file into a 64KB array.
-    The file is assumed not to have any object code outside the range [0:64K-1].
-    Return the 64K array plus the size and bounds of the read data.
-    Array locations not initialized by hex file are filled with supplied value.
+
+    def __init__(self, fill=0):
+        self.data = bytearray([fill]) * 65536
+        self.fill = fill
+        self.total_bytes = 0
+        self.bottom = 0
+        self.top = 0
+        self.start = None
+        self.eof = False
+        self._loaded = False
+
+    def _grow(self, size):
+        """Grow the image with fill bytes up to size bytes."""
+        if size > len(self.data):
+            self.data.extend(bytearray([self.fill]) * (size - len(self.data)))
+
+    def load(self, address, data):
+        """Copy data into the image at address, growing the image as needed."""
+        size = len(data)
+        self._grow(address + size)
+        self.data[address:address + size] = data
+        self.total_bytes = self.total_bytes + size
+        if not self._loaded or address < self.bottom:
+            self.bottom = address
+        if not self._loaded or (address + size) > self.top:
+            self.top = (address + size)
+        self._loaded = True
+
+    def window(self, membase=None, memsize=None):
+        """Return (bottom, top) bounds of the ROM data, both inclusive.
+        By default the ROM data spans the object code plus the location right 
+        past it. If a memory block is given the ROM data spans the whole block
+        instead; MemoryMapError is raised if the object code does not fit in it.
+        The image is grown to cover the returned bounds.
+        """
+        if membase is None and memsize is None:
+            (bottom, top) = (self.bottom, self.top)
+        else:
+            bottom = membase or 0
+            if memsize is not None:
+                top = bottom + memsize - 1
+            else:
+                top = max(self.top, bottom)
+            if self.total_bytes and (self.bottom < bottom or self.top - 1 > top):
+                raise MemoryMapError(
+                    "Object code (%04xh to %04xh) does not fit in memory block %04xh to %04xh." % 
+                    (self.bottom, self.top - 1, bottom, top))
+        self._grow(top + 1)
+        return (bottom, top)
+
+
+def parse_ihex(source, fill=0):
     """
-    
-    # CODE array, initialized to 64K of zeros...
-    xcode = [fill, ] * 65536
-    # ...and code boundaries, initialized out of range.
-    bottom = 100000
-    top = -1
-    (xcode, top, bottom)
-
-    # Read the whole file to a list of lines...
+    Parse Intel HEX object code into a MemoryImage.
+    The source may be a string holding the whole object code, an open file or
+    any other iterable of lines; it is read one record at a time. Extended 
+    segment (02) and extended linear (04) address records are honored so the 
+    object code may live anywhere. Start address records (03, 05) carry no 
+    object code and only set the image start address.
+    Image locations not initialized by the object code hold the fill value.
+    Raise HexFileError if the object code is malformed.
+    """
+
+    if isinstance(source, (basestring, bytearray)):
+        source = str(source).splitlines()
+
+    image = MemoryImage(fill)
+    # Base address set by the last extended address record.
+    base = 0
+
+    for lineno, line in enumerate(source, 1):
+        if not line.strip():
+            continue
+        record = _parse_hex_line(line)
+        if record is None:
+            raise HexFileError("Checksum error in object file, line %d!" % lineno, lineno)
+        (rtype, offset, data) = record
+
+        if rtype == IHEX_DATA:
+            image.load(base + offset, data)
+        elif rtype == IHEX_EOF:
+            image.eof = True
+            break
+        elif rtype in (IHEX_EXT_SEGMENT_ADDR, IHEX_EXT_LINEAR_ADDR):
+            if len(data) != 2:
+                raise HexFileError("Malformed address record in object file, line %d!" % lineno, lineno)
+            fields = bytearray(data)
+            value = (fields[0] << 8) | fields[1]
+            if rtype == IHEX_EXT_SEGMENT_ADDR:
+                base = value << 4
+            else:
+                base = value << 16
+        elif rtype in (IHEX_START_SEGMENT_ADDR, IHEX_START_LINEAR_ADDR):
+            if len(data) != 4:
+                raise HexFileError("Malformed start address record in object file, line %d!" % lineno, lineno)
+            fields = bytearray(data)
+            if rtype == IHEX_START_SEGMENT_ADDR:
+                image.start = (((fields[0] << 8) | fields[1]) << 4) + ((fields[2] << 8) | fields[3])
+            else:
+                image.start = (fields[0] << 24) | (fields[1] << 16) | (fields[2] << 8) | fields[3]
+        else:
+            raise HexFileError("Unknown record type %02xh in object file, line %d!" % (rtype, lineno), lineno)
+
+    return image
+
+
+def read_ihex_file(ihex_filename, fill=0):
+    """Read Intel HEX file into a MemoryImage, see parse_ihex.
+    IOError is raised if the file can't be read.
+    """
+    with open(ihex_filename, "r") as fin:
+        return parse_ihex(fin, fill)
+
+
+def _define_tags(defines):
+    """Return template (tag, value) list for a dict or sequence of parameter
+    (NAME, VALUE) definitions.
+    """
+    if not defines:
+        return []
+    if isinstance(defines, dict):
+        defines = sorted(defines.items())
+    return [("@%s@" % name, value) for (name, value) in defines]
+
+
+def _emit_options(image, format, project, fill_run, bram_size, defines, output):
+    """Build the option set used by the format writers."""
+    if format not in _WRITERS:
+        raise BuildRomError("Invalid output format '%s'." % format)
+    if bram_size <= 0 or bram_size % INIT_ATTR_BYTES:
+        raise BuildRomError("BRAM size must be a multiple of %d bytes" % INIT_ATTR_BYTES)
+    return argparse.Namespace(format=format, project=project, fill=image.fill,
+                              fill_run=fill_run, bram_size=bram_size, 
+                              defines=_define_tags(defines), output=output)
+
+
+def write_rom(fo, image, format=FORMAT_VHDL, project="(unknown)", 
+              membase=None, memsize=None, fill_run=256, bram_size=4096,
+              defines=None):
+    """Write ROM initialization data for MemoryImage image to file object fo.
+    The format is one of FORMAT_CHOICES. The ROM spans the object code or, if
+    membase and/or memsize are given, the whole target memory block.
+    Runs of at least fill_run equal bytes are collapsed in formats vhdl and 
+    mif (0 to disable), bram_size applies to formats mif, coe and init, and
+    defines is a dict of NAME: VALUE replacing tags @NAME@ in the templates.
+    Return the (bottom, top) bounds of the ROM data, both inclusive.
+    """
+    opts = _emit_options(image, format, project, fill_run, bram_size, defines, None)
+    (bottom, top) = image.window(membase, memsize)
+    _WRITERS[format](fo, image.data, bottom, top, opts)
+    return (bottom, top)
+
+
+def format_rom(image, format=FORMAT_VHDL, **options):
+    """Return ROM initialization data for image as a string, see write_rom."""
+    fo = cStringIO.StringIO()
+    write_rom(fo, image, format, **options)
+    return fo.getvalue()
+
+
+def write_map_report(fo, image, output="(unknown)", project="(unknown)", 
+                     membase=None, memsize=None, bram_size=4096):
+    """Write report with the address range held by each BRAM of the memory 
+    written by write_rom to file output.
+    """
+    opts = _emit_options(image, FORMAT_INIT, project, 0, bram_size, None, output)
+    (bottom, top) = image.window(membase, memsize)
+    _write_map_report(fo, bottom, top, opts)
+
+
+def _file_digest(filename):
+    """Return SHA-1 hex digest of file contents or None if it can't be read."""
+    h = hashlib.sha1()
     try:
-        fin = open(ihex_filename, "r")
-        ihex_lines = fin.readlines()
-        fin.close()
-    except IOError as e:
-        print e 
-        sys.exit(e.errno)
-
-    # ...and parse the lines one by one.
-    total_bytes = 0
-    for line in ihex_lines:
-        (address, bytes) = _parse_hex_line(line)
-        if address == None:
-            print >> sys.stderr, "Checksum error in object file!"
-            sys.exit(1)
-        total_bytes = total_bytes + len(bytes)
-        for i in range(len(bytes)):
-            xcode[address + i] = bytes[i]
-        
-        if address < bottom:
-            bottom = address
-    
-        if (address + len(bytes)) > top:
-            top = (address + len(bytes))
-    
-    if not quiet:
-        print >> sys.stdout, "Read %d bytes from file '%s'" % (total_bytes, ihex_filename)
-        print >> sys.stdout, "Code range %04xh to %04xh" % (bottom, top)
-    return (xcode, total_bytes, bottom, top)
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+    except IOError:
+        return None
+    return h.hexdigest()
+
+
+def _cache_key(opts):
+    """Compute build cache key for a conversion.
+    The key covers the object code file, the template, this script (which 
+    stands for the tool version) and all options that affect the output.
+    """
+    h = hashlib.sha1()
+    script = os.path.abspath(__file__)
+    if script.endswith(".pyc"):
+        script = script[:-1]
+    inputs = [script, opts.object]
+    if opts.format in FORMAT_TEMPLATES:
+        script_dir = os.path.dirname(__file__)
+        inputs.append(os.path.join(script_dir, "..", "templates", 
+                                   FORMAT_TEMPLATES[opts.format]))
+    for filename in inputs:
+        h.update("%s\n" % _file_digest(filename))
+    for name in sorted(vars(opts)):
+        if name not in CACHE_NEUTRAL_OPTIONS:
+            h.update("%s=%r\n" % (name, getattr(opts, name)))
+    return h.hexdigest()
+
+
+def _load_cache(cache_filename):
+    """Load build cache from file. A missing or corrupt cache is empty."""
+    try:
+        with open(cache_filename, "r") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _open_temp(filename):
+    """Create a temporary file next to filename, to be renamed over it later.
+    The name is unique so that parallel jobs and concurrent runs don't write 
+    the same temporary file. The file gets the permissions a plain open() 
+    would give it, not mkstemp's private ones.
+    Return (file object open for writing, temporary file name).
+    """
+    (fd, tmp_filename) = tempfile.mkstemp(
+            dir=os.path.dirname(filename) or ".", 
+            prefix=os.path.basename(filename) + ".",
+            suffix=".tmp")
+    umask = os.umask(0)
+    os.umask(umask)
+    os.fchmod(fd, 0o666 & ~umask)
+    return (os.fdopen(fd, "w"), tmp_filename)
+
+
+def _save_cache(cache_filename, cache):
+    """Save build cache to file, replacing the old one atomically."""
+    (f, tmp_filename) = _open_temp(cache_filename)
+    try:
+        with f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+    except:
+        os.remove(tmp_filename)
+        raise
+    os.rename(tmp_filename, cache_filename)
+
+
+def _cache_hit(cache, output, key):
+    """True if output was built with this key and has not been touched since."""
+    entry = cache.get(os.path.abspath(output))
+    if not entry or entry.get("key") != key:
+        return False
+    return _file_digest(output) == entry.get("digest")
+
+
+def _write_output(output, write):
+    """Write output file through function write(fo).
+    The output is streamed to a temporary file which only replaces the output
+    file if their contents differ. Leaving an unchanged file alone preserves 
+    its mtime so that downstream HDL tools don't need to re-analyze it.
+    Return True if the output file was written.
+    """
+    (fo, tmp_output) = _open_temp(output)
+    try:
+        with fo:
+            write(fo)
+    except:
+        if os.path.isfile(tmp_output):
+            os.remove(tmp_output)
+        raise
+    if os.path.isfile(output) and filecmp.cmp(tmp_output, output, shallow=False):
+        os.remove(tmp_output)
+        return False
+    os.rename(tmp_output, output)
+    return True
+
 
 def _parse_cmdline(argv):
 
@@ -150,6 +706,7 @@ def _parse_cmdline(argv):
     parser.add_argument(
             'object', 
             type=str,
+            nargs='?',
             help='Object code file in Intel HEX format.')
     parser.add_argument(
             '--project', 
@@ -165,32 +722,114 @@ def _parse_cmdline(argv):
             '--output', 
             type=str,
             default=None,
-            help='Output file path. Defaults to same as object file with suitable extension vhdl/v.')
+            help='Output file path. Defaults to obj_code_pkg.vhdl, obj_code.inc.v, '
+                 'or obj_code.<format> for the other formats.')
     parser.add_argument(
             '--memsize', 
-            type=int,
-            default=4*1024,
-            help='Size of target memory block in bytes. Defaults to 4KB.')
+            type=lambda x: int(x, 0),
+            default=None,
+            help='Size of target memory block in bytes. If given, the ROM data '
+                 'will span the whole block. By default it spans the object '
+                 'code only.')
     parser.add_argument(
             '--membase', 
-            type=int,
+            type=lambda x: int(x, 0),
+            default=None,
+            help='Base address of target memory block. Defaults to 0 if '
+                 '--memsize is given.')
+    parser.add_argument(
+            '--fill', 
+            type=lambda x: int(x, 0),
             default=0,
-            help='Base address of target memory block. Defaults to 0.')
+            help='Value of memory locations not initialized by the object '
+                 'code. Defaults to 0.')
+    parser.add_argument(
+            '--fill-run', 
+            type=int,
+            default=256,
+            help='Collapse runs of at least this many equal bytes in the VHDL '
+                 'constant into a single choice, 0 to disable. Defaults to 256.')
+    parser.add_argument(
+            '--bram-size', 
+            type=lambda x: int(x, 0),
+            default=4096,
+            help='Size in bytes of each BRAM for formats mif, coe and init. '
+                 'Defaults to 4096 (Xilinx RAMB36 at 8 bits).')
+    parser.add_argument(
+            '--map-report', 
+            type=str,
+            default=None,
+            metavar='FILE',
+            help='Write BRAM map report to FILE (formats mif, coe and init). '
+                 'By default it goes to the console. Not allowed in batch '
+                 'mode.')
     parser.add_argument(
             '--quiet', 
             action='store_true',
             default=False,
             help='Supress all chatter form console output.')
+    parser.add_argument(
+            '--cache', 
+            type=str,
+            default=None,
+            metavar='FILE',
+            help='Build cache file. If the output was built before from the '
+                 'same inputs and options it is left untouched.')
+    parser.add_argument(
+            '--batch', 
+            type=str,
+            action='append',
+            default=[],
+            metavar='OBJECT:OUTPUT',
+            help='Convert object file to output file, may be repeated. '
+                 'All batch conversions are done in a single run, along with '
+                 'the object file argument if one is given.')
+    parser.add_argument(
+            '--manifest', 
+            type=str,
+            default=None,
+            metavar='FILE',
+            help='Batch conversion list, one OBJECT:OUTPUT [PROJECT] per line. '
+                 'Relative paths are relative to the manifest.')
+    parser.add_argument(
+            '--jobs', 
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help='Number of parallel batch conversions. Defaults to CPU count.')
+    parser.add_argument(
+            '--keep-going', 
+            action='store_true',
+            default=False,
+            help='Go on with the batch after a conversion fails.')
     parser.add_argument(
             'parameters', 
             type=str,
             metavar='+define+NAME=VALUE',
             nargs='*',
-            default=0,
+            default=[],
             help='Parameter definition.')
 
 
-    opts = parser.parse_args()
+    opts = parser.parse_args(argv)
+
+    if not opts.object and not opts.batch and not opts.manifest:
+        parser.error("no object code file given")
+    if opts.map_report and (opts.batch or opts.manifest):
+        parser.error("--map-report can't be used with --batch or --manifest")
+    if opts.fill < 0 or opts.fill > 255:
+        parser.error("fill value out of byte range")
+    if opts.memsize is not None and opts.memsize <= 0:
+        parser.error("invalid memory size")
+    if opts.bram_size <= 0 or opts.bram_size % INIT_ATTR_BYTES:
+        parser.error("BRAM size must be a multiple of %d bytes" % INIT_ATTR_BYTES)
+
+    # Parameter definitions replace tags '@NAME@' in the template.
+    opts.defines = []
+    for param in opts.parameters:
+        m = re.match(r"\+define\+([_A-Za-z][_A-Za-z0-9]*)=(.*)$", param)
+        if not m:
+            parser.error("invalid parameter definition '%s'" % param)
+        opts.defines.append((m.group(1), m.group(2)))
 
     # Set output file name if none is given.
     if not opts.output:
@@ -198,6 +837,14 @@ def _parse_cmdline(argv):
             opts.output = DEFAULT_VHDL_OUTPUT_NAME
         elif opts.format == FORMAT_VERILOG:
             opts.output = DEFAULT_VERILOG_OUTPUT_NAME
+        elif opts.format in (FORMAT_MEMH, FORMAT_MEMB):
+            opts.output = DEFAULT_MEM_OUTPUT_NAME
+        elif opts.format == FORMAT_MIF:
+            opts.output = DEFAULT_MIF_OUTPUT_NAME
+        elif opts.format == FORMAT_COE:
+            opts.output = DEFAULT_COE_OUTPUT_NAME
+        elif opts.format == FORMAT_INIT:
+            opts.output = DEFAULT_INIT_OUTPUT_NAME
         else:
             # Should not happen but...
             print >> sys.stderr, "Invalid output format '%s'." % opts.format
@@ -206,29 +853,205 @@ def _parse_cmdline(argv):
 
     return opts
 
-def _main(argv):
+def _rom_options(opts):
+    """Return the write_rom keyword arguments for the command line options."""
+    return dict(format=opts.format, project=opts.project, 
+                membase=opts.membase, memsize=opts.memsize, 
+                fill_run=opts.fill_run, bram_size=opts.bram_size,
+                defines=opts.defines)
 
-    opts = _parse_cmdline(argv)
 
-    (objcode, total_bytes, bottom, top) = _read_ihex_file(opts.object, opts.quiet)
+def _convert(opts):
+    """Convert object code file opts.object to file opts.output."""
 
-    if opts.format == 'vhdl':
-        rtl = _build_vhdl_package(objcode, bottom, top, opts)
-    elif opts.format == 'verilog':
-        rtl = _build_verilog_include(objcode, bottom, top, opts)
-    else:
-        print >> sys.stderr, "Invalid output format '%s'." % opts.format
-        sys.exit(2)
+    image = read_ihex_file(opts.object, opts.fill)
+
+    if not opts.quiet:
+        if not image.eof:
+            print >> sys.stderr, "Warning: no EOF record in file '%s'" % opts.object
+        print >> sys.stdout, "Read %d bytes from file '%s'" % (image.total_bytes, opts.object)
+        print >> sys.stdout, "Code range %04xh to %04xh" % (image.bottom, image.top)
+        if image.start is not None:
+            print >> sys.stdout, "Start address %04xh" % image.start
+
+    # Map the object code onto the target memory block, if one was given.
+    (bottom, top) = image.window(opts.membase, opts.memsize)
+    if not opts.quiet and opts.format == FORMAT_VHDL:
+        print "Range: %d to %d" %(bottom, top)
+
+    # Done. Stream the output file.
+    options = _rom_options(opts)
+    _write_output(opts.output, lambda fo: write_rom(fo, image, **options))
+
+    # Tell where each part of the memory goes for the vendor memory formats.
+    if opts.format in (FORMAT_MIF, FORMAT_COE, FORMAT_INIT):
+        del options['format'], options['fill_run'], options['defines']
+        options['output'] = opts.output
+        if opts.map_report:
+            _write_output(opts.map_report, 
+                          lambda fo: write_map_report(fo, image, **options))
+        elif not opts.quiet:
+            write_map_report(sys.stdout, image, **options)
 
 
-    # Done. Write to output file and quit.
+def _read_manifest(manifest_filename):
+    """Read batch manifest into a list of (object, output, project) tuples."""
     try:
-        fo = open(opts.output, "w")
-        print >> fo, rtl
-        #fo.close()
+        fin = open(manifest_filename, "r")
+        lines = fin.readlines()
+        fin.close()
     except IOError as e:
+        raise BuildRomError(str(e))
+
+    manifest_dir = os.path.dirname(manifest_filename)
+    jobs = []
+    for lineno, line in enumerate(lines, 1):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        (obj, sep, output) = fields[0].rpartition(":")
+        if not sep or not obj or not output or len(fields) > 2:
+            raise BuildRomError("%s:%d: expected OBJECT:OUTPUT [PROJECT]" % (manifest_filename, lineno))
+        project = fields[1] if len(fields) > 1 else None
+        jobs.append((os.path.join(manifest_dir, obj), 
+                     os.path.join(manifest_dir, output), 
+                     project))
+    return jobs
+
+
+def _batch_job(opts):
+    """Run one batch conversion, return (opts, run time, error message)."""
+    start = time.time()
+    error = None
+    try:
+        _convert(opts)
+    except (BuildRomError, EnvironmentError) as e:
+        error = str(e)
+    except SystemExit as e:
+        error = "exit status %s" % e.code
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+    return (opts, time.time() - start, error)
+
+
+def _batch(opts):
+    """Convert a batch of object code files, in parallel if so configured.
+    Return the number of failed conversions.
+    """
+
+    # Build one option set per conversion, all alike but for the files.
+    jobs = []
+    if opts.object:
+        jobs.append((opts.object, opts.output, None))
+    if opts.manifest:
+        jobs.extend(_read_manifest(opts.manifest))
+    for pair in opts.batch:
+        (obj, sep, output) = pair.rpartition(":")
+        if not sep or not obj or not output:
+            print >> sys.stderr, "Invalid batch conversion '%s', expected OBJECT:OUTPUT." % pair
+            sys.exit(2)
+        jobs.append((obj, output, None))
+    job_opts = []
+    for (obj, output, project) in jobs:
+        job = argparse.Namespace(**vars(opts))
+        job.object = obj
+        job.output = output
+        job.project = project or opts.project
+        # Per-image chatter would be garbled by parallel jobs.
+        job.quiet = True
+        job_opts.append(job)
+
+    # Weed out the conversions that are up to date.
+    if opts.cache:
+        cache = _load_cache(opts.cache)
+        pending = []
+        for job in job_opts:
+            job.key = _cache_key(job)
+            if _cache_hit(cache, job.output, job.key):
+                if not opts.quiet:
+                    print "File '%s' is up to date." % job.output
+            else:
+                pending.append(job)
+        job_opts = pending
+
+    # Read the template now so that all the workers inherit it.
+    if opts.format in FORMAT_TEMPLATES:
+        _read_template(FORMAT_TEMPLATES[opts.format])
+
+    failures = 0
+    total_start = time.time()
+    pool = None
+    if opts.jobs > 1 and len(job_opts) > 1:
+        pool = multiprocessing.Pool(min(opts.jobs, len(job_opts)))
+        results = pool.imap_unordered(_batch_job, job_opts)
+    else:
+        results = (_batch_job(job) for job in job_opts)
+    try:
+        for (job, run_time, error) in results:
+            if error:
+                failures += 1
+                print >> sys.stderr, "%8.3fs  %s -> %s: FAILED (%s)" % (run_time, job.object, job.output, error)
+                if not opts.keep_going:
+                    break
+            else:
+                if not opts.quiet:
+                    print "%8.3fs  %s -> %s" % (run_time, job.object, job.output)
+                if opts.cache:
+                    cache[os.path.abspath(job.output)] = {
+                        "key": job.key, 
+                        "digest": _file_digest(job.output)
+                    }
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    if opts.cache:
+        _save_cache(opts.cache, cache)
+    if not opts.quiet:
+        print "%8.3fs  %d conversions, %d failed" % (time.time() - total_start, len(job_opts), failures)
+    return failures
+
+
+def _main(argv):
+
+    opts = _parse_cmdline(argv)
+
+    try:
+        _run(opts)
+    except BuildRomError as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    except EnvironmentError as e:
         print e 
-        sys.exit(e.errno)
+        sys.exit(e.errno or 1)
+
+
+def _run(opts):
+    """Run the conversions requested in the command line."""
+
+    if opts.batch or opts.manifest:
+        if _batch(opts):
+            sys.exit(1)
+        return
+
+    # Skip the conversion altogether if the output is up to date.
+    if opts.cache:
+        cache = _load_cache(opts.cache)
+        key = _cache_key(opts)
+        if _cache_hit(cache, opts.output, key):
+            if not opts.quiet:
+                print "File '%s' is up to date." % opts.output
+            return
+
+    _convert(opts)
+
+    if opts.cache:
+        cache[os.path.abspath(opts.output)] = {
+            "key": key, 
+            "digest": _file_digest(opts.output)
+        }
+        _save_cache(opts.cache, cache)
 
 
     
@@ -0,0 +1,42 @@
+//------------------------------------------------------------------------------
+// obj_code.inc.v -- Application object code in Verilog include file format.
+//------------------------------------------------------------------------------
+// Written by build_rom.py for project '@project_name@'.
+//------------------------------------------------------------------------------
+//                                                              
+// This source file may be used and distributed without         
+// restriction provided that this copyright statement is not    
+// removed from the file and that any derivative work contains  
+// the original copyright notice and the associated disclaimer. 
+//                                                              
+// This source file is free software; you can redistribute it   
+// and/or modify it under the terms of the GNU Lesser General   
+// Public License as published by the Free Software Foundation; 
+// either version 2.1 of the License, or (at your option) any   
+// later version.                                               
+//                                                              
+// This source is distributed in the hope that it will be       
+// useful, but WITHOUT ANY WARRANTY; without even the implied   
+// warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR      
+// PURPOSE.  See the GNU Lesser General Public License for more 
+// details.                                                     
+//                                                              
+// You should have received a copy of the GNU Lesser General    
+// Public License along with this source; if not, download it   
+// from http://www.opencores.org/lgpl.shtml
+//------------------------------------------------------------------------------
+// This file is meant to be `include'd within the body of the module that 
+// declares the memory array, e.g.:
+//
+//     reg [7:0] object_code [@bottom_addr@:@top_addr@];
+//     `include "obj_code.inc.v"
+//------------------------------------------------------------------------------
+
+// Object code bounds.
+localparam OBJ_CODE_BOTTOM = @bottom_addr@;
+localparam OBJ_CODE_TOP = @top_addr@;
+
+// Object code initialization.
+initial begin
+@obj_bytes@
+end
@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+################################################################################
+# emu8080.py : instruction-level Intel 8080 reference emulator
+################################################################################
+# Usage: emu8080.py [options] <hex file>
+#
+# Runs an Intel HEX object code file, as built in src/sw/*, on a model of the
+# mcu80 SoC with a plain 8080 in place of the light8080 core. The fetch trace
+# has the same format as the trace written by the mcu80 TB (hw_sim_log.txt) so
+# that the two can be compared with trace_diff.py.
+#
+# Options:
+#
+# -t FILE     : Write fetch trace to FILE.
+# -c FILE     : Write UART console output to FILE (as hw_sim_con.txt) besides
+#               echoing it to stdout.
+# -n COUNT    : Stop after COUNT instructions. Defaults to 100 million.
+# --ram-size  : RAM size in bytes, a power of 2. Defaults to 64KB.
+# -q          : Don't echo console output to stdout or print the summary.
+# -h, --help  : Show help, quit.
+#
+# Emulation ends when the SW writes EOT (04h) to the UART, or when the CPU
+# halts, or after the maximum number of instructions.
+#
+################################################################################
+# This is a reference model, not a model of the light8080 core: all opcodes
+# behave as documented by Intel except for the undefined opcodes, which are
+# NOPs as the light8080 documentation promises. Bits 5 and 3 of the PSW are
+# always 0 and bit 1 is always 1, as in both the 8080 and light8080.
+# The emulator is not cycle accurate and does not model interrupts.
+#
+# Opcodes are executed through a table of 256 closures; flags are computed
+# with precomputed lookup tables wherever possible.
+################################################################################
+
+import sys
+import os
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "build_rom", "src"))
+import build_rom
+from mcu80_soc import Console, load_memory
+
+
+# F register bits.
+FLAG_S = 0x80
+FLAG_Z = 0x40
+FLAG_AC = 0x10
+FLAG_P = 0x04
+FLAG_C = 0x01
+# Bits 5 and 3 of the F register always read as 0 and bit 1 as 1.
+FLAG_CONST = 0x02
+FLAG_MASK = FLAG_S | FLAG_Z | FLAG_AC | FLAG_P | FLAG_C
+
+# Register list indices; the same order as the light8080 register bank, so
+# that 8080 register codes index the list except for code 6 (M).
+B, C, D, E, H, L, F, A = range(8)
+REG_M = 6
+REGISTER_NAMES = ['b', 'c', 'd', 'e', 'h', 'l', 'f', 'a']
+
+# Default emulation length in instructions.
+MAX_INSTRUCTIONS = 100000000
+
+# Undefined opcodes.
+UNDEFINED_OPCODES = [0x08, 0x10, 0x18, 0x20, 0x28, 0x30, 0x38,
+                     0xcb, 0xd9, 0xdd, 0xed, 0xfd]
+
+
+def _szp(v):
+    """S, Z and P flags (plus the constant bits) of byte value v."""
+    f = FLAG_CONST | (v & FLAG_S)
+    if v == 0: f |= FLAG_Z
+    if bin(v).count("1") % 2 == 0: f |= FLAG_P
+    return f
+
+# Flag lookup tables indexed by result byte.
+SZP = [_szp(v) for v in range(256)]
+# INR/DCR: SZP plus AC as a carry out of (borrow into) bit 3; CY unaffected.
+SZP_INR = [SZP[v] | (FLAG_AC if v & 0x0f == 0x00 else 0) for v in range(256)]
+SZP_DCR = [SZP[v] | (FLAG_AC if v & 0x0f != 0x0f else 0) for v in range(256)]
+
+
+def _daa(a, ac, cy):
+    """DAA result as (A << 8) | F given A, AC and CY."""
+    adjust = 0
+    if (a & 0x0f) > 9 or ac:
+        adjust |= 0x06
+    if (a >> 4) > 9 or cy or ((a >> 4) >= 9 and (a & 0x0f) > 9):
+        adjust |= 0x60
+        cy = 1
+    res = (a + adjust) & 0xff
+    f = SZP[res] | cy
+    if (a & 0x0f) + (adjust & 0x0f) > 0x0f: f |= FLAG_AC
+    return (res << 8) | f
+
+# DAA lookup table indexed by (AC, CY, A) as (F & (AC|CY)) << 8 | A.
+DAA = [0] * (0x1100 + 256)
+for _f in (0, FLAG_C, FLAG_AC, FLAG_AC | FLAG_C):
+    for _a in range(256):
+        DAA[(_f << 8) | _a] = _daa(_a, _f & FLAG_AC, _f & FLAG_C)
+
+
+class Cpu8080(object):
+    """Instruction-level 8080 model.
+    The memory is a bytearray whose size is a power of 2, mirrored over the
+    address map. IO accesses are passed to optional callbacks:
+      io_read(port) -> byte
+      io_write(port, byte)
+    An IO read with no callback returns 00h, an IO write is ignored.
+    """
+
+    def __init__(self, memory, io_read=None, io_write=None):
+        self.memory = memory
+        self.mem_mask = len(memory) - 1
+        self.io_read = io_read
+        self.io_write = io_write
+        self.reg = [0] * 8
+        self.reset()
+        self.ops = self._build_dispatch_table()
+
+    def reset(self):
+        """Reset the CPU: PC is 0, interrupts are disabled."""
+        self.reg[:] = [0] * 8
+        self.reg[F] = FLAG_CONST
+        self.pc = 0
+        self.sp = 0
+        self.inte = False
+        self.halted = False
+        self.stopped = False
+        self.instructions = 0
+
+    def register(self, name):
+        """Value of register by name: 'b'..'a', 'f', 'pc' or 'sp'."""
+        if name == 'pc': return self.pc
+        if name == 'sp': return self.sp
+        return self.reg[REGISTER_NAMES.index(name)]
+
+    def step(self):
+        """Execute one instruction, return the address it was fetched from."""
+        pc = self.pc
+        self.pc = (pc + 1) & 0xffff
+        self.ops[self.memory[pc & self.mem_mask]]()
+        self.instructions += 1
+        return pc
+
+    def run(self, max_instructions=MAX_INSTRUCTIONS, trace=None):
+        """Run until the CPU halts, stop() is called or max_instructions are
+        executed. Fetch addresses are passed to trace(address) if given.
+        Return the number of instructions executed.
+        """
+        # This is the emulator's inner loop; keep everything in locals.
+        mem = self.memory
+        mask = self.mem_mask
+        ops = self.ops
+        count = 0
+        self.stopped = False
+        while count < max_instructions:
+            pc = self.pc
+            self.pc = (pc + 1) & 0xffff
+            ops[mem[pc & mask]]()
+            count += 1
+            if trace: trace(pc)
+            if self.halted or self.stopped:
+                break
+        self.instructions += count
+        return count
+
+    def stop(self):
+        """Stop run() after the current instruction. Meant for IO callbacks."""
+        self.stopped = True
+
+    def _build_dispatch_table(self):
+        """Return list of 256 opcode handlers, closures over the CPU state."""
+
+        cpu = self
+        r = self.reg
+        mem = self.memory
+        mask = self.mem_mask
+
+        # Memory and operand access helpers ------------------------------------
+
+        def imm8():
+            pc = cpu.pc
+            cpu.pc = (pc + 1) & 0xffff
+            return mem[pc & mask]
+
+        def imm16():
+            pc = cpu.pc
+            cpu.pc = (pc + 2) & 0xffff
+            return mem[pc & mask] | (mem[(pc + 1) & mask] << 8)
+
+        def rd16(address):
+            return mem[address & mask] | (mem[(address + 1) & mask] << 8)
+
+        def wr16(address, value):
+            mem[address & mask] = value & 0xff
+            mem[(address + 1) & mask] = value >> 8
+
+        def push(value):
+            sp = (cpu.sp - 2) & 0xffff
+            cpu.sp = sp
+            mem[(sp + 1) & mask] = value >> 8
+            mem[sp & mask] = value & 0xff
+
+        def pop():
+            sp = cpu.sp
+            cpu.sp = (sp + 2) & 0xffff
+            return mem[sp & mask] | (mem[(sp + 1) & mask] << 8)
+
+        # Register pairs by 8080 code; pair 3 is SP or PSW.
+        def get_pair(p):
+            if p == 3:
+                return lambda: cpu.sp
+            hi = 2 * p
+            return lambda: (r[hi] << 8) | r[hi + 1]
+
+        def set_pair(p):
+            if p == 3:
+                def set_sp(v): cpu.sp = v & 0xffff
+                return set_sp
+            hi = 2 * p
+            def set_rr(v):
+                r[hi] = (v >> 8) & 0xff
+                r[hi + 1] = v & 0xff
+            return set_rr
+
+        # ALU operations on A ----------------------------------------------------
+
+        def add(v):
+            a = r[A]
+            res = a + v
+            r[F] = SZP[res & 0xff] | (res >> 8) | ((a ^ v ^ res) & FLAG_AC)
+            r[A] = res & 0xff
+
+        def adc(v):
+            a = r[A]
+            res = a + v + (r[F] & FLAG_C)
+            r[F] = SZP[res & 0xff] | (res >> 8) | ((a ^ v ^ res) & FLAG_AC)
+            r[A] = res & 0xff
+
+        def sub(v):
+            a = r[A]
+            res = a - v
+            r[F] = (SZP[res & 0xff] | ((res >> 8) & FLAG_C) |
+                    ((a ^ ~v ^ res) & FLAG_AC))
+            r[A] = res & 0xff
+
+        def sbb(v):
+            a = r[A]
+            res = a - v - (r[F] & FLAG_C)
+            r[F] = (SZP[res & 0xff] | ((res >> 8) & FLAG_C) |
+                    ((a ^ ~v ^ res) & FLAG_AC))
+            r[A] = res & 0xff
+
+        def ana(v):
+            a = r[A]
+            res = a & v
+            r[F] = SZP[res] | (((a | v) & 0x08) << 1)
+            r[A] = res
+
+        def xra(v):
+            res = r[A] ^ v
+            r[F] = SZP[res]
+            r[A] = res
+
+        def ora(v):
+            res = r[A] | v
+            r[F] = SZP[res]
+            r[A] = res
+
+        def cmp(v):
+            a = r[A]
+            res = a - v
+            r[F] = (SZP[res & 0xff] | ((res >> 8) & FLAG_C) |
+                    ((a ^ ~v ^ res) & FLAG_AC))
+
+        ALU = [add, adc, sub, sbb, ana, xra, ora, cmp]
+
+        # Conditions by 8080 code: NZ, Z, NC, C, PO, PE, P, M.
+        def condition(c):
+            flag = [FLAG_Z, FLAG_C, FLAG_P, FLAG_S][c >> 1]
+            if c & 1:
+                return lambda: r[F] & flag
+            return lambda: not (r[F] & flag)
+
+        # Opcode handler factories -----------------------------------------------
+        # Each factory returns the handler for one opcode.
+
+        def op_nop():
+            pass
+
+        def op_mov(d, s):
+            if s == REG_M:
+                def mov_r_m(): r[d] = mem[((r[H] << 8) | r[L]) & mask]
+                return mov_r_m
+            if d == REG_M:
+                def mov_m_r(): mem[((r[H] << 8) | r[L]) & mask] = r[s]
+                return mov_m_r
+            def mov_r_r(): r[d] = r[s]
+            return mov_r_r
+
+        def op_mvi(d):
+            if d == REG_M:
+                def mvi_m():
+                    v = imm8()
+                    mem[((r[H] << 8) | r[L]) & mask] = v
+                return mvi_m
+            def mvi_r(): r[d] = imm8()
+            return mvi_r
+
+        def op_inr(d):
+            if d == REG_M:
+                def inr_m():
+                    address = ((r[H] << 8) | r[L]) & mask
+                    v = (mem[address] + 1) & 0xff
+                    mem[address] = v
+                    r[F] = (r[F] & FLAG_C) | SZP_INR[v]
+                return inr_m
+            def inr_r():
+                v = (r[d] + 1) & 0xff
+                r[d] = v
+                r[F] = (r[F] & FLAG_C) | SZP_INR[v]
+            return inr_r
+
+        def op_dcr(d):
+            if d == REG_M:
+                def dcr_m():
+                    address = ((r[H] << 8) | r[L]) & mask
+                    v = (mem[address] - 1) & 0xff
+                    mem[address] = v
+                    r[F] = (r[F] & FLAG_C) | SZP_DCR[v]
+                return dcr_m
+            def dcr_r():
+                v = (r[d] - 1) & 0xff
+                r[d] = v
+                r[F] = (r[F] & FLAG_C) | SZP_DCR[v]
+            return dcr_r
+
+        def op_alu(fn, s):
+            if s == REG_M:
+                return lambda: fn(mem[((r[H] << 8) | r[L]) & mask])
+            return lambda: fn(r[s])
+
+        def op_alu_imm(fn):
+            return lambda: fn(imm8())
+
+        def op_lxi(p):
+            set_rp = set_pair(p)
+            return lambda: set_rp(imm16())
+
+        def op_inx(p, delta):
+            get_rp = get_pair(p)
+            set_rp = set_pair(p)
+            return lambda: set_rp(get_rp() + delta)
+
+        def op_dad(p):
+            get_rp = get_pair(p)
+            def dad():
+                res = ((r[H] << 8) | r[L]) + get_rp()
+                r[H] = (res >> 8) & 0xff
+                r[L] = res & 0xff
+                r[F] = (r[F] & ~FLAG_C) | (res >> 16)
+            return dad
+
+        def op_stax(p):
+            get_rp = get_pair(p)
+            def stax(): mem[get_rp() & mask] = r[A]
+            return stax
+
+        def op_ldax(p):
+            get_rp = get_pair(p)
+            def ldax(): r[A] = mem[get_rp() & mask]
+            return ldax
+
+        def op_push(p):
+            if p == 3:
+                return lambda: push((r[A] << 8) | r[F])
+            get_rp = get_pair(p)
+            return lambda: push(get_rp())
+
+        def op_pop(p):
+            if p == 3:
+                def pop_psw():
+                    v = pop()
+                    r[A] = v >> 8
+                    r[F] = (v & FLAG_MASK) | FLAG_CONST
+                return pop_psw
+            set_rp = set_pair(p)
+            return lambda: set_rp(pop())
+
+        def op_jmp(cond=None):
+            if cond is None:
+                def jmp(): cpu.pc = imm16()
+                return jmp
+            def jcc():
+                target = imm16()
+                if cond(): cpu.pc = target
+            return jcc
+
+        def op_call(cond=None):
+            if cond is None:
+                def call():
+                    target = imm16()
+                    push(cpu.pc)
+                    cpu.pc = target
+                return call
+            def ccc():
+                target = imm16()
+                if cond():
+                    push(cpu.pc)
+                    cpu.pc = target
+            return ccc
+
+        def op_ret(cond=None):
+            if cond is None:
+                def ret(): cpu.pc = pop()
+                return ret
+            def rcc():
+                if cond(): cpu.pc = pop()
+            return rcc
+
+        def op_rst(n):
+            def rst():
+                push(cpu.pc)
+                cpu.pc = n << 3
+            return rst
+
+        # Single instructions ------------------------------------------------------
+
+        def rlc():
+            a = r[A]
+            c = a >> 7
+            r[A] = ((a << 1) | c) & 0xff
+            r[F] = (r[F] & ~FLAG_C) | c
+
+        def rrc():
+            a = r[A]
+            c = a & 1
+            r[A] = (a >> 1) | (c << 7)
+            r[F] = (r[F] & ~FLAG_C) | c
+
+        def ral():
+            a = r[A]
+            r[A] = ((a << 1) | (r[F] & FLAG_C)) & 0xff
+            r[F] = (r[F] & ~FLAG_C) | (a >> 7)
+
+        def rar():
+            a = r[A]
+            r[A] = (a >> 1) | ((r[F] & FLAG_C) << 7)
+            r[F] = (r[F] & ~FLAG_C) | (a & 1)
+
+        def daa():
+            v = DAA[((r[F] & (FLAG_AC | FLAG_C)) << 8) | r[A]]
+            r[A] = v >> 8
+            r[F] = v & 0xff
+
+        def cma(): r[A] ^= 0xff
+        def stc(): r[F] |= FLAG_C
+        def cmc(): r[F] ^= FLAG_C
+
+        def shld(): wr16(imm16(), (r[H] << 8) | r[L])
+        def lhld():
+            v = rd16(imm16())
+            r[H] = v >> 8
+            r[L] = v & 0xff
+        def sta(): mem[imm16() & mask] = r[A]
+        def lda(): r[A] = mem[imm16() & mask]
+
+        def xchg():
+            r[H], r[D] = r[D], r[H]
+            r[L], r[E] = r[E], r[L]
+
+        def xthl():
+            v = rd16(cpu.sp)
+            wr16(cpu.sp, (r[H] << 8) | r[L])
+            r[H] = v >> 8
+            r[L] = v & 0xff
+
+        def sphl(): cpu.sp = (r[H] << 8) | r[L]
+        def pchl(): cpu.pc = (r[H] << 8) | r[L]
+
+        def hlt():
+            cpu.halted = True
+
+        def ei(): cpu.inte = True
+        def di(): cpu.inte = False
+
+        def out():
+            port = imm8()
+            if cpu.io_write: cpu.io_write(port, r[A])
+
+        def inp():
+            port = imm8()
+            r[A] = cpu.io_read(port) if cpu.io_read else 0
+
+        # The table ------------------------------------------------------------------
+
+        ops = [op_nop] * 256
+        for op in range(0x40, 0x80):
+            ops[op] = op_mov((op >> 3) & 7, op & 7)
+        ops[0x76] = hlt
+        for op in range(0x80, 0xc0):
+            ops[op] = op_alu(ALU[(op >> 3) & 7], op & 7)
+        for n in range(8):
+            ops[0x06 | (n << 3)] = op_mvi(n)
+            ops[0x04 | (n << 3)] = op_inr(n)
+            ops[0x05 | (n << 3)] = op_dcr(n)
+            ops[0xc6 | (n << 3)] = op_alu_imm(ALU[n])
+            ops[0xc2 | (n << 3)] = op_jmp(condition(n))
+            ops[0xc4 | (n << 3)] = op_call(condition(n))
+            ops[0xc0 | (n << 3)] = op_ret(condition(n))
+            ops[0xc7 | (n << 3)] = op_rst(n)
+        for p in range(4):
+            ops[0x01 | (p << 4)] = op_lxi(p)
+            ops[0x03 | (p << 4)] = op_inx(p, 1)
+            ops[0x0b | (p << 4)] = op_inx(p, -1)
+            ops[0x09 | (p << 4)] = op_dad(p)
+            ops[0xc5 | (p << 4)] = op_push(p)
+            ops[0xc1 | (p << 4)] = op_pop(p)
+        for p in range(2):
+            ops[0x02 | (p << 4)] = op_stax(p)
+            ops[0x0a | (p << 4)] = op_ldax(p)
+        ops[0x07] = rlc
+        ops[0x0f] = rrc
+        ops[0x17] = ral
+        ops[0x1f] = rar
+        ops[0x22] = shld
+        ops[0x27] = daa
+        ops[0x2a] = lhld
+        ops[0x2f] = cma
+        ops[0x32] = sta
+        ops[0x37] = stc
+        ops[0x3a] = lda
+        ops[0x3f] = cmc
+        ops[0xc3] = op_jmp()
+        ops[0xc9] = op_ret()
+        ops[0xcd] = op_call()
+        ops[0xd3] = out
+        ops[0xdb] = inp
+        ops[0xe3] = xthl
+        ops[0xe9] = pchl
+        ops[0xeb] = xchg
+        ops[0xf3] = di
+        ops[0xf9] = sphl
+        ops[0xfb] = ei
+        for op in UNDEFINED_OPCODES:
+            ops[op] = op_nop
+        return ops
+
+
+def _parse_cmdline():
+    parser = optparse.OptionParser(usage='%prog [options] <hex file>')
+    parser.add_option("-t", dest="trace", default=None,
+                    help="write fetch trace to FILE.", metavar="FILE")
+    parser.add_option("-c", dest="console", default=None,
+                    help="write console output to FILE.", metavar="FILE")
+    parser.add_option("-n", dest="max_instructions", type="int",
+                    default=MAX_INSTRUCTIONS,
+                    help="stop after COUNT instructions.", metavar="COUNT")
+    parser.add_option("--ram-size", dest="ram_size", type="int",
+                    default=0x10000,
+                    help="RAM size in bytes, a power of 2.", metavar="BYTES")
+    parser.add_option("-q", dest="quiet", action="store_true", default=False,
+                    help="don't echo console output or print summary.")
+
+    (opts, args) = parser.parse_args()
+    if len(args) < 1:
+        print >> sys.stderr, "error: missing object code file name"
+        parser.print_help()
+        sys.exit(1)
+    size = opts.ram_size
+    if size <= 0 or size > 0x10000 or size & (size - 1):
+        print >> sys.stderr, "error: RAM size must be a power of 2 up to 64KB"
+        sys.exit(1)
+    return (opts, args)
+
+
+def _main():
+    (opts, args) = _parse_cmdline()
+
+    try:
+        memory = load_memory(args[0], opts.ram_size)
+    except (build_rom.BuildRomError, EnvironmentError) as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(1)
+
+    con_file = open(opts.console, "w") if opts.console else None
+    console = Console(echo=not opts.quiet, log=con_file)
+    cpu = Cpu8080(memory, console.io_read, console.io_write)
+    console.target = cpu
+
+    if opts.trace:
+        # Trace in chunks; formatting each address as it is fetched would
+        # make the trace the bottleneck.
+        trace_file = open(opts.trace, "w")
+        left = opts.max_instructions
+        while left > 0:
+            chunk = []
+            left -= cpu.run(min(left, 0x10000), chunk.append)
+            trace_file.write("".join(["%04X: \n" % a for a in chunk]))
+            if cpu.halted or cpu.stopped or not chunk:
+                break
+        trace_file.close()
+    else:
+        cpu.run(opts.max_instructions)
+    console.flush()
+    if con_file: con_file.close()
+
+    if not opts.quiet:
+        if console.eot:
+            print "Execution terminated by SW -- EOT written to UART_DATA."
+        elif cpu.halted:
+            print "CPU halted at PC=%04Xh." % cpu.pc
+        else:
+            print "Emulation stopped after %d instructions." % cpu.instructions
+        print "%d instructions." % cpu.instructions
+
+
+if __name__ == "__main__":
+    _main()
+    sys.exit(0)
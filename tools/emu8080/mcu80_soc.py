@@ -0,0 +1,73 @@
+################################################################################
+# mcu80_soc.py : mcu80 SoC peripherals shared by the CPU models
+################################################################################
+# The UART console and the RAM loader of the mcu80 TB, as used by emu8080.py
+# and ../uasm/ucode_sim.py. Depends on build_rom only; it must not import any
+# CPU model, so that the models checked against each other don't share code
+# beyond the SoC they run in.
+################################################################################
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "build_rom", "src"))
+import build_rom
+
+
+# mcu80 IO ports.
+UART_DATA = 0x80
+UART_STATUS = 0x81
+UART_EOT = 0x04
+# UART status: TX ready, no RX data.
+UART_STATUS_IDLE = 0x01
+
+
+class Console(object):
+    """mcu80 UART as seen by the TB console monitor: line buffered TX, EOT
+    terminates the run, CR is ignored. The UART is always ready.
+    EOT calls target.stop(); the target is any model with a stop() method.
+    """
+
+    def __init__(self, target=None, echo=True, log=None):
+        self.target = target
+        self.echo = echo
+        self.log = log
+        self.line = ""
+        self.eot = False
+
+    def io_read(self, port):
+        if port == UART_STATUS: return UART_STATUS_IDLE
+        return 0
+
+    def io_write(self, port, value):
+        if port != UART_DATA: return
+        if value == 0x0a:
+            self._print(self.line)
+            self.line = ""
+        elif value == 0x0d:
+            pass
+        elif value == UART_EOT:
+            self.eot = True
+            if self.target: self.target.stop()
+        else:
+            self.line += chr(value)
+
+    def flush(self):
+        """Print the pending partial line, if any."""
+        if self.line: self._print(self.line)
+        self.line = ""
+
+    def _print(self, line):
+        if self.echo: print line
+        if self.log: print >> self.log, line
+
+
+def load_memory(hex_filename, ram_size=0x10000):
+    """Read Intel HEX file into a RAM image of ram_size bytes, wrapping around
+    as the mcu80 RAM does."""
+    image = build_rom.read_ihex_file(hex_filename)
+    memory = bytearray(ram_size)
+    for address in range(image.bottom, image.top):
+        memory[address & (ram_size - 1)] = image.data[address]
+    return memory
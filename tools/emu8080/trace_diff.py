@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+################################################################################
+# trace_diff.py : find first divergence between two CPU fetch traces
+################################################################################
+# Usage: trace_diff.py [options] <trace A> <trace B>
+#
+# Compares two fetch traces in the format written by the mcu80 TB
+# (hw_sim_log.txt), emu8080.py or ucode_sim.py -- one 'XXXX: ' line per
+# instruction fetch, plain or gzipped, or '-' for stdin -- or in the binary
+# format of trace_bin.py, and reports the first fetch where they differ along
+# with the fetches that led to it. The traces are streamed, they can be of any
+# size.
+#
+# Options:
+#
+# -C COUNT    : Show COUNT common fetches before the divergence. Default 16.
+# -h, --help  : Show help, quit.
+#
+# Exit status is 0 if the traces are identical, 1 if they differ and 2 if
+# either can't be read.
+#
+################################################################################
+
+import sys
+import os
+import optparse
+import collections
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "trace"))
+from trace_bin import read_trace, TraceFormatError
+
+
+def first_divergence(trace_a, trace_b, context=16):
+    """Compare two sequences of fetch addresses.
+    Return None if they are identical, or a tuple (index, address A, address B,
+    previous) where index is the 0-based index of the first differing fetch,
+    either address is None if that trace ended early, and previous is the list
+    of up to context addresses common to both traces before the divergence.
+    """
+    previous = collections.deque(maxlen=context)
+    for (index, (a, b)) in enumerate(itertools.izip_longest(trace_a, trace_b)):
+        if a != b:
+            return (index, a, b, list(previous))
+        previous.append(a)
+    return None
+
+
+def _format_address(address):
+    return "(end of trace)" if address is None else "%04X" % address
+
+
+def _parse_cmdline():
+    parser = optparse.OptionParser(usage='%prog [options] <trace A> <trace B>')
+    parser.add_option("-C", dest="context", type="int", default=16,
+                    help="show COUNT fetches before divergence.", metavar="COUNT")
+    (opts, args) = parser.parse_args()
+    if len(args) < 2:
+        print >> sys.stderr, "error: missing trace file name(s)"
+        parser.print_help()
+        sys.exit(2)
+    return (opts, args)
+
+
+def _main():
+    (opts, args) = _parse_cmdline()
+
+    try:
+        diff = first_divergence(read_trace(args[0]), read_trace(args[1]),
+                                opts.context)
+    except (TraceFormatError, EnvironmentError) as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(2)
+
+    if diff is None:
+        print "Traces are identical."
+        sys.exit(0)
+
+    (index, a, b, previous) = diff
+    print "Traces diverge at fetch #%d:" % (index + 1)
+    for (n, address) in enumerate(previous):
+        print "  #%-10d %04X" % (index - len(previous) + n + 1, address)
+    print "  #%-10d %s <-- %s" % (index + 1, _format_address(a), args[0])
+    print "  %-11s %s <-- %s" % ("", _format_address(b), args[1])
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    _main()
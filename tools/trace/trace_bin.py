@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+################################################################################
+# trace_bin.py : compact binary CPU fetch traces with random access
+################################################################################
+# Usage: trace_bin.py convert [options] <text trace> <binary trace>
+#        trace_bin.py dump [-s START] [-n COUNT] <binary trace>
+#        trace_bin.py find [-s START] <binary trace> <hex address>
+#        trace_bin.py info <binary trace>
+#
+# convert : Convert a fetch trace in the mon_cpu_trace text format (one
+#           'XXXX: ' line per fetch, as in hw_sim_log.txt) to binary.
+#           With --follow the text trace is converted while the simulator is
+#           still writing it, until the simulator process (--pid) exits or
+#           the trace stops growing for --idle seconds. The text trace can be
+#           a named pipe too, created with mkfifo before running the TB.
+# dump    : Write fetches START to START+COUNT-1 in the text format.
+# find    : Print the index of the first fetch from address at or after START.
+# info    : Print number of fetches, index interval and compression ratio.
+#
+# Fetches are numbered from 0.
+#
+################################################################################
+# Binary trace file format (all integers little endian):
+#
+# Header      : 'L8TRACE' 0x02 (format version 2), u32 index interval N,
+#               u32 reserved.
+# Blocks      : One block per N fetches. A block starts with the absolute
+#               address of its first fetch as u16; each of the rest of the
+#               fetches is the difference from the previous fetch address as
+#               a signed 16-bit value, zigzag and varint (LEB128) encoded.
+#               Sequential code takes 1 byte per fetch.
+# Index       : u64 file offset of every block.
+# First hits  : One entry per address fetched from, sorted by address: u16
+#               address, u64 index of the first fetch from it.
+# Trailer     : u64 index offset, u64 number of fetches, u64 number of blocks,
+#               u64 number of first hits, 'L8TEND' 0x00 0x00.
+#
+# The footer (index, first hits and trailer) is written when the conversion
+# is done; a file without it is incomplete and can't be read. It takes 8 bytes
+# per block and 10 per address fetched from, so a short run's trace is not
+# padded out by addresses it never reached.
+################################################################################
+
+import sys
+import os
+import mmap
+import time
+import gzip
+import struct
+import errno
+import argparse
+
+
+MAGIC = b"L8TRACE\x02"
+END_MAGIC = b"L8TEND\x00\x00"
+HEADER = struct.Struct("<8sII")
+HIT = struct.Struct("<HQ")
+TRAILER = struct.Struct("<QQQQ8s")
+NO_HIT = 0xffffffffffffffff
+
+# Default number of fetches per indexed block.
+DEFAULT_INTERVAL = 4096
+
+
+def _encode_delta(delta):
+    """Zigzag + varint encoding of 16-bit address difference."""
+    if delta & 0x8000: delta -= 0x10000
+    zz = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+    out = bytearray()
+    while zz >= 0x80:
+        out.append((zz & 0x7f) | 0x80)
+        zz >>= 7
+    out.append(zz)
+    return bytes(out)
+
+# Encoded delta by (address - previous address) & 0xffff.
+DELTA_CODES = [_encode_delta(d) for d in range(0x10000)]
+
+
+class TraceFormatError(Exception):
+    pass
+
+
+class TraceWriter(object):
+    """Write fetch addresses to a binary trace file object opened for binary
+    writing. Call close() when done; the file is not readable until then.
+    """
+
+    def __init__(self, fo, interval=DEFAULT_INTERVAL):
+        if interval < 1:
+            raise ValueError("index interval must be at least 1")
+        self.fo = fo
+        self.interval = interval
+        self.count = 0
+        self.offsets = []
+        self.first_hits = [NO_HIT] * 0x10000
+        self._prev = 0
+        self._pending = []
+        self._offset = HEADER.size
+        fo.write(HEADER.pack(MAGIC, interval, 0))
+
+    def write(self, address):
+        """Append one fetch address."""
+        self.write_many((address,))
+
+    def write_many(self, addresses):
+        """Append fetch addresses from iterable."""
+        # Conversion inner loop; keep everything in locals.
+        interval = self.interval
+        codes = DELTA_CODES
+        first_hits = self.first_hits
+        pending = self._pending
+        count = self.count
+        offset = self._offset
+        prev = self._prev
+        left = (interval - count % interval) % interval
+        for address in addresses:
+            address &= 0xffff
+            left -= 1
+            if left < 0:
+                left = interval - 1
+                self.offsets.append(offset)
+                code = struct.pack("<H", address)
+            else:
+                code = codes[(address - prev) & 0xffff]
+            pending.append(code)
+            offset += len(code)
+            if first_hits[address] == NO_HIT:
+                first_hits[address] = count
+            prev = address
+            count += 1
+            if len(pending) >= 0x10000:
+                self.fo.write(b"".join(pending))
+                del pending[:]
+        self.count = count
+        self._offset = offset
+        self._prev = prev
+
+    def close(self):
+        """Write the footer. Does not close the file object."""
+        self._flush()
+        index_offset = self._offset
+        self.fo.write(struct.pack("<%dQ" % len(self.offsets), *self.offsets))
+        hits = [HIT.pack(a, k) for (a, k) in enumerate(self.first_hits)
+                if k != NO_HIT]
+        self.fo.write(b"".join(hits))
+        self.fo.write(TRAILER.pack(index_offset, self.count, len(self.offsets),
+                                   len(hits), END_MAGIC))
+        self.fo.flush()
+
+    def _flush(self):
+        if self._pending:
+            self.fo.write(b"".join(self._pending))
+            del self._pending[:]
+
+
+class TraceReader(object):
+    """Random access reader of a binary trace file, memory mapped.
+    len(reader) is the number of fetches; reader[k] is the address of fetch k.
+    reader.addresses is the number of different addresses fetched from.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size + TRAILER.size:
+                raise TraceFormatError("%s: not a binary trace" % filename)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.interval, reserved) = HEADER.unpack_from(self._map, 0)
+        if magic[:-1] != MAGIC[:-1]:
+            raise TraceFormatError("%s: not a binary trace" % filename)
+        if magic != MAGIC:
+            raise TraceFormatError("%s: unsupported binary trace version %d" %
+                                   (filename, ord(magic[-1])))
+        (index_offset, self.count, blocks, self.addresses, end) = \
+            TRAILER.unpack_from(self._map, size - TRAILER.size)
+        if end != END_MAGIC:
+            raise TraceFormatError("%s: incomplete binary trace" % filename)
+        self.size = size
+        self._index_offset = index_offset
+        self._blocks = blocks
+        self._hits_offset = index_offset + 8 * blocks
+
+    def close(self):
+        self._map.close()
+
+    def data_size(self):
+        """Size in bytes of the encoded fetches, without header and footer."""
+        return self._index_offset - HEADER.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, k):
+        if k < 0: k += self.count
+        if not 0 <= k < self.count:
+            raise IndexError("fetch index out of range")
+        for address in self.iter(k, k + 1):
+            return address
+
+    def __iter__(self):
+        return self.iter()
+
+    def first_hit(self, address):
+        """Index of first fetch from address, or None if never fetched.
+        Binary search of the first hits in the file."""
+        address &= 0xffff
+        (lo, hi) = (0, self.addresses)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (a, k) = HIT.unpack_from(self._map,
+                                     self._hits_offset + HIT.size * mid)
+            if a < address:
+                lo = mid + 1
+            elif a > address:
+                hi = mid
+            else:
+                return k
+        return None
+
+    def find(self, address, start=0):
+        """Index of first fetch from address at or after fetch start, or None.
+        Only the blocks after the first hit of the address are decoded.
+        """
+        first = self.first_hit(address)
+        if first is None: return None
+        if first >= start: return first
+        for (k, a) in enumerate(self.iter(start), start):
+            if a == address: return k
+        return None
+
+    def iter(self, start=0, stop=None):
+        """Yield addresses of fetches start to stop-1. Decoding begins at the
+        indexed block containing fetch start."""
+        if stop is None or stop > self.count: stop = self.count
+        block = start // self.interval
+        k = block * self.interval
+        while k < stop:
+            data = bytearray(self._map[self._block_offset(block):
+                                       self._block_offset(block + 1)])
+            address = data[0] | (data[1] << 8)
+            if k >= start: yield address
+            k += 1
+            zz = shift = 0
+            for b in data[2:]:
+                zz |= (b & 0x7f) << shift
+                if b & 0x80:
+                    shift += 7
+                    continue
+                address = (address + ((zz >> 1) ^ -(zz & 1))) & 0xffff
+                zz = shift = 0
+                if k >= stop: return
+                if k >= start: yield address
+                k += 1
+            block += 1
+
+    def _block_offset(self, block):
+        """File offset of block; of the index for the block past the last."""
+        if block >= self._blocks: return self._index_offset
+        (offset,) = struct.unpack_from("<Q", self._map,
+                                       self._index_offset + 8 * block)
+        return offset
+
+
+def is_binary_trace(filename):
+    """True if filename is a binary trace file, of any format version. Pipes
+    are never binary traces; peeking into them would lose data."""
+    if not os.path.isfile(filename):
+        return False
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(MAGIC) - 1) == MAGIC[:-1]
+    except EnvironmentError:
+        return False
+
+
+def read_text_trace(f, follow=False, idle=None, pid=None):
+    """Yield fetch addresses from text trace file object f.
+    With follow, wait for more data at end of file until process pid exits
+    or no data arrives for idle seconds (if given).
+    Lines repeat a lot; they are parsed once and looked up after that.
+    """
+    parsed = {}
+    partial = ""
+    waited = 0.0
+    lineno = 0
+    while True:
+        line = f.readline()
+        if not line:
+            if follow and pid is not None and not _process_alive(pid):
+                follow = False
+            elif follow and (idle is None or waited < idle):
+                time.sleep(0.1)
+                waited += 0.1
+                continue
+            if not partial: break
+            (line, partial) = (partial, "")
+        elif not line.endswith("\n") and follow:
+            # The writer is in the middle of a line.
+            partial += line
+            continue
+        else:
+            (line, partial) = (partial + line, "")
+        waited = 0.0
+        lineno += 1
+        try:
+            address = parsed[line]
+        except KeyError:
+            address = _parse_line(line, lineno)
+            parsed[line] = address
+        if address is not None:
+            yield address
+
+
+def _parse_line(line, lineno):
+    """Fetch address in text trace line, None for blank lines."""
+    field = line.split(":", 1)[0].strip()
+    if not field and not line.strip():
+        return None
+    try:
+        return int(field, 16) & 0xffff
+    except ValueError:
+        raise TraceFormatError("line %d: malformed trace line '%s'" %
+                               (lineno, line.rstrip()))
+
+
+def read_trace(filename, follow=False, idle=None, pid=None):
+    """Yield fetch addresses from binary or text trace file; text traces
+    can be gzipped (.gz) or read from stdin ('-')."""
+    if filename != "-" and is_binary_trace(filename):
+        reader = TraceReader(filename)
+        for address in reader:
+            yield address
+        reader.close()
+        return
+    if filename == "-":
+        f = sys.stdin
+    elif filename.endswith(".gz"):
+        f = gzip.open(filename, "r")
+    else:
+        f = open(filename, "r")
+    try:
+        for address in read_text_trace(f, follow, idle, pid):
+            yield address
+    except TraceFormatError as e:
+        raise TraceFormatError("%s: %s" % (filename, e))
+    finally:
+        if f is not sys.stdin: f.close()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def convert(text_filename, bin_filename, interval=DEFAULT_INTERVAL,
+            follow=False, idle=None, pid=None):
+    """Convert text trace to binary trace; return number of fetches."""
+    with open(bin_filename, "wb") as fo:
+        writer = TraceWriter(fo, interval)
+        writer.write_many(read_trace(text_filename, follow, idle, pid))
+        writer.close()
+    return writer.count
+
+
+def _cmd_convert(opts):
+    count = convert(opts.text, opts.binary, opts.interval, opts.follow,
+                    opts.idle, opts.pid)
+    if not opts.quiet:
+        reader = TraceReader(opts.binary)
+        data_size = reader.data_size()
+        print "%d fetches, %d bytes of data (%.2f bits per fetch), %d bytes" \
+              " of index" % (count, data_size, 8.0 * data_size / max(count, 1),
+                             reader.size - HEADER.size - data_size)
+
+
+def _cmd_dump(opts):
+    reader = TraceReader(opts.binary)
+    stop = None if opts.count is None else opts.start + opts.count
+    lines = []
+    for address in reader.iter(opts.start, stop):
+        lines.append("%04X: \n" % address)
+        if len(lines) >= 0x10000:
+            sys.stdout.write("".join(lines))
+            lines = []
+    sys.stdout.write("".join(lines))
+
+
+def _cmd_find(opts):
+    reader = TraceReader(opts.binary)
+    k = reader.find(int(opts.address, 16), opts.start)
+    if k is None:
+        print "Address %04X not fetched from." % int(opts.address, 16)
+        sys.exit(1)
+    print k
+
+
+def _cmd_info(opts):
+    reader = TraceReader(opts.binary)
+    print "Fetches:         %d" % len(reader)
+    print "Index interval:  %d" % reader.interval
+    print "File size:       %d" % reader.size
+    print "Data size:       %d" % reader.data_size()
+    print "Text trace size: %d" % (7 * len(reader))
+    print "Addresses:       %d" % reader.addresses
+
+
+def _positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return value
+
+
+def _parse_cmdline():
+    parser = argparse.ArgumentParser(
+        description="Compact binary CPU fetch traces with random access.")
+    sub = parser.add_subparsers()
+
+    p = sub.add_parser("convert", help="convert text trace to binary trace")
+    p.add_argument("text", help="text trace file, '-' for stdin")
+    p.add_argument("binary", help="binary trace file")
+    p.add_argument("-i", "--interval", type=_positive_int,
+                   default=DEFAULT_INTERVAL,
+                   help="fetches per indexed block (default: %(default)s)")
+    p.add_argument("-f", "--follow", action="store_true",
+                   help="keep converting as the text trace grows")
+    p.add_argument("--idle", type=float, default=None,
+                   help="with --follow, stop after SECONDS without new data",
+                   metavar="SECONDS")
+    p.add_argument("--pid", type=int, default=None,
+                   help="with --follow, stop when process PID exits")
+    p.add_argument("-q", "--quiet", action="store_true",
+                   help="don't print conversion summary")
+    p.set_defaults(func=_cmd_convert)
+
+    p = sub.add_parser("dump", help="write binary trace as text")
+    p.add_argument("binary", help="binary trace file")
+    p.add_argument("-s", "--start", type=int, default=0,
+                   help="first fetch to dump (default: 0)")
+    p.add_argument("-n", "--count", type=int, default=None,
+                   help="number of fetches to dump (default: all)")
+    p.set_defaults(func=_cmd_dump)
+
+    p = sub.add_parser("find", help="find first fetch from an address")
+    p.add_argument("binary", help="binary trace file")
+    p.add_argument("address", help="fetch address, hex")
+    p.add_argument("-s", "--start", type=int, default=0,
+                   help="first fetch to search from (default: 0)")
+    p.set_defaults(func=_cmd_find)
+
+    p = sub.add_parser("info", help="print binary trace summary")
+    p.add_argument("binary", help="binary trace file")
+    p.set_defaults(func=_cmd_info)
+
+    return parser.parse_args()
+
+
+def _main():
+    opts = _parse_cmdline()
+    try:
+        opts.func(opts)
+    except TraceFormatError as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(1)
+    except EnvironmentError as e:
+        if e.errno == errno.EPIPE: sys.exit(0)
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    _main()
+    sys.exit(0)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+################################################################################
+# trace_prof.py : execution profiler for CPU fetch traces
+################################################################################
+# Usage: trace_prof.py [options] <trace file>
+#
+# Reads a fetch trace as written by the mcu80 TB (hw_sim_log.txt), ucode_sim.py
+# or emu8080.py -- one 'XXXX: ' line per instruction fetch -- and writes a
+# profile: flat per-function profile, approximate call graph and hottest
+# addresses. The trace is streamed in constant memory; it can be gzipped
+# (.gz), read from stdin ('-') or a binary trace made by trace_bin.py.
+#
+# Options:
+#
+# -l FILE     : ASL listing file of the SW. Supplies labels and code bytes.
+#               Can be used more than once.
+# -m FILE     : ASL map file of the SW. Supplies labels. Can be used more than
+#               once.
+# -x FILE     : Intel HEX object code of the SW. Supplies code bytes.
+# -o FILE     : Write profile report to FILE instead of stdout.
+# -f FILE     : Write folded stacks to FILE, one 'f1;f2;f3 count' line per
+#               call stack, for flamegraph.pl and compatible tools.
+# -n COUNT    : Number of hot addresses in the report. Defaults to 20.
+# -h, --help  : Show help, quit.
+#
+################################################################################
+# Functions and call graph:
+#
+# With code bytes (from the listing or the HEX file) the profiler follows the
+# CALL, RST and RET instructions in the trace with a shadow call stack. A
+# function is the target of a taken call, named after the label at that
+# address; fetches are attributed to the function on top of the stack. This is
+# an approximation: stack tricks (PCHL, RET used as a jump, etc.) confuse it.
+#
+# Without code bytes the functions are the labels in the listing or map, and
+# every address belongs to the closest label before it. No call graph is
+# available then.
+################################################################################
+
+import sys
+import os
+import re
+import bisect
+import gzip
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "build_rom", "src"))
+import build_rom
+import trace_bin
+
+
+# Control transfer kind of the instruction at each address.
+KIND_NONE = 0
+KIND_CALL = 1                     # CALL, Ccc: 3 bytes
+KIND_RST = 2                      # RST: 1 byte
+KIND_RET = 3                      # RET, Rcc
+
+CALL_OPCODES = [0xcd] + [0xc4 | (n << 3) for n in range(8)]
+RST_OPCODES = [0xc7 | (n << 3) for n in range(8)]
+RET_OPCODES = [0xc9] + [0xc0 | (n << 3) for n in range(8)]
+
+# Deepest shadow call stack followed; deeper calls are counted in the caller.
+MAX_STACK_DEPTH = 256
+
+# Name of the stack frame in which the trace starts.
+ROOT_NAME = "[root]"
+
+# ASL listing line: 'lineno/ address : code bytes   source'. The line number
+# is missing in continuation lines of long data statements.
+LISTING_LINE_RE = re.compile(r"^\s*(?:\d+(?:\(\w+\))?/)?\s*([0-9A-Fa-f]+)\s*:"
+                             r" ?((?:[0-9A-Fa-f]{2}(?: |$))*)(?:\s+|$)(.*)$")
+LABEL_RE = re.compile(r"^\s*([A-Za-z_.?@$][\w.?@$]*):")
+# ASL listing symbol table entry of a CODE symbol: 'NAME : value C |'.
+LISTING_SYMBOL_RE = re.compile(r"\*?([A-Za-z_.?@$][\w.?@$]*)\s*:\s*([0-9A-Fa-f]+)\s+C\s*\|")
+# ASL map file symbol entry within a 'Symbols in Segment CODE' section.
+MAP_SYMBOL_RE = re.compile(r"([A-Za-z_.?@$][\w.?@$]*)\s+([0-9A-Fa-f]+)\b")
+
+
+class Program(object):
+    """What the profiler knows about the SW: labels and code bytes."""
+
+    def __init__(self):
+        self.labels = {}                # address -> label
+        self.code = None                # bytearray(64K) or None
+        self._sorted = []               # Sorted label addresses
+
+    def load_listing(self, filename):
+        """Get labels and code bytes from ASL listing file."""
+        symbols = {}
+        for line in _open(filename):
+            m = LISTING_LINE_RE.match(line)
+            if m:
+                address = int(m.group(1), 16)
+                data = m.group(2).split()
+                if address > 0xffff:
+                    continue
+                if data:
+                    if self.code is None: self.code = bytearray(0x10000)
+                    for (i, byte) in enumerate(data):
+                        self.code[(address + i) & 0xffff] = int(byte, 16)
+                label = LABEL_RE.match(m.group(3))
+                if label and address not in self.labels:
+                    self.labels[address] = label.group(1)
+            else:
+                for (name, value) in LISTING_SYMBOL_RE.findall(line):
+                    symbols.setdefault(int(value, 16) & 0xffff, name)
+        # Symbol table entries are upper case; prefer the source spelling.
+        for (address, name) in symbols.items():
+            self.labels.setdefault(address, name)
+
+    def load_map(self, filename):
+        """Get labels from the CODE segment symbols of an ASL map file."""
+        in_code = False
+        for line in _open(filename):
+            if line.startswith("Symbols in Segment"):
+                in_code = line.split()[-1].upper() == "CODE"
+            elif line.startswith("Segment"):
+                in_code = False
+            elif in_code:
+                for (name, value) in MAP_SYMBOL_RE.findall(line):
+                    self.labels.setdefault(int(value, 16) & 0xffff, name)
+
+    def load_hex(self, filename):
+        """Get code bytes from Intel HEX file."""
+        image = build_rom.read_ihex_file(filename)
+        if self.code is None: self.code = bytearray(0x10000)
+        for address in range(image.bottom, min(image.top, 0x10000)):
+            self.code[address] = image.data[address]
+
+    def kinds(self):
+        """Return table of control transfer kind by address, or None if the
+        code bytes are unknown."""
+        if self.code is None: return None
+        kind = [KIND_NONE] * 256
+        for op in CALL_OPCODES: kind[op] = KIND_CALL
+        for op in RST_OPCODES: kind[op] = KIND_RST
+        for op in RET_OPCODES: kind[op] = KIND_RET
+        return [kind[op] for op in self.code]
+
+    def name(self, address):
+        """Name of address: label, label+offset or plain hex address."""
+        if address in self.labels: return self.labels[address]
+        base = self._label_below(address)
+        if base is None: return "%04X" % address
+        return "%s+%X" % (self.labels[base], address - base)
+
+    def owner(self, address):
+        """Label of the closest labelled address at or below address."""
+        base = self._label_below(address)
+        return ROOT_NAME if base is None else self.labels[base]
+
+    def _label_below(self, address):
+        if len(self._sorted) != len(self.labels):
+            self._sorted = sorted(self.labels)
+        i = bisect.bisect_right(self._sorted, address)
+        return self._sorted[i - 1] if i else None
+
+
+class Profile(object):
+    """Execution counts collected from a trace."""
+
+    def __init__(self, program):
+        self.program = program
+        self.fetches = 0
+        self.address_counts = [0] * 0x10000
+        self.calls = {}                 # function -> times called
+        self.edges = {}                 # (caller, callee) -> times called
+        self.stacks = {}                # 'f1;f2;...' -> fetches
+        self.truncated_calls = 0        # calls beyond MAX_STACK_DEPTH
+
+    def collect(self, addresses):
+        """Process iterable of fetch addresses."""
+        kinds = self.program.kinds()
+        if kinds is None:
+            counts = self.address_counts
+            for a in addresses:
+                counts[a] += 1
+            self.fetches = sum(counts)
+            return
+        self._collect_calls(addresses, kinds)
+
+    def _collect_calls(self, addresses, kinds):
+        counts = self.address_counts
+        stacks = self.stacks
+        program = self.program
+        names = {}
+        # Shadow stack of (return address, stack string of caller).
+        frames = []
+        stack = None
+        run = 0
+        prev = None
+        prev_kind = KIND_NONE
+        for a in addresses:
+            if prev_kind:
+                if prev_kind == KIND_RET:
+                    if a != prev + 1 and frames:
+                        stacks[stack] = stacks.get(stack, 0) + run
+                        run = 0
+                        stack = self._return(frames, a)
+                else:
+                    ret = prev + (3 if prev_kind == KIND_CALL else 1)
+                    if a != ret:
+                        if len(frames) >= MAX_STACK_DEPTH:
+                            self.truncated_calls += 1
+                        else:
+                            stacks[stack] = stacks.get(stack, 0) + run
+                            run = 0
+                            callee = names.get(a)
+                            if callee is None:
+                                callee = names[a] = _frame_name(program.name(a))
+                            caller = stack.rsplit(";", 1)[-1]
+                            self.calls[callee] = self.calls.get(callee, 0) + 1
+                            edge = (caller, callee)
+                            self.edges[edge] = self.edges.get(edge, 0) + 1
+                            frames.append((ret & 0xffff, stack))
+                            stack = stack + ";" + callee
+            elif prev is None:
+                stack = _frame_name(program.name(a)) if a in program.labels else ROOT_NAME
+            counts[a] += 1
+            run += 1
+            prev = a
+            prev_kind = kinds[a]
+        if stack is not None:
+            stacks[stack] = stacks.get(stack, 0) + run
+        self.fetches = sum(counts)
+
+    def _return(self, frames, address):
+        """Pop shadow stack frames on a RET to address; return new stack.
+        If address is not the return address of the top frame, unwind to the
+        frame it belongs to, if any, else pop just the top frame.
+        """
+        for depth in range(len(frames) - 1, -1, -1):
+            if frames[depth][0] == address:
+                stack = frames[depth][1]
+                del frames[depth:]
+                return stack
+        return frames.pop()[1]
+
+    def functions(self):
+        """Return list of (self count, inclusive count, calls, function)."""
+        selfc = {}
+        incl = {}
+        if self.stacks:
+            for (stack, count) in self.stacks.items():
+                names = stack.split(";")
+                selfc[names[-1]] = selfc.get(names[-1], 0) + count
+                for name in set(names):
+                    incl[name] = incl.get(name, 0) + count
+        else:
+            for (address, count) in enumerate(self.address_counts):
+                if count:
+                    name = self.program.owner(address)
+                    selfc[name] = selfc.get(name, 0) + count
+            incl = selfc
+        return [(selfc.get(f, 0), incl[f], self.calls.get(f, 0), f) for f in incl]
+
+    def write_report(self, fo, trace_name, hot_count=20):
+        total = max(self.fetches, 1)
+        print >> fo, "Profile of trace %s: %d fetches" % (trace_name, self.fetches)
+        print >> fo
+        print >> fo, "Flat profile:"
+        print >> fo
+        print >> fo, "  self %        self  total %       total     calls  function"
+        for (selfc, incl, calls, name) in sorted(self.functions(), reverse=True):
+            print >> fo, "%7.2f %11d %8.2f %11d %9s  %s" % (
+                100.0 * selfc / total, selfc, 100.0 * incl / total, incl,
+                calls if self.stacks else "", name)
+        print >> fo
+
+        if self.stacks:
+            print >> fo, "Call graph (approximate, from taken CALL/RST and RET):"
+            print >> fo
+            callers = {}
+            callees = {}
+            for ((caller, callee), count) in self.edges.items():
+                callers.setdefault(callee, []).append((count, caller))
+                callees.setdefault(caller, []).append((count, callee))
+            for (selfc, incl, calls, name) in sorted(self.functions(),
+                                                     key=lambda f: -f[1]):
+                print >> fo, "%s: %d fetches inclusive, called %d times" % (
+                    name, incl, calls)
+                for (count, caller) in sorted(callers.get(name, []), reverse=True):
+                    print >> fo, "    called by %-24s %9d" % (caller, count)
+                for (count, callee) in sorted(callees.get(name, []), reverse=True):
+                    print >> fo, "    calls     %-24s %9d" % (callee, count)
+            if self.truncated_calls:
+                print >> fo
+                print >> fo, "%d calls beyond depth %d not followed." % (
+                    self.truncated_calls, MAX_STACK_DEPTH)
+            print >> fo
+
+        print >> fo, "Hot addresses:"
+        print >> fo
+        print >> fo, "  address       count       %  location"
+        hot = sorted([(c, a) for (a, c) in enumerate(self.address_counts) if c],
+                     reverse=True)[:hot_count]
+        for (count, address) in hot:
+            print >> fo, "     %04X %11d %7.2f  %s" % (
+                address, count, 100.0 * count / total, self.program.name(address))
+
+    def write_folded(self, fo):
+        for (stack, count) in sorted(self.stacks.items()):
+            if count: print >> fo, "%s %d" % (stack, count)
+
+
+def _frame_name(name):
+    """Make name usable as a folded stack frame."""
+    return name.replace(";", "_").replace(" ", "_")
+
+
+def _open(filename):
+    if filename == "-": return sys.stdin
+    if filename.endswith(".gz"): return gzip.open(filename, "r")
+    return open(filename, "r")
+
+
+def _parse_cmdline():
+    parser = optparse.OptionParser(usage='%prog [options] <trace file>')
+    parser.add_option("-l", dest="listings", action="append", default=[],
+                    help="ASL listing FILE.", metavar="FILE")
+    parser.add_option("-m", dest="maps", action="append", default=[],
+                    help="ASL map FILE.", metavar="FILE")
+    parser.add_option("-x", dest="hex", default=None,
+                    help="Intel HEX object code FILE.", metavar="FILE")
+    parser.add_option("-o", dest="output", default=None,
+                    help="write profile report to FILE.", metavar="FILE")
+    parser.add_option("-f", dest="folded", default=None,
+                    help="write folded stacks to FILE.", metavar="FILE")
+    parser.add_option("-n", dest="hot_count", type="int", default=20,
+                    help="number of hot addresses in report.", metavar="COUNT")
+    (opts, args) = parser.parse_args()
+    if len(args) < 1:
+        print >> sys.stderr, "error: missing trace file name"
+        parser.print_help()
+        sys.exit(1)
+    return (opts, args)
+
+
+def _main():
+    (opts, args) = _parse_cmdline()
+
+    try:
+        program = Program()
+        for filename in opts.listings: program.load_listing(filename)
+        for filename in opts.maps: program.load_map(filename)
+        if opts.hex: program.load_hex(opts.hex)
+
+        profile = Profile(program)
+        profile.collect(trace_bin.read_trace(args[0]))
+
+        if opts.output:
+            with open(opts.output, "w") as fo:
+                profile.write_report(fo, args[0], opts.hot_count)
+        else:
+            profile.write_report(sys.stdout, args[0], opts.hot_count)
+        if opts.folded:
+            if not profile.stacks:
+                print >> sys.stderr, "warning: no code bytes, folded stacks not available"
+            with open(opts.folded, "w") as fo:
+                profile.write_folded(fo)
+    except (trace_bin.TraceFormatError, build_rom.BuildRomError,
+            EnvironmentError) as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    _main()
+    sys.exit(0)
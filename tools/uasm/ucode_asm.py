@@ -7,8 +7,37 @@
 # Options:
 #
 # -l FILE     : Generate listing file. By default none is generated.
+# -O          : Optimize microcode: fold identical routine tails into shared 
+#               code and remove unreachable uIs. Prints a report of the words
+#               saved. Only folds that cost no cycles are done.
+# --fold-jsr  : With -O, also fold tails that are preceded by other uIs by
+#               means of a JSR to the shared copy. Each such fold costs one 
+#               cycle in every opcode that runs through it; the report lists
+#               the opcode timing changes.
+# -x FILE     : Generate cross-reference index in JSON format: labels, opcode
+#               entry points, __asm names and, for each uA, the source line,
+#               the routine and the JSR/TJSRs that reach it.
+# -u FILE     : Generate field and bit utilization report.
+# -n          : Narrow ROM: leave bits that are constant across the ROM out of
+#               the VHDL table; the package includes a function to rebuild 
+#               the full uI.
+# -t FILE     : Generate table of cycles and memory cycles per opcode, in CSV 
+#               format if FILE ends in .csv, JSON otherwise.
+# -d FILE     : Generate opcode decoder report file: overlapping, ambiguous and
+#               shadowed __code patterns and undecoded opcodes.
+# -f FORMAT   : Microcode table format: VHDL (package), Verilog (include file),
+#               memh or memb (memory file for $readmemh/$readmemb).
+# -D          : Compact decoding table: leave the decoding table (one JSR per
+#               opcode at uA 100h-1FFh) out of the VHDL microcode table and
+#               put an opcode class ROM and a class entry table in the
+#               package instead, plus a function to rebuild the JSR uIs.
+#               Prints the ROM bits of both schemes.
 # -h, --help  : Show help, quit.
 #
+# The assembler can be used from Python too: assemble() takes the source as a
+# string or a list of lines and returns the uIs, the symbol tables and every
+# error and warning found, without printing anything or quitting.
+#
 ################################################################################
 # Assembler format (informal definition, source is the ultimate reference!):
 #
@@ -99,6 +128,10 @@ import os
 import ntpath
 import optparse
 import re
+import hashlib
+import json
+import filecmp
+import tempfile
 
 UI_WIDTH =        32              # uInstruction width in bits
 UF_FLAGS1 =       (31, 3)         # uI field - flags1
@@ -120,86 +153,200 @@ UF_ALU_OP =       ( 5, 6)         # uI field - alu_op
 UF_JUMP_DST_L =   ( 5, 6)         # uI field - jump target, 6 LSB
 UF_JUMP_DST_H =   (11, 2)         # uI field - jump target, 2 MSB
 
+def _field_mask(field):
+  """Return (shift, mask) of uI field given as (msb, width)."""
+  (msb, nbits) = field
+  shift = msb - nbits + 1
+  return (shift, ((1 << nbits) - 1) << shift)
+
+# All uI fields by name, MSB first. Jump uIs (JSR, TJSR) only use the jump 
+# fields; all other uIs use all the fields but these.
+UI_FIELDS = [
+  ("flags1", UF_FLAGS1),          ("flags2", UF_FLAGS2), 
+  ("ld_addr", UF_LD_ADDR),        ("ld_al", UF_LD_AL), 
+  ("ld_t1", UF_LD_T1),            ("ld_t2", UF_LD_T2), 
+  ("mux_in", UF_MUX_IN),          ("rb_addr_sel", UF_RB_ADDR_SEL), 
+  ("rb_addr", UF_RB_ADDR),        ("rb_addr_msb", UF_RB_ADDR_MSB), 
+  ("clr_acy", UF_CLR_ACY),        ("rb_wr_addr", UF_RB_WR_ADDR), 
+  ("jump_dst_h", UF_JUMP_DST_H),  ("fp", UF_FP), 
+  ("do_we", UF_DO_WE),            ("rb_we", UF_RB_WE), 
+  ("alu_op", UF_ALU_OP),          ("jump_dst_l", UF_JUMP_DST_L)
+  ]
+UI_JUMP_FIELDS = ["flags2", "jump_dst_h", "jump_dst_l"]
+
+# Precomputed (shift, mask) for every uI field.
+UF_SHIFT_MASK = dict([(f, _field_mask(f)) for (name, f) in UI_FIELDS])
+
+# uI fields of the ALU stage plus all flags; a uI with any of these fields set
+# does something in the cycle after its own.
+FOLD_BARRIER_MASK = 0
+for f in [UF_FLAGS1, UF_FLAGS2, UF_LD_AL, UF_LD_ADDR, UF_FP, UF_CLR_ACY, 
+          UF_RB_WE, UF_DO_WE, UF_ALU_OP]:
+  FOLD_BARRIER_MASK |= UF_SHIFT_MASK[f][1]
+
+# uI binary format, MSB left. uIs are only formatted as text on output.
+UI_BIN_FORMAT = "{0:0%db}" % UI_WIDTH
+
 PRAGMAS = ['__code', '__asm', '__reset', '__fetch', '__halt']
 FLAGS = {
-  "#ld_al" :    (UF_LD_AL, "1"),
-  "#ld_addr" :  (UF_LD_ADDR, "1"),
-  "#fp_r" :     (UF_FP, "10"),
-  "#fp_c" :     (UF_FP, "01"),
-  "#fp_rc" :    (UF_FP, "11"),
-  "#clr_acy" :  (UF_CLR_ACY, "1"),
-
-  "#decode" :   (UF_FLAGS1, "001"),
-  "#ei" :       (UF_FLAGS1, "011"),
-  "#di" :       (UF_FLAGS1, "010"),
-  "#io" :       (UF_FLAGS1, "100"),
-  "#auxcy" :    (UF_FLAGS1, "101"),
-  "#clrt1" :    (UF_FLAGS1, "110"),
-  "#halt" :     (UF_FLAGS1, "111"),
+  "#ld_al" :    (UF_LD_AL, 0b1),
+  "#ld_addr" :  (UF_LD_ADDR, 0b1),
+  "#fp_r" :     (UF_FP, 0b10),
+  "#fp_c" :     (UF_FP, 0b01),
+  "#fp_rc" :    (UF_FP, 0b11),
+  "#clr_acy" :  (UF_CLR_ACY, 0b1),
+
+  "#decode" :   (UF_FLAGS1, 0b001),
+  "#ei" :       (UF_FLAGS1, 0b011),
+  "#di" :       (UF_FLAGS1, 0b010),
+  "#io" :       (UF_FLAGS1, 0b100),
+  "#auxcy" :    (UF_FLAGS1, 0b101),
+  "#clrt1" :    (UF_FLAGS1, 0b110),
+  "#halt" :     (UF_FLAGS1, 0b111),
   
-  "#end" :      (UF_FLAGS2, "001"),
-  # UF_FLAGS2 = "010" -> JSR
-  "#ret" :      (UF_FLAGS2, "011"),
-  # UF_FLAGS2 = "100" -> TJSR
-  "#rd" :       (UF_FLAGS2, "101"),
-  "#wr" :       (UF_FLAGS2, "110"),
-  "#setacy" :   (UF_FLAGS2, "111"),
+  "#end" :      (UF_FLAGS2, 0b001),
+  # UF_FLAGS2 = 0b010 -> JSR
+  "#ret" :      (UF_FLAGS2, 0b011),
+  # UF_FLAGS2 = 0b100 -> TJSR
+  "#rd" :       (UF_FLAGS2, 0b101),
+  "#wr" :       (UF_FLAGS2, 0b110),
+  "#setacy" :   (UF_FLAGS2, 0b111),
 }
 
+# Flags field values relevant to uI sequencing and optimization.
+FLAGS1_DECODE = FLAGS["#decode"][1]
+FLAGS1_IO = FLAGS["#io"][1]
+FLAGS1_AUXCY = FLAGS["#auxcy"][1]
+FLAGS1_HALT = FLAGS["#halt"][1]
+FLAGS2_END = FLAGS["#end"][1]
+FLAGS2_JSR = 0b010
+FLAGS2_RET = FLAGS["#ret"][1]
+FLAGS2_TJSR = 0b100
+FLAGS2_RD = FLAGS["#rd"][1]
+FLAGS2_WR = FLAGS["#wr"][1]
+FLAGS2_SETACY = FLAGS["#setacy"][1]
+
+# uA of the fetch uIs, where every CPU instruction starts.
+FETCH_UA = 3
+
+# 8080 register, register pair and condition names by opcode field value.
+REGISTERS = ['b', 'c', 'd', 'e', 'h', 'l', 'm', 'a']
+REGISTER_PAIRS = ['b', 'd', 'h', 'sp']
+CONDITIONS = ['nz', 'z', 'nc', 'c', 'po', 'pe', 'p', 'm']
+
 
 OPCTRL_DST = ['t1', 't2']
 OPCTRL_RB = {
-      '_b':"0000",    '_c':"0001",    '_d':"0010",    '_e':"0011", 
-      '_h':"0100",    '_l':"0101",    '_a':"0111",    '_f':"0110", 
-      '_ph':"1000",   '_pl':"1001",   '_x':"1010",    '_y':"1011", 
-      '_z':"1100",    '_w':"1101",    '_sh':"1110",   '_sl':"1111"
+      '_b':0b0000,    '_c':0b0001,    '_d':0b0010,    '_e':0b0011, 
+      '_h':0b0100,    '_l':0b0101,    '_a':0b0111,    '_f':0b0110, 
+      '_ph':0b1000,   '_pl':0b1001,   '_x':0b1010,    '_y':0b1011, 
+      '_z':0b1100,    '_w':0b1101,    '_sh':0b1110,   '_sl':0b1111
       }
 OPCTRL_IR = {
-      '{s}':  ("01", "0"), 
-      '{d}':  ("10", "0"),
-      '{p}0': ("11", "0"),
-      '{p}1': ("11", "1")
+      '{s}':  (0b01, 0b0), 
+      '{d}':  (0b10, 0b0),
+      '{p}0': (0b11, 0b0),
+      '{p}1': (0b11, 0b1)
       }
 
 ALUCTRL_ALU_0ARG = {
-      'cpc':    '101100',
-      'sec':    '101101'
+      'cpc':    0b101100,
+      'sec':    0b101101
       }
 
 ALUCTRL_ALU_1ARG = {
-      'add':    '001100',
-      'adc':    '001101',
-      'sub':    '001110',
-      'sbb':    '001111',  
+      'add':    0b001100,
+      'adc':    0b001101,
+      'sub':    0b001110,
+      'sbb':    0b001111,  
       
-      'and':    '000100',
-      'orl':    '000110',
-      'not':    '000111',
-      'xrl':    '000101',
+      'and':    0b000100,
+      'orl':    0b000110,
+      'not':    0b000111,
+      'xrl':    0b000101,
       
-      'rla':    '000000',
-      'rra':    '000001',
-      'rlca':   '000010',
-      'rrca':   '000011',
+      'rla':    0b000000,
+      'rra':    0b000001,
+      'rlca':   0b000010,
+      'rrca':   0b000011,
       
-      'aaa':    '111000',
+      'aaa':    0b111000,
       
-      't1':     '010111',
-      'rst':    '011111',
-      'daa':    '101000',
-      'psw':    '110000' 
+      't1':     0b010111,
+      'rst':    0b011111,
+      'daa':    0b101000,
+      'psw':    0b110000 
       }
 
 class SyntaxError(Exception):
-  pass
+  """Raised by uCodeROM when the source has errors.
+  The diagnostics attribute holds the list of Diagnostic objects.
+  """
+  def __init__(self, msg, diagnostics=()):
+    Exception.__init__(self, msg)
+    self.diagnostics = list(diagnostics)
+
+class Diagnostic(object):
+  """Error or warning found while assembling, tied to a source line."""
+
+  def __init__(self, severity, filename, lineno, msg, line=""):
+    self.severity = severity          # 'error' or 'warning'
+    self.filename = filename
+    self.lineno = lineno
+    self.msg = msg
+    self.line = line                  # Offending source line, stripped
+
+  def __str__(self):
+    return "%s:%d:%s:%s." % (self.filename, self.lineno, self.severity, self.msg)
+
+class AssemblyResult(object):
+  """Outcome of an in-memory assembly run, see assemble().
+  The words and tables are only meaningful if ok is True; otherwise they hold
+  whatever was assembled around the errors.
+  """
+
+  def __init__(self, rom):
+    self.rom = rom                    # uCodeROM, to build outputs from
+    self.words = rom.uInstruction_list    # uI table, index is uA
+    self.code_size = rom.code_size        # Number of uIs before padding
+    self.labels = rom.label_address_dict  # label -> uA
+    self.codes = rom.code_address_dict    # opcode pattern -> uA
+    self.instructions = rom.instr_address_dict  # CPU instruction -> uA
+    self.decoding = rom.opcode_address_dict     # opcode -> uA
+    self.diagnostics = rom.diagnostics
+    self.errors = [d for d in self.diagnostics if d.severity == 'error']
+    self.warnings = [d for d in self.diagnostics if d.severity == 'warning']
+    self.ok = not self.errors
+
+
+def assemble(source, optimize=False, filename="<string>", verbose=False):
+  """Assemble microcode source given as a string or an iterable of lines.
+  Never raises on source errors nor quits: every error and warning found is
+  returned in the diagnostics of the AssemblyResult. filename is only used in
+  the messages. Messages are printed to stderr as well if verbose is True.
+  """
+  rom = uCodeROM(filename, optimize, source=source, verbose=verbose, strict=False)
+  return AssemblyResult(rom)
+
 
 class uCodeROM(object):
   """Microcode ROM.
   Includes uCode assembler and VHDL/Verilog formatter.
+  The source is read from srcfile unless given as a string or an iterable of
+  lines in source. optimize is the optimization level: 0 (or False) for none,
+  1 (or True) for the folds and removals that cost no cycles as in -O, 2 for
+  the tail folds through a JSR too, as in -O --fold-jsr. Assembly goes on past errors so that all of them are
+  reported; then, if strict, SyntaxError is raised. Errors and warnings are
+  printed to stderr if verbose and collected in diagnostics in any case.
   """
 
-  def __init__(self, srcfile):
+  def __init__(self, srcfile, optimize=False, source=None, verbose=True,
+               strict=True):
     self.srcfile = srcfile
+    self.optimize = optimize          # 1: Fold tails, remove dead code;
+                                      # 2: fold tails through JSRs too
+    self.verbose = verbose            # Print diagnostics to stderr
+    self.diagnostics = []             # Errors and warnings, as found
     self.source = []                  # List of source lines indexed by lineno
     self.lineno = 0                   # Source line being assembled in pass 1
     self.upc_counter = 0              # uA of next uI
@@ -208,6 +355,13 @@ class uCodeROM(object):
     self.code_address_dict = {}       # bin opcode pattern -> uA
     self.code_lineno_dict = {}        # bin opcode pattern -> src line number
     self.opcode_address_dict = {}     # plain bin opcode -> uA (decoding)
+    self.opcode_pattern_dict = {}     # plain bin opcode -> decoding pattern
+    self.decode_overlaps = []         # (winner, loser, opcodes, ambiguous)
+    self.decode_shadowed = []         # Patterns that decode no opcode
+    self.code_size = 0                # Number of uIs before padding
+    self.lineno_note_dict = {}        # src line number -> listing note
+    self.optimization_report = []     # Lines of optimization report
+    self.fold_jumps = set()           # uAs of JSRs inserted by tail folding
     self.lineno_address_dict = {}     # src line number -> uA if any
     self.lineno_label_dict = {}       # src line number -> label if any
     self.instr_address_dict = {}      # CPU instruction -> uA
@@ -216,132 +370,608 @@ class uCodeROM(object):
     self.jump_src_dst_dict = {}       # Jump instruction uA -> target label
     self.jump_src_lineno_dict = {}    # Jump instruction uA -> src line number
     self.uInstruction_list = []       # uInstruction table, index is uA
-    self.uI = ['0']*UI_WIDTH          # uI being assembled in pass 1
-    # (uI is stored as list of chars, MSB-first.)
+    self.uI = 0                       # uI being assembled in pass 1
+    # (uI is stored as an integer, see UF_SHIFT_MASK for the field layout.)
 
     # Assemble the uCode right now.
+    if source is None:
+      with open(srcfile, "r") as fin:
+        source = fin.readlines()
+    elif isinstance(source, basestring):
+      source = source.splitlines(True)
+    self.source = list(source)
     self._assemble()
 
+    errors = [d for d in self.diagnostics if d.severity == 'error']
+    if strict and errors:
+      raise SyntaxError("%s: %d error(s)" % (srcfile, len(errors)), self.diagnostics)
+
 
-  def build_vhdl_package(self, vhdl_filename):
+  def build_vhdl_package(self, vhdl_filename, narrow=False, compact=False):
     """Return string with microcode table formatted as VHDL package.
     Note you choose the file name but not the package name.
+    If narrow is True the bits that are constant across the ROM are left out
+    of the table, see build_narrow_vhdl_package.
+    If compact is True the decoding table is left out of the table, see
+    compact_decoding.
     """
 
+    if narrow: return self.build_narrow_vhdl_package(vhdl_filename, compact)
+
+    words = 256 if compact else len(self.uInstruction_list)
     base_filename = ntpath.basename(vhdl_filename)
     vhdl =  "-- %s -- Microcode table for light8080 CPU core.\n" % base_filename
+    if compact: vhdl += self._vhdl_compact_note()
     vhdl += "library ieee;\n"
     vhdl += "use ieee.std_logic_1164.all;\n"
     vhdl += "use ieee.numeric_std.all;\n\n"
     vhdl += "package light8080_ucode_pkg is\n\n"
-    vhdl += "  type t_rom is array (0 to 511) of std_logic_vector(31 downto 0);\n"
+    vhdl += "  type t_rom is array (0 to %d) of std_logic_vector(31 downto 0);\n" % (words-1)
     vhdl += "  constant microcode : t_rom := (\n"
 
     # TODO check size of uI table
 
-    for i in range(len(self.uInstruction_list)):
-      vhdl += "  \"%s\"" % "".join(self.uInstruction_list[i])
-      if i < len(self.uInstruction_list)-1:
+    for i in range(words):
+      vhdl += "  \"%s\"" % UI_BIN_FORMAT.format(self.uInstruction_list[i])
+      if i < words-1:
         vhdl += ","
       else:
         vhdl += " "
       vhdl += " -- %03x" % i
       vhdl += "\n"
     vhdl += "\n);\n"
-    vhdl += "end package;\n"
+    if compact:
+      (decl, body) = self._vhdl_compact_decoding()
+      vhdl += "\n" + decl
+      vhdl += "end package;\n\n"
+      vhdl += "package body light8080_ucode_pkg is\n\n"
+      vhdl += body
+      vhdl += "end package body;\n"
+    else:
+      vhdl += "end package;\n"
+
+    _write_file(vhdl_filename, vhdl + "\n")
+
+  def build_narrow_vhdl_package(self, vhdl_filename, compact=False):
+    """Write microcode table formatted as VHDL package, leaving out all the 
+    bits that have the same value in all the uIs.
+    The package has the narrow ROM plus constants UCODE_KEEP (bits stored in 
+    the ROM) and UCODE_CONST (value of the rest), and a function expand_ucode
+    that rebuilds the 32-bit uI. To use it in the core, replace the ROM read
+    with 'ucode <= expand_ucode(rom(to_integer(next_uc_addr)));'.
+    If compact is True the decoding table is left out, see compact_decoding.
+    """
 
-    try:
-      f = open(vhdl_filename, 'w')
-      print >> f, vhdl
-      f.close()
-    except IOError as e:
-      raise e
+    words = 256 if compact else len(self.uInstruction_list)
+    (keep, const) = self.constant_bits(words)
+    kept = [b for b in range(UI_WIDTH-1, -1, -1) if keep & (1 << b)]
+    width = len(kept)
+
+    base_filename = ntpath.basename(vhdl_filename)
+    vhdl =  "-- %s -- Narrow microcode table for light8080 CPU core.\n" % base_filename
+    vhdl += "-- Only the %d bits that are not constant in the ROM are stored, use\n" % width
+    vhdl += "-- function expand_ucode to rebuild the 32-bit microinstruction.\n"
+    if compact: 
+      width_before = bin(self.constant_bits()[0]).count("1")
+      vhdl += self._vhdl_compact_note(width, width_before)
+    vhdl += "library ieee;\n"
+    vhdl += "use ieee.std_logic_1164.all;\n"
+    vhdl += "use ieee.numeric_std.all;\n\n"
+    vhdl += "package light8080_ucode_pkg is\n\n"
+    vhdl += "  constant UCODE_WIDTH : integer := %d;\n" % width
+    vhdl += "  -- Bits stored in the ROM ('1') and value of the bits that are not.\n"
+    vhdl += "  constant UCODE_KEEP : std_logic_vector(31 downto 0) := \"%s\";\n" % UI_BIN_FORMAT.format(keep)
+    vhdl += "  constant UCODE_CONST : std_logic_vector(31 downto 0) := \"%s\";\n\n" % UI_BIN_FORMAT.format(const)
+    vhdl += "  type t_rom is array (0 to %d) of std_logic_vector(UCODE_WIDTH-1 downto 0);\n" % (words-1)
+    vhdl += "  constant microcode : t_rom := (\n"
+
+    for i in range(words):
+      bits = UI_BIN_FORMAT.format(self.uInstruction_list[i])
+      vhdl += "  \"%s\"" % "".join([bits[UI_WIDTH-1-b] for b in kept])
+      if i < words-1:
+        vhdl += ","
+      else:
+        vhdl += " "
+      vhdl += " -- %03x" % i
+      vhdl += "\n"
+    vhdl += "\n);\n\n"
+    if compact:
+      (decl, body) = self._vhdl_compact_decoding()
+      vhdl += decl
+    vhdl += "  function expand_ucode(w : std_logic_vector(UCODE_WIDTH-1 downto 0)) \n"
+    vhdl += "    return std_logic_vector;\n\n"
+    vhdl += "end package;\n\n"
+    vhdl += "package body light8080_ucode_pkg is\n\n"
+    vhdl += "  function expand_ucode(w : std_logic_vector(UCODE_WIDTH-1 downto 0)) \n"
+    vhdl += "    return std_logic_vector is\n"
+    vhdl += "    variable u : std_logic_vector(31 downto 0) := UCODE_CONST;\n"
+    vhdl += "    variable j : integer := 0;\n"
+    vhdl += "  begin\n"
+    vhdl += "    for i in 0 to 31 loop\n"
+    vhdl += "      if UCODE_KEEP(i) = '1' then\n"
+    vhdl += "        u(i) := w(j);\n"
+    vhdl += "        j := j + 1;\n"
+    vhdl += "      end if;\n"
+    vhdl += "    end loop;\n"
+    vhdl += "    return u;\n"
+    vhdl += "  end function;\n\n"
+    if compact: vhdl += body
+    vhdl += "end package body;\n"
+
+    _write_file(vhdl_filename, vhdl + "\n")
+
+  def constant_bits(self, words=None):
+    """Return (keep, const) masks: bits set in keep vary across the ROM, 
+    bits set in const are '1' in all the uIs.
+    If words is given only the first words uIs are looked at.
+    """
+    ones = (1 << UI_WIDTH) - 1
+    zeros = 0
+    for uI in self.uInstruction_list[:words]:
+      ones &= uI
+      zeros |= uI
+    return (zeros & ~ones, ones)
+
+  def compact_decoding(self, width=UI_WIDTH, width_before=None):
+    """Split the decoding table (one JSR uI per opcode at uA 100h-1FFh) into
+    an opcode class ROM and an entry table. Opcodes whose JSRs go to the
+    same uA share a class; the entry table has the JSR target of each class,
+    classes numbered in order of their first opcode.
+    Return dict with keys:
+      classes:      class of each opcode, list indexed by opcode
+      entries:      JSR target uA of each class
+      template:     the decoding JSR uI with a zero target
+      class_bits:   width of the class ROM
+      bits_before:  bits of the 512-word ROM with the decoding table
+      bits_after:   bits of the 256-word ROM plus class ROM and entry table
+    ROM bits are counted for uIs width bits wide (width_before for the
+    512-word ROM if given), e.g. the narrow ROM's.
+    Rebuilding the JSR of every opcode from the template and its class entry
+    is checked to give back the uI of the decoding table, bit by bit.
+    """
+
+    target_mask = UF_SHIFT_MASK[UF_JUMP_DST_L][1] | UF_SHIFT_MASK[UF_JUMP_DST_H][1]
+    decoding = self.uInstruction_list[0x100:0x200]
+    template = decoding[0] & ~target_mask
+    entries = []
+    classes = []
+    for uI in decoding:
+      target = _get_jump_target(uI)
+      if target not in entries: entries.append(target)
+      classes.append(entries.index(target))
+    for (opcode, uI) in enumerate(decoding):
+      rebuilt = template
+      rebuilt |= (entries[classes[opcode]] & 0x3f) << UF_SHIFT_MASK[UF_JUMP_DST_L][0]
+      rebuilt |= (entries[classes[opcode]] >> 6) << UF_SHIFT_MASK[UF_JUMP_DST_H][0]
+      if rebuilt != uI:
+        self._quit("decoding table entry of opcode %02xh is not a plain JSR" % opcode)
+
+    class_bits = max(1, (len(entries) - 1).bit_length())
+    return {
+      'classes': classes,
+      'entries': entries,
+      'template': template,
+      'class_bits': class_bits,
+      'bits_before': len(self.uInstruction_list) * (width_before or width),
+      'bits_after': 256 * width + 256 * class_bits + len(entries) * 8
+    }
+
+  def _vhdl_compact_note(self, width=UI_WIDTH, width_before=None):
+    """VHDL header comment of a package with a compact decoding table."""
+    compact = self.compact_decoding(width, width_before)
+    note =  "-- The decoding table is compacted: the ROM only has uA 000h-0FFh, the\n"
+    note += "-- JSR of each opcode is rebuilt by function decode_ucode. To use it in\n"
+    note += "-- the core, read the ROM as:\n"
+    note += "--   if next_uc_addr(8) = '1' then\n"
+    note += "--     ucode <= decode_ucode(std_logic_vector(next_uc_addr(7 downto 0)));\n"
+    note += "--   else\n"
+    note += "--     ucode <= rom(to_integer(next_uc_addr(7 downto 0)));\n"
+    note += "--   end if;\n"
+    note += "-- ROM bits: %d with the decoding table, %d compacted.\n" % (
+      compact['bits_before'], compact['bits_after'])
+    return note
+
+  def _vhdl_compact_decoding(self):
+    """Return (declarations, package body) VHDL strings for the opcode class
+    ROM, the class entry table and function decode_ucode."""
+    compact = self.compact_decoding()
+    entries = compact['entries']
+    class_bits = compact['class_bits']
+    class_format = "{0:0%db}" % class_bits
+    (l_msb, l_width) = UF_JUMP_DST_L
+    (h_msb, h_width) = UF_JUMP_DST_H
+
+    decl =  "  -- Decoding table: class of each opcode and JSR target of each class.\n"
+    decl += "  constant DECODE_CLASS_WIDTH : integer := %d;\n" % class_bits
+    decl += "  -- Decoding JSR uI with a zero target.\n"
+    decl += "  constant DECODE_JSR : std_logic_vector(31 downto 0) := \"%s\";\n\n" % (
+      UI_BIN_FORMAT.format(compact['template']))
+    decl += "  type t_decode_class_rom is array (0 to 255) of std_logic_vector(DECODE_CLASS_WIDTH-1 downto 0);\n"
+    decl += "  constant decode_class : t_decode_class_rom := (\n"
+    for opcode in range(256):
+      decl += "  \"%s\"%s -- %02x %s\n" % (
+        class_format.format(compact['classes'][opcode]), 
+        "," if opcode < 255 else " ", opcode, self.opcode_mnemonic(opcode) or "")
+    decl += "\n);\n\n"
+    decl += "  type t_decode_entry_rom is array (0 to %d) of std_logic_vector(7 downto 0);\n" % (len(entries)-1)
+    decl += "  constant decode_entry : t_decode_entry_rom := (\n"
+    for (n, uA) in enumerate(entries):
+      decl += "  \"{0:08b}\"{1} -- {2:d}: {3:03x} {4}\n".format(uA, 
+        "," if n < len(entries)-1 else " ", n, uA, self.address_instr_dict.get(uA, ""))
+    decl += "\n);\n\n"
+    decl += "  function decode_ucode(opcode : std_logic_vector(7 downto 0)) \n"
+    decl += "    return std_logic_vector;\n\n"
+
+    body =  "  function decode_ucode(opcode : std_logic_vector(7 downto 0)) \n"
+    body += "    return std_logic_vector is\n"
+    body += "    variable u : std_logic_vector(31 downto 0) := DECODE_JSR;\n"
+    body += "    variable target : std_logic_vector(7 downto 0);\n"
+    body += "  begin\n"
+    body += "    target := decode_entry(to_integer(unsigned(decode_class(to_integer(unsigned(opcode))))));\n"
+    body += "    u(%d downto %d) := target(%d downto 0);\n" % (l_msb, l_msb-l_width+1, l_width-1)
+    body += "    u(%d downto %d) := target(7 downto %d);\n" % (h_msb, h_msb-h_width+1, l_width)
+    body += "    return u;\n"
+    body += "  end function;\n\n"
+    return (decl, body)
+
+  def build_utilization_report(self, report_filename=None):
+    """Write microcode field and bit utilization report to file unless file is
+    None. Jump and non-jump uIs are counted apart for the fields since they 
+    use different field layouts.
+    """
+
+    if not report_filename: return
+
+    uIs = self.uInstruction_list
+    jumps = [uI for uI in uIs 
+             if _get_field(uI, UF_FLAGS2) in (FLAGS2_JSR, FLAGS2_TJSR)]
+    others = [uI for uI in uIs 
+              if _get_field(uI, UF_FLAGS2) not in (FLAGS2_JSR, FLAGS2_TJSR)]
+
+    report = "Microcode utilization report for '%s'.\n" % self.srcfile
+    report += "%d uIs: %d from source, %d padding; %d jumps, %d other.\n\n" % (
+      len(uIs), self.code_size, 256 - self.code_size, len(jumps), len(others))
+
+    report += "FIELDS:\n"
+    report += "%-12s %-6s  %-5s  %-9s  %s\n" % ("field", "bits", "uIs", "distinct", "values (count)")
+    for (name, field) in UI_FIELDS:
+      (msb, nbits) = field
+      words = jumps if name in UI_JUMP_FIELDS else others
+      counts = {}
+      for uI in words:
+        value = _get_field(uI, field)
+        counts[value] = counts.get(value, 0) + 1
+      values = " ".join(["{0:0{1}b}({2})".format(v, nbits, counts[v]) 
+                         for v in sorted(counts)])
+      if set(counts) <= set([0]): values = "NEVER SET"
+      report += "%-12s %2d..%-2d  %5d  %5d/%-3d  %s\n" % (name, msb, msb - nbits + 1, 
+        len(words), len(counts), 1 << nbits, values)
+
+    (keep, const) = self.constant_bits()
+    report += "\nBITS:\n"
+    report += "%-3s  %-5s  %-5s  %s\n" % ("bit", "ones", "zeros", "fields")
+    for bit in range(UI_WIDTH-1, -1, -1):
+      ones = len([uI for uI in uIs if uI & (1 << bit)])
+      names = [n for (n, f) in UI_FIELDS if UF_SHIFT_MASK[f][1] & (1 << bit)]
+      if not keep & (1 << bit):
+        names.append("CONSTANT %d" % (ones > 0))
+      report += "%3d  %5d  %5d  %s\n" % (bit, ones, len(uIs) - ones, ", ".join(names))
+
+    width = bin(keep).count("1")
+    report += "\n%d constant bits, narrow ROM would be %d x %d bits (%d bits saved).\n" % (
+      UI_WIDTH - width, len(uIs), width, len(uIs) * (UI_WIDTH - width))
+
+    _write_file(report_filename, report)
+
+  def instruction_timing(self):
+    """Walk the microcode of every opcode and return a list of dicts, one per
+    opcode and conditional path, with keys:
+      opcode, mnemonic, variant, cycles, mem_reads, mem_writes, io_reads, 
+      io_writes, halts, path
+    Each uI takes one clock cycle, JSR/TJSR included; the count covers the 
+    fetch uIs and the decoding table JSR. Memory cycles include the opcode
+    fetch. Each TJSR in the path gives a 'taken' and a 'not taken' variant, 
+    named by a string of 'T' and 'N' in path order ('' for no TJSR).
+    Undecoded opcodes run the reset uIs back into the fetch uIs.
+    """
+
+    uIs = self.uInstruction_list
+    table = []
+    for opcode in range(256):
+      # Pending paths: (uA, return uA, path so far, variant so far).
+      pending = [(FETCH_UA, None, [], "")]
+      while pending:
+        (uA, ret, path, variant) = pending.pop(0)
+        while True:
+          if len(path) > 512:
+            self._quit("microcode of opcode %02xh does not end" % opcode)
+          path.append(uA)
+          uI = uIs[uA]
+          flags1 = _get_field(uI, UF_FLAGS1)
+          flags2 = _get_field(uI, UF_FLAGS2)
+          if flags2 == FLAGS2_END: 
+            break
+          elif flags2 == FLAGS2_TJSR:
+            # Taken: follow the jump. Not taken: works as #end.
+            pending.append((_get_jump_target(uI), uA + 1, list(path), variant + "T"))
+            variant += "N"
+            break
+          elif flags2 == FLAGS2_JSR:
+            (uA, ret) = (_get_jump_target(uI), uA + 1)
+          elif flags2 == FLAGS2_RET:
+            uA = ret
+          elif flags1 == FLAGS1_DECODE:
+            uA = 0x100 + opcode
+          else:
+            uA = uA + 1
+          if uA == FETCH_UA: 
+            break
+        table.append(self._path_timing(opcode, path, variant))
+    return table
+
+  def _path_timing(self, opcode, path, variant):
+    """Return instruction_timing table row for uI path of opcode."""
+    row = {
+      'opcode': opcode,
+      'mnemonic': self.opcode_mnemonic(opcode),
+      'variant': variant,
+      'cycles': len(path),
+      'mem_reads': 0, 'mem_writes': 0, 'io_reads': 0, 'io_writes': 0,
+      'halts': False,
+      'path': path
+    }
+    for uA in path:
+      uI = self.uInstruction_list[uA]
+      flags1 = _get_field(uI, UF_FLAGS1)
+      flags2 = _get_field(uI, UF_FLAGS2)
+      space = "io" if flags1 == FLAGS1_IO else "mem"
+      if flags2 == FLAGS2_RD: row[space + "_reads"] += 1
+      if flags2 == FLAGS2_WR: row[space + "_writes"] += 1
+      if flags1 == FLAGS1_HALT and flags2 == FLAGS2_END: row['halts'] = True
+    return row
+
+  def opcode_mnemonic(self, opcode):
+    """Return assembler mnemonic of opcode built from its __asm pragma, or 
+    None if the opcode is not decoded.
+    """
+    if opcode not in self.opcode_address_dict: return None
+    instr = self.address_instr_dict.get(self.opcode_address_dict[opcode])
+    if instr is None: return None
+    ddd = (opcode >> 3) & 7
+    def choose(m):
+      # Conditional instructions are listed in no particular order.
+      items = [x.strip() for x in m.group(1).split(",")]
+      matches = [x for x in items if x.split()[0][1:] == CONDITIONS[ddd]]
+      return matches[0] if len(matches) == 1 else items[ddd]
+    instr = re.sub(r"\{([^}]*,[^}]*)\}", choose, instr)
+    instr = instr.replace("{s}", REGISTERS[opcode & 7])
+    instr = instr.replace("{d}", REGISTERS[ddd])
+    instr = instr.replace("[p]", REGISTER_PAIRS[(opcode >> 4) & 3])
+    return " ".join(instr.split())
+
+  def build_timing_table(self, table_filename=None):
+    """Write instruction timing table to file unless file is None.
+    The table is written in CSV format if the file name ends in '.csv' and in
+    JSON format otherwise. See instruction_timing.
+    """
+
+    if not table_filename: return
+
+    table = self.instruction_timing()
+    columns = ['opcode', 'mnemonic', 'variant', 'cycles', 'mem_reads', 
+               'mem_writes', 'io_reads', 'io_writes', 'halts']
+    if table_filename.lower().endswith(".csv"):
+      text = ",".join(columns) + "\n"
+      for row in table:
+        values = dict(row)
+        values['opcode'] = "%02x" % row['opcode']
+        values['mnemonic'] = row['mnemonic'] or ""
+        values['halts'] = int(row['halts'])
+        text += ",".join(['"%s"' % values[c] if c == 'mnemonic' else str(values[c]) 
+                          for c in columns]) + "\n"
+    else:
+      for row in table:
+        row['path'] = ["%03x" % uA for uA in row['path']]
+      text = json.dumps({'source': ntpath.basename(self.srcfile), 
+                         'columns': columns + ['path'], 
+                         'opcodes': table}, indent=1, sort_keys=True) + "\n"
+
+    _write_file(table_filename, text)
+
+  def build_verilog_include(self, verilog_filename):
+    """Write microcode table formatted as Verilog include file.
+    The include file declares the ROM array and initializes it, it is meant 
+    to be `include'd within the body of the CPU module.
+    """
+
+    base_filename = ntpath.basename(verilog_filename)
+    verilog =  "// %s -- Microcode table for light8080 CPU core.\n" % base_filename
+    verilog += "reg [31:0] microcode [0:511];\n\n"
+    verilog += "initial begin\n"
+
+    for i in range(len(self.uInstruction_list)):
+      verilog += "  microcode[%3d] = 32'b%s;" % (i, UI_BIN_FORMAT.format(self.uInstruction_list[i]))
+      verilog += " // %03x" % i
+      verilog += "\n"
+    verilog += "end\n"
+
+    _write_file(verilog_filename, verilog + "\n")
+
+  def build_mem_file(self, mem_filename, radix='b'):
+    """Write microcode table as a memory file to be read by $readmemb (radix 
+    'b') or $readmemh (radix 'h'), one uI per line.
+    """
+
+    base_filename = ntpath.basename(mem_filename)
+    mem =  "// %s -- Microcode table for light8080 CPU core.\n" % base_filename
+    mem += "// Load with $readmem%s into a [31:0] array [0:511].\n" % radix
+
+    for i in range(len(self.uInstruction_list)):
+      word = self.uInstruction_list[i]
+      if radix == 'h':
+        word = "%08x" % word
+      else:
+        word = UI_BIN_FORMAT.format(word)
+      mem += "%s // %03x\n" % (word, i)
+
+    _write_file(mem_filename, mem + "\n")
 
   def build_listing(self, lst_filename=None):
-    """Print listing to file unless file is None.
+    """Write listing to file unless file is None, see write_listing."""
+
+    if not lst_filename: return
+    _write_output(lst_filename, self.write_listing)
+
+  def write_listing(self, fo):
+    """Write listing to file object fo, one line at a time.
     Listing will include uI coming from the source as well as padding uI and 
     uI used in the jump (decoding) table.
     """
 
-    if not lst_filename: return
-
-    listing = ""
+    uI_lines = self._uI_lines()
 
     # First, build traditional listing with 1 listing line per source line.
     for i in range(1,self.lineno+1):
       asm = self.source[i-1].rstrip()
-      if i in self.lineno_address_dict and not i in self.lineno_label_dict and not asm.startswith("__"):
+      if i in uI_lines:
         # This line generated a uInstruction.
-        uA = self.lineno_address_dict[i]
+        uA = uI_lines[i]
         addr = "%03x:" % uA
-        obj = "".join(self.uInstruction_list[uA])
+        obj = UI_BIN_FORMAT.format(self.uInstruction_list[uA])
       else:
         # This line is a comment or is blank.
         addr = " "*4
         obj = ""
-      listing_line = "%4s  %32s  %s\n" % (addr, obj, asm)
-      listing += listing_line
+      if i in self.lineno_note_dict:
+        asm += "  // %s" % self.lineno_note_dict[i]
+      fo.write("%4s  %32s  %s\n" % (addr, obj, asm))
 
     # Ok, now add the padding uInstructions.
-    listing += "\n\n%4s  %32s  %s\n" % ("", "", "// PADDING INSTRUCTIONS INSERTED AUTOMATICALLY.")
-    for i in range(uA+1,256):
-      obj = "".join(self.uInstruction_list[i])
-      listing_line = "%03x:  %32s  %s\n" % (i, obj, "")
-      listing += listing_line
+    fo.write("\n\n%4s  %32s  %s\n" % ("", "", "// PADDING INSTRUCTIONS INSERTED AUTOMATICALLY."))
+    for i in range(self.code_size,256):
+      obj = UI_BIN_FORMAT.format(self.uInstruction_list[i])
+      fo.write("%03x:  %32s  %s\n" % (i, obj, ""))
 
     # Finally, add the jump table JSR uInstructions.
-    listing += "\n\n%4s  %32s  %s\n" % ("", "", "// DECODING TABLE INSERTED AUTOMATICALLY.")
+    fo.write("\n\n%4s  %32s  %s\n" % ("", "", "// DECODING TABLE INSERTED AUTOMATICALLY."))
     for i in range(256,512):
-      obj = "".join(self.uInstruction_list[i])
+      obj = UI_BIN_FORMAT.format(self.uInstruction_list[i])
       if (i-0x100) in self.opcode_address_dict: 
         ua = self.opcode_address_dict[i-0x100]
         asm = "// %s" % self.address_instr_dict[ua]
       else:
         asm = "//"
-      listing_line = "%03x:  %32s  %s\n" % (i, obj, asm)
-      listing += listing_line
+      fo.write("%03x:  %32s  %s\n" % (i, obj, asm))
+
+    fo.write("\n\n%4s  %32s  %s\n\n" % ("", "", "// END OF LISTING."))
+
+  def cross_reference(self):
+    """Return cross-reference index of the microcode as a dict with keys:
+      labels:       label -> {uA, line}
+      instructions: __asm name -> {uA, line}
+      opcodes:      opcode as 2 hex digits -> {uA, pattern, instruction}, uA
+                    being the entry point of the opcode's microcode
+      uA:           list indexed by uA of {line, source, routine, jsr_from}:
+                    source line of the uI if any, closest label or __asm at
+                    or before it (the opcode's for decoding table slots), and
+                    uAs of the JSR/TJSRs (decoding table included) that jump
+                    to it
+    The index holds the same information as the listing, ready for lookups.
+    """
 
-    listing += "\n\n%4s  %32s  %s\n" % ("", "", "// END OF LISTING.")
+    uI_lines = self._uI_lines()
+    uA_lines = dict((uA, lineno) for (lineno, uA) in uI_lines.items())
+
+    labels = {}
+    for (label, uA) in self.label_address_dict.items():
+      labels[label] = {'uA': uA, 'line': self.label_lineno_dict[label]}
+    instructions = {}
+    for (instr, uA) in self.instr_address_dict.items():
+      instructions[instr] = {'uA': uA, 'line': self.instr_lineno_dict[instr]}
+    opcodes = {}
+    for (opcode, uA) in self.opcode_address_dict.items():
+      opcodes["%02x" % opcode] = {'uA': uA, 
+        'pattern': self.opcode_pattern_dict[opcode],
+        'instruction': self.address_instr_dict.get(uA)}
+
+    # Names of routines by uA, __asm names taking precedence over labels.
+    names = dict((uA, label) for (label, uA) in self.label_address_dict.items())
+    names.update(self.address_instr_dict)
+
+    jsr_from = [[] for uA in self.uInstruction_list]
+    for (uA, uI) in enumerate(self.uInstruction_list):
+      if _get_field(uI, UF_FLAGS2) in (FLAGS2_JSR, FLAGS2_TJSR):
+        jsr_from[_get_jump_target(uI)].append(uA)
+
+    table = []
+    routine = None
+    for uA in range(len(self.uInstruction_list)):
+      if uA == self.code_size: routine = None
+      routine = names.get(uA, routine)
+      if uA >= 0x100:
+        # Decoding table: name the slot after the opcode's microcode.
+        routine = self.address_instr_dict.get(self.opcode_address_dict.get(uA - 0x100))
+      lineno = uA_lines.get(uA)
+      table.append({
+        'line': lineno,
+        'source': self.source[lineno-1].strip() if lineno else None,
+        'routine': routine,
+        'jsr_from': jsr_from[uA]
+      })
+
+    return {
+      'source': self.srcfile,
+      'labels': labels,
+      'instructions': instructions,
+      'opcodes': opcodes,
+      'uA': table
+    }
+
+  def build_index(self, index_filename=None):
+    """Write cross-reference index to file in JSON format unless file is 
+    None, see cross_reference.
+    """
 
-    try:
-      f = open(lst_filename, 'w')
-      print >> f, listing
-      f.close()
-    except IOError as e:
-      raise e
+    if not index_filename: return
+    index = self.cross_reference()
+    _write_output(index_filename, lambda fo: json.dump(index, fo, indent=1, sort_keys=True))
+
+  def _uI_lines(self):
+    """Return dict mapping the source lines that generated a uI to its uA."""
+    lines = {}
+    for (lineno, uA) in self.lineno_address_dict.items():
+      if lineno not in self.lineno_label_dict and not self.source[lineno-1].strip().startswith("__"):
+        lines[lineno] = uA
+    return lines
 
 
   def _assemble(self):
-    """Read uCode asm source, assemble it fully into a list of uCode binary 
-    words.
+    """Assemble uCode asm source fully into a list of uCode binary words.
+    Errors are recorded in the diagnostics list; the passes that depend on
+    error-free code are skipped if there are any.
     """
 
-    # Read the whole file to a list of lines.
-    try:
-        fin = open(self.srcfile, "r")
-        self.source = fin.readlines()
-        fin.close()
-    except IOError as e:
-        print e 
-        sys.exit(e.errno)
-
-    try:
-      # Assembly pass 1: translate ucode words, leave jumps unresolved.
-      self._pass_1()    
-      # Assembly pass 2: resolve jump references.
-      self._pass_2()
-      # Pad to 256 uInstructions with NOPs.
-      self._fill_unused_slots()
-      # Build decoding (jump) table.
-      self._build_decoding_table()
-      
-    except SyntaxError as e:
-      # Error messages have already been output to stderr, just quit.
-      sys.exit(22)
+    # Assembly pass 1: translate ucode words, leave jumps unresolved.
+    self._pass_1()
+    # Assembly pass 2: resolve jump references.
+    self._pass_2()
+    if self._error_count(): return
+    # Optional optimization pass: fold common tails, remove dead code.
+    if self.optimize: self._optimize()
+    self.code_size = self.upc_counter
+    # Pad to 256 uInstructions with NOPs.
+    self._fill_unused_slots()
+    # Build decoding (jump) table.
+    self._build_decoding_table()
+    # Tell what the tail folding JSRs cost, now that opcodes can be timed.
+    if self.fold_jumps: self._report_fold_timing()
 
 
   def _pass_1(self):
-    """Assemble all individual uInstructions, leave jumps unresolved."""
+    """Assemble all individual uInstructions, leave jumps unresolved.
+    A line with errors is assembled as a NOP if it was a uI so that the 
+    addresses of the uIs that follow are right, then assembly goes on.
+    """
 
     # Process all lines in file.
     self.lineno = 0
@@ -355,16 +985,23 @@ class uCodeROM(object):
       if len(ucode) == 0: continue
       # Split the actual ucode in up to 3 fields...
       fields = [x.strip() for x in ucode.split(';')]
-      # ...reject lines with 4 or more.
-      if len(fields) > 3: self._syntax_error("line has more than 3 fields")
-
-      self._assemble_uInstruction(fields)
+      upc_counter = self.upc_counter
+      try:
+        # ...reject lines with 4 or more.
+        if len(fields) > 3: self._syntax_error("line has more than 3 fields")
+        self._assemble_uInstruction(fields)
+      except SyntaxError:
+        uI_line = not (fields[0].startswith(":") or fields[0].startswith("__"))
+        if uI_line and self.upc_counter == upc_counter:
+          self.uI = 0
+          self._emit()
+        self.lineno_address_dict[self.lineno] = self.upc_counter-1
       
 
   def _assemble_uInstruction(self, uI_fields):
     """Assemble individual uInstruction."""
 
-    self.uI = ['0']*UI_WIDTH
+    self.uI = 0
     
     if uI_fields[0].startswith(":"):
       # Label. Store the address for reference in pass 2.
@@ -409,19 +1046,19 @@ class uCodeROM(object):
         self._syntax_error("wrong target register in operand control field")
       # ...and set corresponding load flag. # TODO support T1=T2=x? it's free.
       target = [UF_LD_T1, UF_LD_T2][OPCTRL_DST.index(sides[0])]
-      self._set_bits(target, "1")
+      self._set_bits(target, 1)
       # ...then parse source.
       if sides[1] in OPCTRL_RB:
-        self._set_bits(UF_RB_ADDR_SEL, "00")  # RB RD addr comes from uI
+        self._set_bits(UF_RB_ADDR_SEL, 0b00)  # RB RD addr comes from uI
         self._set_bits(UF_RB_ADDR, OPCTRL_RB[sides[1]])
-        self._set_bits(UF_MUX_IN, "1")        # Tx load data comes from RB
+        self._set_bits(UF_MUX_IN, 1)          # Tx load data comes from RB
       elif sides[1] in OPCTRL_IR:
         (mux, msb) = OPCTRL_IR[sides[1]]
         self._set_bits(UF_RB_ADDR_SEL, mux)   # RD RD addr comes from IR...
         self._set_bits(UF_RB_ADDR_MSB, msb)   # ...+1 if top half of 16b pair
-        self._set_bits(UF_MUX_IN, "1")        # Tx load data comes from RB
+        self._set_bits(UF_MUX_IN, 1)          # Tx load data comes from RB
       elif sides[1] == 'di':
-        self._set_bits(UF_MUX_IN, "0")        # Tx load data comes from DI
+        self._set_bits(UF_MUX_IN, 0)          # Tx load data comes from DI
       else:
         self._syntax_error("invalid source in operand control field")
     else:
@@ -444,15 +1081,15 @@ class uCodeROM(object):
         # TODO use separate WR index field currently unused.
         #self._set_bits(UF_RB_WR_ADDR, OPCTRL_RB[sides[0]])
         self._set_bits(UF_RB_ADDR, OPCTRL_RB[sides[0]])
-        self._set_bits(UF_RB_WE, "1")
+        self._set_bits(UF_RB_WE, 1)
       elif sides[0] in OPCTRL_IR:
         (mux, msb) = OPCTRL_IR[sides[0]]
         # TODO check concordance with op stage.
         self._set_bits(UF_RB_ADDR_SEL, mux)   # RD RD addr comes from IR...
         self._set_bits(UF_RB_ADDR_MSB, msb)   # ...+1 if top half of 16b pair
-        self._set_bits(UF_RB_WE, "1")
+        self._set_bits(UF_RB_WE, 1)
       elif sides[0] == "do":
-        self._set_bits(UF_DO_WE, "1")
+        self._set_bits(UF_DO_WE, 1)
       else:
         self._syntax_error("wrong target register in operand control field")
       # Ok, now parse ALU operation.
@@ -480,8 +1117,7 @@ class uCodeROM(object):
         (bitfield, bitval) = FLAGS[flag]
         # ...unless the field is already initialized which means flag clash.
         if self._field_nonzero(bitfield):
-          print "".join(self.uI)
-          self._syntax_error("flag conflict")
+          self._syntax_error("flag '%s' conflicts with a previous flag" % flag)
         self._set_bits(bitfield, bitval)
 
   def _pass1_jump(self, uI_fields):
@@ -497,15 +1133,17 @@ class uCodeROM(object):
       self._syntax_error("unexpected fields in JSR/TJSR line")
     if not tokens[0] in ['TJSR', 'JSR']:
       self._syntax_error("unknown microinstruction mnemonic '%s'" % tokens[0])
+    if len(tokens) < 2:
+      self._syntax_error("missing JSR/TJSR target label")
     # Okay, save the jump to be resolved in pass 2...
     label = tokens[1].strip()
     self.jump_src_dst_dict[self.upc_counter] = label
     self.jump_src_lineno_dict[self.upc_counter] = self.lineno
     # ...and emit the actual jump uInstruction with target uA field empty.
     if tokens[0] == 'JSR':
-      self._set_bits(UF_FLAGS2, "010")
+      self._set_bits(UF_FLAGS2, FLAGS2_JSR)
     else:
-      self._set_bits(UF_FLAGS2, "100")
+      self._set_bits(UF_FLAGS2, FLAGS2_TJSR)
     self._emit()
 
 
@@ -514,19 +1152,22 @@ class uCodeROM(object):
     self.uInstruction_list.append(self.uI)
     self.upc_counter += 1
 
-  def _set_bits(self, field, bits):
-    """Set bit field in current uInstruction."""
+  def _set_bits(self, field, value):
+    """Set bit field in current uInstruction to integer value."""
 
-    (msb, nbits) = field
-    for i in range(nbits):
-      self.uI[(UI_WIDTH-1)-msb+i] = bits[i]
+    (shift, mask) = UF_SHIFT_MASK[field]
+    if (value << shift) & ~mask:
+      self._syntax_error("BUG! value out of range for uI field")
+    self.uI = (self.uI & ~mask) | (value << shift)
+
+  def _set_jump_target(self, uA):
+    """Set jump target field in current uInstruction."""
+    self._set_bits(UF_JUMP_DST_L, uA & 0x3f)
+    self._set_bits(UF_JUMP_DST_H, uA >> 6)
 
   def _field_nonzero(self, field):
     """Check whether a uInstruction field is nonzero. Flag conflicts."""
-    (msb, nbits) = field
-    for i in range(nbits):
-      if self.uI[(UI_WIDTH-1)-msb+i] != '0': return True
-    return False
+    return (self.uI & UF_SHIFT_MASK[field][1]) != 0
 
 
   def _do_label(self, uI_fields):
@@ -563,10 +1204,12 @@ class uCodeROM(object):
     params = pragma_fields[1].strip() if len(pragma_fields)>1 else ''
     if pragma == '__code':
       # __code: store uA of CPU binary opcode, will be used to build jump table.
+      params = params.replace("\"","")
+      if len(params) != 8:
+        self._syntax_error("invalid CPU opcode pattern '%s'" % params)
       if params in self.code_address_dict:
         emsg = "CPU opcode '%s' already defined at line %d" % (params, self.code_lineno_dict[params])
         self._syntax_error(emsg)
-      params = params.replace("\"","")
       self.code_address_dict[params] = self.upc_counter
       self.code_lineno_dict[params] = self.lineno
     if pragma == '__asm':
@@ -584,137 +1227,566 @@ class uCodeROM(object):
 
   def _pass_2(self):
     """Resolve jump references."""
-    undefined_label = False
-    for jump_src_addr in self.jump_src_dst_dict.keys():
+    for jump_src_addr in sorted(self.jump_src_dst_dict.keys()):
       label = self.jump_src_dst_dict[jump_src_addr]
       if label not in self.label_address_dict:
         lsrc = self.jump_src_lineno_dict[jump_src_addr]
         self._syntax_error("undefined label '%s'" % label, src=lsrc, quit=0)
-        undefined_label = True
       else:
         jump_dst_addr = self.label_address_dict[label]
         #print "[%3xh] -> %3xh; %s" % (jump_src_addr, jump_dst_addr, label) 
-        target_bin = self._int_to_bin(jump_dst_addr, 8)
         self.uI = self.uInstruction_list[jump_src_addr]
-        self._set_bits(UF_JUMP_DST_L, target_bin[2:])
-        self._set_bits(UF_JUMP_DST_H, target_bin[0:2])
+        self._set_jump_target(jump_dst_addr)
         self.uInstruction_list[jump_src_addr] = self.uI
 
-    if undefined_label:
-      self._quit("quitting due to previous label error(s)")
+
+  def _optimize(self):
+    """Shrink the microcode: fold identical routine tails into a single copy
+    and remove unreachable uIs, then relocate the code that's left.
+    The uIs before the first __code routine live at fixed addresses (reset,
+    fetch and halt) and are never touched.
+    """
+
+    words = self.uInstruction_list
+    if not self.code_address_dict: return
+    first = min(self.code_address_dict.values())
+    old_size = len(words)
+
+    # uA -> original source line, to name things in the report.
+    self._uA_lineno = dict((uA, lineno) for (lineno, uA) in self._uI_lines().items())
+
+    deleted = [False] * len(words)
+    alias = {}                        # uA -> uA of equivalent code
+    fold_jumps = set()                # uA of JSRs inserted by tail folding
+
+    self._fold_tails(first, deleted, alias, fold_jumps)
+    self._remove_dead_code(first, deleted, alias, fold_jumps)
+    reloc = self._relocate(deleted, alias)
+    self.fold_jumps = set(reloc[uA] for uA in fold_jumps)
+
+    self.optimization_report.append("%d uI words saved (%d uIs used, %d before)." % 
+      (old_size - len(self.uInstruction_list), len(self.uInstruction_list), old_size))
+
+  def _fold_tails(self, first, deleted, alias, fold_jumps):
+    """Replace each routine tail identical to an earlier one with a JSR to it.
+    A tail is a run of uIs ending in #end. Since the shared tail ends the CPU
+    instruction no #ret is needed, the JSR 'does not return'. If the whole 
+    routine is identical to the tail there is no JSR at all; the routine's 
+    entry is just redirected to the shared copy.
+    The JSR costs one cycle, so these folds are only done at optimization
+    level 2. The extra cycle delays the pipelined ALU stage of the uI before
+    it, so a tail is only folded after a uI with no ALU stage, flags or 
+    memory control, and never at a uI dealing with the aux carry or DAA.
+    """
+
+    words = self.uInstruction_list
+    ends = [uA for uA in range(first, len(words)) 
+            if _get_field(words[uA], UF_FLAGS2) == FLAGS2_END]
+
+    for (n, i) in enumerate(ends):
+      best = None
+      for j in ends[:n]:
+        if deleted[j] or words[j] != words[i]: continue
+        # Grow the common tail backwards as long as both run sequentially.
+        k = 1
+        while (i-k >= first and j-k >= first and 
+               not deleted[i-k] and not deleted[j-k] and 
+               words[i-k] == words[j-k] and 
+               _falls_through(words[i-k]) and _falls_through(words[j-k])):
+          k += 1
+        start = i - k + 1
+        if not _falls_through(words[start-1]):
+          # The whole routine is the shared tail, nothing left to jump from.
+          fold = (k, start, j, False)
+        elif self.optimize < 2:
+          continue
+        else:
+          for p in range(start, i):
+            if self._can_fold_at(p): break
+          else:
+            continue
+          fold = (i - p + 1, p, j - (i - p), True)
+        if best is None or fold[0] - fold[3] > best[0] - best[3]:
+          best = fold + (j,)
+
+      if best is None: continue
+      (k, p, q, jump, j) = best
+      if k - jump < 1: continue
+
+      # Fold it: the first uI of the tail becomes the JSR if one is needed.
+      for t in range(k):
+        alias[p + t] = q + t
+        deleted[p + t] = True
+      if jump:
+        deleted[p] = False
+        self.uI = 0
+        self._set_bits(UF_FLAGS2, FLAGS2_JSR)
+        self._set_jump_target(q)
+        words[p] = self.uI
+        fold_jumps.add(p)
+        self.lineno_note_dict[self._uA_lineno.get(p)] = "tail folded: JSR %03x"
+      for t in range(jump, k):
+        self.lineno_note_dict[self._uA_lineno.get(p + t)] = "tail folded into %03x"
+      self.optimization_report.append(
+        "%d uIs of %s folded into %s (%d words saved%s)." % (k, 
+        self._routine_name(p), self._routine_name(q), k - jump, 
+        ", +1 cycle" if jump else ""))
+
+  def _can_fold_at(self, p):
+    """True if a tail starting at uA p can be replaced with a JSR."""
+    words = self.uInstruction_list
+    if words[p-1] & FOLD_BARRIER_MASK: return False
+    for uI in words[p:p+2]:
+      if _get_field(uI, UF_FLAGS1) == FLAGS1_AUXCY: return False
+      if _get_field(uI, UF_FLAGS2) == FLAGS2_SETACY: return False
+      if _get_field(uI, UF_ALU_OP) == ALUCTRL_ALU_1ARG['daa']: return False
+    return True
+
+  def _remove_dead_code(self, first, deleted, alias, fold_jumps):
+    """Delete all uIs that can't be reached from the fixed uIs at the bottom
+    of the ROM or from any __code routine.
+    """
+
+    words = self.uInstruction_list
+    reached = [False] * len(words)
+    pending = range(first) + [_resolve(alias, a) for a in self.code_address_dict.values()]
+    while pending:
+      uA = pending.pop()
+      if uA >= len(words) or reached[uA] or deleted[uA]: continue
+      reached[uA] = True
+      uI = words[uA]
+      if _get_field(uI, UF_FLAGS2) in (FLAGS2_JSR, FLAGS2_TJSR):
+        pending.append(_resolve(alias, _get_jump_target(uI)))
+      if _falls_through(uI) and uA not in fold_jumps:
+        pending.append(uA + 1)
+
+    dead = [uA for uA in range(first, len(words)) if not reached[uA] and not deleted[uA]]
+    for uA in dead:
+      deleted[uA] = True
+      self.lineno_note_dict[self._uA_lineno.get(uA)] = "unreachable, removed"
+    if dead:
+      self.optimization_report.append("%d unreachable uIs removed: %s." % 
+        (len(dead), ", ".join(["%03x" % uA for uA in dead])))
+
+  def _relocate(self, deleted, alias):
+    """Pack the uIs left after optimization and fix all uA references.
+    Return the dict mapping the old uA of every uI left to its new uA.
+    """
+
+    words = self.uInstruction_list
+    reloc = {}
+    for uA in range(len(words)):
+      if not deleted[uA]: reloc[uA] = len(reloc)
+
+    def new_uA(uA):
+      uA = _resolve(alias, uA)
+      while uA < len(words) and deleted[uA]: uA += 1
+      return reloc.get(uA, len(reloc))
+
+    packed = []
+    for uA in range(len(words)):
+      if deleted[uA]: continue
+      uI = words[uA]
+      if _get_field(uI, UF_FLAGS2) in (FLAGS2_JSR, FLAGS2_TJSR):
+        self.uI = uI
+        self._set_jump_target(new_uA(_get_jump_target(uI)))
+        uI = self.uI
+      packed.append(uI)
+    self.uInstruction_list = packed
+    self.upc_counter = len(packed)
+
+    # Fill in the listing notes now that the final addresses are known.
+    for (lineno, note) in self.lineno_note_dict.items():
+      if "%" in note:
+        self.lineno_note_dict[lineno] = note % new_uA(alias[self.lineno_address_dict[lineno]])
+
+    for d in (self.label_address_dict, self.code_address_dict, self.instr_address_dict):
+      for key in d: d[key] = new_uA(d[key])
+    address_instr = {}
+    for (uA, instr) in sorted(self.address_instr_dict.items()):
+      uA = new_uA(uA)
+      if uA in address_instr: instr = address_instr[uA] + ", " + instr
+      address_instr[uA] = instr
+    self.address_instr_dict = address_instr
+    for d in (self.jump_src_dst_dict, self.jump_src_lineno_dict):
+      for uA in d.keys():
+        value = d.pop(uA)
+        if not deleted[uA]: d[reloc[uA]] = value
+    for (lineno, uA) in self.lineno_address_dict.items():
+      if uA < 0: continue
+      if deleted[uA]:
+        del self.lineno_address_dict[lineno]
+      else:
+        self.lineno_address_dict[lineno] = reloc[uA]
+    return reloc
+
+  def _report_fold_timing(self):
+    """Add the opcodes slowed down by tail folding JSRs to the optimization
+    report, with their cycle counts before and after folding.
+    """
+    rows = []
+    for row in self.instruction_timing():
+      jumps = len([uA for uA in row['path'] if uA in self.fold_jumps])
+      if jumps:
+        rows.append(row)
+        row['before'] = row['cycles'] - jumps
+    self.optimization_report.append(
+      "%d opcode paths slowed down by tail folding JSRs:" % len(rows))
+    for row in rows:
+      taken = {'T': " (taken)", 'N': " (not taken)"}.get(row['variant'], row['variant'])
+      self.optimization_report.append("  %02x  %-16s %d -> %d cycles%s" % (
+        row['opcode'], row['mnemonic'] or "", row['before'], row['cycles'], taken))
+
+  def _routine_name(self, uA):
+    """Name the code at uA for optimization reports: the closest __asm or 
+    label at or before uA, plus the source line of the uI.
+    """
+    names = [(a, "'%s'" % i) for (i, a) in self.instr_address_dict.items()]
+    names += [(a, "'%s'" % l) for (l, a) in self.label_address_dict.items()]
+    names = [n for n in names if n[0] <= uA]
+    name = max(names)[1] if names else "code"
+    return "%s (line %d)" % (name, self._uA_lineno.get(uA, 0))
 
 
   def _fill_unused_slots(self):
     """Fill any unused uI slots up to 0xff with 'NOP;NOP;#end's."""
 
     # We'll fill the slots with 'NOP;NOP;#end'
-    self.uI = ["0"] * 32
-    self._set_bits(UF_FLAGS2, "001")
+    self.uI = 0
+    self._set_bits(UF_FLAGS2, FLAGS2_END)
 
     while self.upc_counter < 256:
       self._emit()
 
   def _build_decoding_table(self):
     """Build 256-entry decoding table. 
-    One jump uI per opcode, starting at uA 0x100."""
+    One jump uI per opcode, starting at uA 0x100.
+    Each opcode is decoded by the most specific __code pattern that matches it,
+    i.e. the one with fewest wildcard bits. Patterns are compiled to (mask, 
+    value) pairs and the table is filled with the opcodes matching each of 
+    them, most specific first. Equally specific patterns that overlap on 
+    opcodes not claimed by a more specific pattern are ambiguous; the one 
+    defined first wins and a warning is issued.
+    """
+
+    patterns = []
+    for pattern in self.code_address_dict:
+      (mask, value) = self._compile_pattern(pattern)
+      wildcards = 8 - bin(mask).count("1")
+      patterns.append((wildcards, self.code_lineno_dict[pattern], pattern, mask, value))
+    patterns.sort()
 
     jump_table = [None] * 256
-    for opcode in range(256):
-      op_bin = self._int_to_bin(opcode, 8)
-      match_len = 1000
-      match_pattern = None
-      for pattern in self.code_address_dict.keys():
-        pat_len = self._match_pattern(pattern, op_bin)
-        if (pat_len != None) and (pat_len < match_len):
-          match_len = pat_len
-          match_pattern = pattern
-      if match_pattern != None:
-        #print op_bin, match_pattern, match_len
-        jump_table[opcode] = self.code_address_dict[match_pattern]
-        self.opcode_address_dict[opcode] = self.code_address_dict[match_pattern]
+    for (wildcards, lineno, pattern, mask, value) in patterns:
+      decoded = 0
+      for opcode in _pattern_opcodes(mask, value):
+        if jump_table[opcode] is None:
+          jump_table[opcode] = self.code_address_dict[pattern]
+          self.opcode_address_dict[opcode] = self.code_address_dict[pattern]
+          self.opcode_pattern_dict[opcode] = pattern
+          decoded += 1
+      if decoded == 0:
+        self.decode_shadowed.append(pattern)
+        self._warning("CPU opcode pattern '%s' is shadowed by other patterns" % pattern, lineno)
+
+    # Find all pairs of patterns competing for some opcodes. The first of each
+    # pair wins; flag the pairs where it does so only by source order.
+    for (i, p1) in enumerate(patterns):
+      for p2 in patterns[i+1:]:
+        if (p1[4] ^ p2[4]) & p1[3] & p2[3]: continue
+        shared = [op for op in _pattern_opcodes(p1[3] | p2[3], p1[4] | p2[4]) 
+                  if self.opcode_pattern_dict[op] == p1[2]]
+        if not shared: continue
+        ambiguous = (p1[0] == p2[0])
+        self.decode_overlaps.append((p1[2], p2[2], len(shared), ambiguous))
+        if ambiguous:
+          emsg = "CPU opcode pattern '%s' is ambiguous with '%s' in line %d" % (p2[2], p1[2], p1[1])
+          self._warning(emsg, p2[1])
 
     # Ok, we have the table of target addresses. Now emit one JSR uI per entry.
     for i in range(len(jump_table)):
       if jump_table[i] != None:
-        self.uI = ["0"]*32
-        self._set_bits(UF_FLAGS2, "010")
-        target_bin = self._int_to_bin(jump_table[i], 8)
-        self._set_bits(UF_JUMP_DST_L, target_bin[2:])
-        self._set_bits(UF_JUMP_DST_H, target_bin[0:2])
+        self.uI = 0
+        self._set_bits(UF_FLAGS2, FLAGS2_JSR)
+        self._set_jump_target(jump_table[i])
         
       else:
         # Unused opcode. JSR to zero, ending instruction.
-        self.uI = "00001000000000000000000000000000"
+        self.uI = 0
+        self._set_bits(UF_FLAGS2, FLAGS2_JSR)
       self._emit()
 
-  def _match_pattern(self, pat1, pat2):
-    """ """
-
-    ctr = 0
-    for i in range(8):
-      if pat1[i]=='1' and pat2[i] == '1':
-        pass
-      elif pat1[i]=='0' and pat2[i] == '0':
-        pass
-      elif (pat1[i] not in ['0','1']):
-        ctr += 1
-      else:
-        return None
-
-    return ctr
-
-
-  def _int_to_bin(self, value, width):
-    """Convert in value into binary string, MSB left as usual."""
-
-    if value < 0: self._syntax_error("BUG! invalid binary value conversion")
+  def _compile_pattern(self, pattern):
+    """Compile opcode pattern into (mask, value) integer pair. 
+    Bits other than '0' and '1' in the pattern are wildcards.
+    """
+    mask = 0
+    value = 0
+    for c in pattern:
+      mask = (mask << 1) | (c in "01")
+      value = (value << 1) | (c == "1")
+    return (mask, value)
+
+  def build_decode_report(self, report_filename=None):
+    """Write opcode decoder report to file unless file is None.
+    The report lists each __code pattern with the opcodes it decodes, the 
+    overlaps between patterns and the opcodes not decoded by any pattern.
+    """
 
-    original = value
-    bin = ""
-    mask = 1
-    for i in range(width):
-      if (mask & value) != 0:
-        bin = "1"+bin
-        value = value & ~(mask)
+    if not report_filename: return
+
+    report = "Opcode decoder report for '%s'.\n\n" % self.srcfile
+    report += "PATTERNS, MOST SPECIFIC FIRST:\n"
+    report += "%-5s  %-8s  %-3s  %-7s  %s\n" % ("line", "pattern", "uA", "opcodes", "instruction")
+    counts = {}
+    for pattern in self.opcode_pattern_dict.values():
+      counts[pattern] = counts.get(pattern, 0) + 1
+    patterns = sorted(self.code_address_dict.keys(), 
+      key=lambda p: (-bin(self._compile_pattern(p)[0]).count("1"), self.code_lineno_dict[p]))
+    for pattern in patterns:
+      uA = self.code_address_dict[pattern]
+      matching = 1 << (8 - bin(self._compile_pattern(pattern)[0]).count("1"))
+      report += "%5d  %-8s  %03x  %3d/%-3d  %s\n" % (self.code_lineno_dict[pattern], 
+        pattern, uA, counts.get(pattern, 0), matching, self.address_instr_dict.get(uA, ""))
+
+    report += "\nOVERLAPPING PATTERNS (first one decodes the shared opcodes):\n"
+    for (p1, p2, shared, ambiguous) in self.decode_overlaps:
+      if ambiguous: 
+        verb = "is AMBIGUOUS with"
       else:
-        bin = "0"+bin
-      mask = mask << 1
+        verb = "overrides"
+      report += "%s (line %d) %s %s (line %d) on %d opcode(s)\n" % (p1, 
+        self.code_lineno_dict[p1], verb, p2, self.code_lineno_dict[p2], shared)
 
-    if value != 0:
-      self._syntax_error("BUG! binary conversion out of range")
+    report += "\nSHADOWED PATTERNS:\n"
+    for pattern in self.decode_shadowed:
+      report += "%s (line %d)\n" % (pattern, self.code_lineno_dict[pattern])
 
-    return bin
+    undecoded = [op for op in range(256) if op not in self.opcode_address_dict]
+    report += "\nUNDECODED OPCODES (%d):\n" % len(undecoded)
+    for i in range(0, len(undecoded), 16):
+      report += " ".join(["%02x" % op for op in undecoded[i:i+16]]) + "\n"
 
+    _write_file(report_filename, report)
 
   def _syntax_error(self, msg, src=None, quit=True):
-    """Print error message to stdout and optionally quit."""
-    if src == None: src = self.lineno
-    print >> sys.stderr, self.source[src-1].rstrip()
-    emsg = "%s:%d:error:%s." % (self.srcfile, src, msg)
-    print >> sys.stderr, emsg
-
+    """Record error message, print it to stderr if verbose.
+    Unless quit is False, raise SyntaxError to abandon the line.
+    """
+    emsg = self._diagnostic('error', msg, src)
     if quit: raise SyntaxError(emsg)
 
+  def _warning(self, msg, src=None):
+    """Record warning message, print it to stderr if verbose."""
+    self._diagnostic('warning', msg, src)
+
+  def _diagnostic(self, severity, msg, src):
+    """Append diagnostic for source line src (default: current line) to the
+    list and print it if verbose. Return the formatted message.
+    """
+    if src == None: src = self.lineno
+    line = self.source[src-1].rstrip() if 0 < src <= len(self.source) else ""
+    diagnostic = Diagnostic(severity, self.srcfile, src, msg, line)
+    self.diagnostics.append(diagnostic)
+    if self.verbose:
+      print >> sys.stderr, line
+      print >> sys.stderr, diagnostic
+    return str(diagnostic)
+
+  def _error_count(self):
+    """Number of errors found so far."""
+    return len([d for d in self.diagnostics if d.severity == 'error'])
+
   def _quit(self, msg):
     """Raise syntax error exception, print raw message to stderr."""
     print >> sys.stderr, msg
     raise SyntaxError(msg)
 
 
+def _get_field(uI, field):
+  """Return value of uI field."""
+  (shift, mask) = UF_SHIFT_MASK[field]
+  return (uI & mask) >> shift
+
+
+def _get_jump_target(uI):
+  """Return jump target uA of JSR/TJSR uI."""
+  return (_get_field(uI, UF_JUMP_DST_H) << 6) | _get_field(uI, UF_JUMP_DST_L)
+
+
+def _falls_through(uI):
+  """True if the uI may be followed by the next one in the ROM, right away or
+  after returning from a JSR/TJSR.
+  """
+  if _get_field(uI, UF_FLAGS2) in (FLAGS2_END, FLAGS2_RET): return False
+  return _get_field(uI, UF_FLAGS1) not in (FLAGS1_DECODE, FLAGS1_HALT)
+
+
+def _resolve(alias, uA):
+  """Follow chain of uA aliases to the final one."""
+  while uA in alias: uA = alias[uA]
+  return uA
+
+
+def _pattern_opcodes(mask, value):
+  """Yield all the 8-bit opcodes matching (mask, value) pattern, in order."""
+  free = ~mask & 0xff
+  sub = 0
+  while True:
+    yield value | sub
+    if sub == free: break
+    # Next subset of the wildcard bits.
+    sub = ((sub | mask) + 1) & free
+
+
+def _write_file(filename, text):
+  """Write text to file unless the file already has that very content.
+  Leaving an unchanged file alone preserves its mtime so that the HDL tools
+  downstream don't need to re-analyze it.
+  """
+  try:
+    with open(filename, 'r') as f:
+      if f.read() == text: return
+  except IOError:
+    pass
+  with open(filename, 'w') as f:
+    f.write(text)
+
+
+def _open_temp(filename):
+  """Create a temporary file next to filename, to be renamed over it later.
+  The name is unique so that concurrent runs (build_sw.py's thread pool,
+  parallel make) don't write the same temporary file. The file gets the
+  permissions a plain open() would give it, not mkstemp's private ones.
+  Return (file object open for writing, temporary file name).
+  """
+  (fd, tmp_filename) = tempfile.mkstemp(dir=os.path.dirname(filename) or ".",
+                                        prefix=os.path.basename(filename) + ".",
+                                        suffix=".tmp")
+  umask = os.umask(0)
+  os.umask(umask)
+  os.fchmod(fd, 0o666 & ~umask)
+  return (os.fdopen(fd, 'w'), tmp_filename)
+
+
+def _write_output(filename, write):
+  """Write file through function write(fo), streaming it to a temporary file
+  which only replaces the file if their contents differ, see _write_file.
+  """
+  (fo, tmp_filename) = _open_temp(filename)
+  try:
+    with fo:
+      write(fo)
+  except:
+    if os.path.isfile(tmp_filename): os.remove(tmp_filename)
+    raise
+  if os.path.isfile(filename) and filecmp.cmp(tmp_filename, filename, shallow=False):
+    os.remove(tmp_filename)
+  else:
+    os.rename(tmp_filename, filename)
+
+
+def _file_digest(filename):
+  """Return SHA-1 hex digest of file contents or None if it can't be read."""
+  try:
+    with open(filename, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  except IOError:
+    return None
+
+
+def _cache_key(srcfile, options, outputs):
+  """Compute build cache key for an assembly run.
+  The key covers the microcode source, this script (which stands for the tool
+  version) and the options and output file names, which affect the output.
+  """
+  script = os.path.abspath(__file__)
+  if script.endswith(".pyc"): script = script[:-1]
+  h = hashlib.sha1()
+  for filename in [script, srcfile]:
+    h.update("%s\n" % _file_digest(filename))
+  h.update("format=%s\n" % options.format)
+  h.update("optimize=%s\n" % options.optimize)
+  h.update("fold_jsr=%s\n" % options.fold_jsr)
+  h.update("narrow=%s\n" % options.narrow)
+  h.update("compact=%s\n" % options.compact)
+  for filename in outputs:
+    h.update("output=%s\n" % ntpath.basename(filename))
+  return h.hexdigest()
+
+
+def _load_cache(cache_filename):
+  """Load build cache from file. A missing or corrupt cache is empty."""
+  try:
+    with open(cache_filename, 'r') as f:
+      cache = json.load(f)
+  except (IOError, ValueError):
+    return {}
+  return cache if isinstance(cache, dict) else {}
+
+
+def _save_cache(cache_filename, cache):
+  """Save build cache to file, replacing the old one atomically."""
+  (f, tmp_filename) = _open_temp(cache_filename)
+  try:
+    with f:
+      json.dump(cache, f, indent=1, sort_keys=True)
+  except:
+    os.remove(tmp_filename)
+    raise
+  os.rename(tmp_filename, cache_filename)
+
+
+def _cache_hit(cache, outputs, key):
+  """True if all outputs were built with this key and are untouched since."""
+  for filename in outputs:
+    entry = cache.get(os.path.abspath(filename))
+    if not entry or entry.get('key') != key: return False
+    if _file_digest(filename) != entry.get('digest'): return False
+  return True
+
+
 def _parse_command_line():
   """Get cmd line params."""
   parser = optparse.OptionParser(usage='%prog [options] <source file> <output file>')
   parser.add_option("-l", dest="listing", default=None,
                   help="write listing to FILE.", metavar="FILE")
+  parser.add_option("-O", dest="optimize", action="store_true", default=False,
+                  help="optimize microcode: fold identical tails, remove dead code.")
+  parser.add_option("--fold-jsr", dest="fold_jsr", action="store_true", default=False,
+                  help="with -O, fold tails through JSRs too; costs a cycle per fold.")
+  parser.add_option("-u", dest="utilization", default=None,
+                  help="write field and bit utilization report to FILE.", metavar="FILE")
+  parser.add_option("-n", "--narrow", dest="narrow", action="store_true", default=False,
+                  help="leave constant bits out of the VHDL microcode table.")
+  parser.add_option("-t", dest="timing", default=None,
+                  help="write per-opcode timing table to FILE (JSON or .csv).", metavar="FILE")
+  parser.add_option("-x", dest="index", default=None,
+                  help="write cross-reference index to FILE (JSON).", metavar="FILE")
+  parser.add_option("-d", dest="decode_report", default=None,
+                  help="write opcode decoder report to FILE.", metavar="FILE")
   parser.add_option("-f",
-                  dest="format", default="VHDL", choices=["VHDL","Verilog"],
-                  help="microcode table format. VHDL or Verilog.")
+                  dest="format", default="VHDL", 
+                  choices=["VHDL","Verilog","memh","memb"],
+                  help="microcode table format. VHDL, Verilog, memh or memb.")
+  parser.add_option("-D", dest="compact", action="store_true", default=False,
+                  help="compact decoding table: opcode class ROM and entry table "
+                       "instead of a JSR per opcode (VHDL only).")
+  parser.add_option("-c", "--cache", dest="cache", default=None,
+                  help="build cache FILE. Outputs built before from the same "
+                       "source and options are left untouched.", metavar="FILE")
 
   (options, args) = parser.parse_args()
   if len(args) < 2:
     print >> sys.stderr, "error: missing input and/or output file name(s)"
     parser.print_help()
     sys.exit(1)
+  if options.fold_jsr and not options.optimize:
+    print >> sys.stderr, "error: --fold-jsr needs -O"
+    sys.exit(1)
+  if options.compact and options.format != "VHDL":
+    print >> sys.stderr, "error: compact decoding table is only available in VHDL"
+    sys.exit(1)
   return (options, args)
 
 
@@ -723,9 +1795,60 @@ def _main():
     (options, filenames) = _parse_command_line()
 
     srcfile = filenames[0]
-    rom = uCodeROM(srcfile)
-    rom.build_vhdl_package(filenames[1])
+    outputs = [filenames[1]]
+    if options.listing: outputs.append(options.listing)
+    if options.index: outputs.append(options.index)
+    if options.decode_report: outputs.append(options.decode_report)
+    if options.utilization: outputs.append(options.utilization)
+    if options.timing: outputs.append(options.timing)
+
+    # Don't even assemble the source if the outputs are up to date.
+    if options.cache:
+      cache = _load_cache(options.cache)
+      key = _cache_key(srcfile, options, outputs)
+      if _cache_hit(cache, outputs, key): return
+
+    try:
+      rom = uCodeROM(srcfile, 2 if options.fold_jsr else options.optimize)
+    except IOError as e:
+      print >> sys.stderr, e
+      sys.exit(e.errno)
+    except SyntaxError as e:
+      # Error messages have already been output to stderr, add a summary.
+      print >> sys.stderr, e
+      sys.exit(22)
+    for line in rom.optimization_report:
+      print line
+    if options.format == "Verilog":
+      rom.build_verilog_include(filenames[1])
+    elif options.format in ("memh", "memb"):
+      rom.build_mem_file(filenames[1], options.format[-1])
+    else:
+      rom.build_vhdl_package(filenames[1], options.narrow, options.compact)
+    if options.compact:
+      if options.narrow:
+        compact = rom.compact_decoding(bin(rom.constant_bits(256)[0]).count("1"),
+                                       bin(rom.constant_bits()[0]).count("1"))
+      else:
+        compact = rom.compact_decoding()
+      print "Compact decoding table: %d opcode classes, %d-bit class ROM." % (
+        len(compact['entries']), compact['class_bits'])
+      print "ROM bits: %d with the decoding table, %d compacted (%d saved)." % (
+        compact['bits_before'], compact['bits_after'], 
+        compact['bits_before'] - compact['bits_after'])
     rom.build_listing(options.listing)
+    rom.build_index(options.index)
+    rom.build_decode_report(options.decode_report)
+    rom.build_utilization_report(options.utilization)
+    rom.build_timing_table(options.timing)
+
+    if options.cache:
+      for filename in outputs:
+        cache[os.path.abspath(filename)] = {
+          'key': key, 
+          'digest': _file_digest(filename)
+        }
+      _save_cache(options.cache, cache)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,779 @@
+#!/usr/bin/env python
+################################################################################
+# ucode_compile.py : light8080 microcode to Python translator
+################################################################################
+# Usage: ucode_compile.py [options] <module file>
+#
+# Translates the microcode assembled by ucode_asm.py into a Python module with
+# one straight-line function per 8080 opcode. Each function runs all the clock
+# cycles of its opcode, from the decode table entry at uA 100h+opcode through
+# the JSRs and #rets of the microcode to the #decode of the next opcode fetch,
+# with the same register bank, T1/T2, flag and bus semantics as the cycle by
+# cycle model of ucode_sim.py. The only branches left are on the flag
+# condition tested by TJSR.
+#
+# Options:
+#
+# -m FILE     : Microcode source file. Defaults to src/ucode/light8080.m80.
+# -O          : Optimize microcode as ucode_asm.py -O does before translating.
+# -h, --help  : Show help, quit.
+#
+# The module is meant to be run by CompiledSimulator, which can stand in for
+# ucode_sim.Simulator; ucode_sim.py -x translates the microcode and runs it
+# that way.
+#
+################################################################################
+# The translator runs the model of ucode_sim.Simulator.step symbolically: all
+# the uI fields, the pipelined field 2 and the IR are known while translating
+# an opcode, so every sequencer and ALU mux decision is taken at translation
+# time and only the data path is left, as assignments to single-assignment
+# locals. The register bank is held in locals too, since all its addresses
+# come from the uI or the IR.
+# Assignments whose values are never used are dropped, and so are the loads
+# and stores of the registers (T1, T2, DO, flags...) that no opcode reads
+# before writing. Values used once are folded into the expression using them.
+################################################################################
+
+import sys
+import os
+import re
+import imp
+import hashlib
+import optparse
+
+import ucode_asm
+from ucode_asm import _get_field, UF_FLAGS1, UF_FLAGS2, UF_LD_AL, UF_LD_ADDR
+from ucode_asm import UF_LD_T1, UF_LD_T2, UF_MUX_IN, UF_RB_ADDR_SEL, UF_RB_ADDR
+from ucode_asm import FLAGS1_DECODE, FLAGS1_IO, FLAGS1_AUXCY, FLAGS1_HALT
+from ucode_asm import FLAGS2_END, FLAGS2_JSR, FLAGS2_RET, FLAGS2_TJSR
+from ucode_asm import FLAGS2_RD, FLAGS2_WR, FLAGS2_SETACY, FETCH_UA
+from ucode_sim import FLAGS1_CLRT1, HALT_UA, RB_F, RB_NAMES, PARITY
+from ucode_sim import F2_DO_CY_OP, F2_DO_CPC, F2_CLR_T2, F2_CLR_T1
+from ucode_sim import F2_SET_AUX, F2_USE_AUX, F2_RB_ADDR, F2_CLR_ACY
+from ucode_sim import F2_LOAD_DO, F2_WE_RB, FLAG_S, FLAG_Z, FLAG_AC, FLAG_P
+from ucode_sim import FLAG_C, FLAG_CONST, MAX_CYCLES
+
+# uA the core starts at when reset is released.
+RESET_UA = 1
+
+# Index of the reset function in the OPCODES table of a translated module.
+RESET = 0x100
+
+# Core registers other than the register bank, as named in the generated code
+# and in the state object.
+SCALARS = ['t1', 't2', 'do', 'di', 'al', 'flags', 'aux', 'cond', 'daa']
+
+# Registers kept in the state object whether or not the code reads them.
+ALWAYS_STORED = ['flags']
+
+# Register values when reset is released, as set by Simulator.reset.
+RESET_STATE = dict([("r%d" % i, 0) for i in range(16)] +
+                   [(r, 0) for r in SCALARS] +
+                   [('flags', FLAG_CONST), ('aux', 1)])
+
+# Register values #decode leaves for the first cycle of every opcode.
+DECODE_STATE = {'t1': 0, 't2': 0, 'aux': 1}
+
+# Longest uI sequence a single opcode may take.
+MAX_PATH = 1024
+
+# Generated code names a value is looked up as a local; everything else in an
+# expression is a parameter or a module global.
+_LOCAL_RE = re.compile(r"\bv\d+\b")
+
+# Names of the function parameters expressions may use.
+_RUNTIME_RE = re.compile(r"\b(mem|mask|io_read|io_write)\b")
+
+
+class CompileError(Exception):
+  """Microcode the translator can't handle."""
+  pass
+
+
+class _Block(object):
+  """Straight-line code ending either in a TJSR branch or a function exit.
+  Each statement is [target, expr, reads, pure, needed]; target is None for
+  statements run for their side effects.
+  """
+
+  def __init__(self):
+    self.code = []
+    self.cond = None
+    self.taken = None
+    self.not_taken = None
+    self.exit = None
+
+
+class _Exit(object):
+  """End of a path: the register values at that point and what to return."""
+
+  def __init__(self, entry, env, cycles, fetch, next_op, halt):
+    self.entry = entry
+    self.env = env
+    self.cycles = cycles
+    self.fetch = fetch
+    self.next_op = next_op
+    self.halt = halt
+
+  def stores(self, live_out):
+    """(register, value) list of the registers the caller must see updated."""
+    stores = []
+    for name in _REGISTERS:
+      value = self.env[name]
+      if value == self.entry[name]: continue
+      if name in live_out or name.startswith("r"):
+        stores.append((name, value))
+    return stores
+
+
+_REGISTERS = ["r%d" % i for i in range(16)] + SCALARS
+
+
+class Translator(object):
+  """Translates a microcode ROM (the uI table of ucode_asm.uCodeROM) into the
+  source of a Python module.
+  """
+
+  def __init__(self, uinstructions):
+    self.rom = list(uinstructions)
+    self.count = 0
+    self.inverted = {}
+    self.block = None
+    self.ir = 0
+
+  def translate(self, name="<microcode>"):
+    """Return the source of the module as a string."""
+    functions = [self._function(RESET_UA, 0, 0, 0, RESET_STATE)]
+    for opcode in range(256):
+      functions.append(self._function(0x100 | opcode, self._decode_field2(),
+                                      None, opcode, DECODE_STATE))
+
+    # Only registers some function reads before writing need to be passed
+    # from one function to the next; find them as a fixed point.
+    live_out = set(ALWAYS_STORED)
+    while True:
+      live_in = set(live_out)
+      for block in functions:
+        live_in |= self._liveness(block, live_out) & set(SCALARS)
+      if live_in == live_out: break
+      live_out = live_in
+    self.live_out = live_out
+
+    lines = [
+      "# Generated by ucode_compile.py from %s -- do not edit." % name,
+      "",
+      "UCODE_DIGEST = %r" % microcode_digest(self.rom),
+      "",
+      "STATE = %r" % [r for r in SCALARS if r in live_out],
+      "",
+      "PARITY = %r" % PARITY,
+      ""]
+    bodies = {}
+    table = []
+    for index, block in enumerate(functions):
+      fname = "reset" if index == 0 else "op_%02x" % (index - 1)
+      body = tuple(self._function_body(block))
+      if body in bodies:
+        table.append(bodies[body])
+        continue
+      bodies[body] = fname
+      table.append(fname)
+      lines.append("")
+      lines.append("def %s(rb, mem, mask, st, io_read, io_write):" % fname)
+      lines.extend(body)
+      lines.append("")
+    lines.append("")
+    lines.append("OPCODES = [")
+    for i in range(1, 257, 8):
+      lines.append("    " + " ".join("%s," % f for f in table[i:i + 8]))
+    lines.append("    reset]")
+    return "\n".join(lines) + "\n"
+
+  def _decode_field2(self):
+    """Field 2 of the #decode uI, pipelined into the first cycle of every
+    opcode. Its RB address can't depend on the IR of the previous opcode.
+    """
+    uI = self.rom[FETCH_UA + 2]
+    if _get_field(uI, UF_FLAGS1) != FLAGS1_DECODE:
+      raise CompileError("uA %d is not the #decode uI" % (FETCH_UA + 2))
+    if _get_field(uI, UF_RB_ADDR_SEL) != 0:
+      raise CompileError("the #decode uI must not address the RB with the IR")
+    return self._field2(uI, _get_field(uI, UF_RB_ADDR))
+
+  def _function(self, uA, f2, ret, ir, known):
+    """Translate the path from uA with the given pipelined field 2, return
+    address and IR into a tree of blocks. known has the registers whose
+    values are known at uA."""
+    self.ir = ir
+    root = _Block()
+    env = dict((r, r) for r in _REGISTERS)
+    env.update(known)
+    self.entry = env
+    self._path(root, env, uA, f2, ret, 0, None)
+    return root
+
+  def _path(self, block, env, uA, f2, ret, cycles, fetch):
+    """Translate cycles from uA on into block until the path ends or forks."""
+    ir = self.ir
+    while True:
+      if cycles >= MAX_PATH:
+        raise CompileError("opcode %02Xh: uI sequence doesn't end" % ir)
+      self.block = block
+      uI = self.rom[uA]
+      uc_addr = uA & 0xff
+      flags1 = _get_field(uI, UF_FLAGS1)
+      flags2 = _get_field(uI, UF_FLAGS2)
+      uc_decode = flags1 == FLAGS1_DECODE
+      uc_halt = flags1 == FLAGS1_HALT
+
+      # Operation 1.
+      rb_addr_sel = _get_field(uI, UF_RB_ADDR_SEL)
+      ra_field = _get_field(uI, UF_RB_ADDR)
+      if rb_addr_sel == 0:
+        rd_addr = ra_field
+      elif rb_addr_sel == 1:
+        rd_addr = ir & 7
+      elif rb_addr_sel == 2:
+        rd_addr = (ir >> 3) & 7
+      else:
+        p_field = (ir >> 4) & 3
+        rd_addr = (8 if p_field == 3 else 0) | (p_field << 1) | (ra_field & 1)
+      rbank_data = env["r%d" % rd_addr]
+      addr_out = self._op("(%s << 8) | %s", rbank_data, env["al"])
+      alu_input = rbank_data if _get_field(uI, UF_MUX_IN) else env["di"]
+
+      new = self._alu(env, f2)
+
+      # Condition selected by IR ddd field; registered.
+      cond_sel = (ir >> 3) & 7
+      cond_flag = [FLAG_Z, FLAG_C, FLAG_P, FLAG_S][cond_sel >> 1]
+      if cond_sel & 1:
+        new["cond"] = self._op("1 if %s & " + str(cond_flag) + " else 0",
+                               env["flags"])
+      else:
+        new["cond"] = self._op("0 if %s & " + str(cond_flag) + " else 1",
+                               env["flags"])
+
+      # Bus cycle.
+      vma = _get_field(uI, UF_LD_ADDR)
+      io = flags1 == FLAGS1_IO
+      if vma and uc_addr < 16:
+        if fetch is not None:
+          raise CompileError("opcode %02Xh: more than one fetch" % ir)
+        fetch = addr_out
+      if io and flags2 == FLAGS2_RD:
+        new["di"] = self._op("io_read(%s & 0xff)", addr_out, pure=False)
+      else:
+        new["di"] = self._op("mem[%s & mask]", addr_out)
+      if flags2 == FLAGS2_WR:
+        if io:
+          self._op("io_write(%s & 0xff, %s)", addr_out, env["do"],
+                   statement=True)
+        else:
+          self._op("mem[%s & mask] = %s", addr_out, env["do"], statement=True)
+
+      # Clock edge.
+      if uc_decode or (f2 >> F2_CLR_T1) & 1:
+        new["t1"] = 0
+      elif _get_field(uI, UF_LD_T1):
+        new["t1"] = alu_input
+      if uc_decode or (f2 >> F2_CLR_T2) & 1:
+        new["t2"] = 0
+      elif _get_field(uI, UF_LD_T2):
+        new["t2"] = alu_input
+      if uc_decode:
+        new["aux"] = 1
+      if _get_field(uI, UF_LD_AL):
+        new["al"] = rbank_data
+      old_di = env["di"]
+      env = dict(env)
+      env.update(new)
+      next_f2 = self._field2(uI, rd_addr)
+      cycles += 1
+
+      if uc_halt:
+        block.exit = _Exit(self.entry, env, cycles, fetch, None, True)
+        return
+
+      # Sequencer: TJSR forks the path on the registered condition.
+      if flags2 == FLAGS2_TJSR:
+        outcomes = [(1, self._next(uI, uc_addr, ret, 1)),
+                    (0, self._next(uI, uc_addr, ret, 0))]
+        cond = env["cond"]
+        if not isinstance(cond, str):
+          outcomes = [o for o in outcomes if o[0] == cond]
+      else:
+        outcomes = [(None, self._next(uI, uc_addr, ret, 0))]
+      if len(outcomes) == 2:
+        block.cond = env["cond"]
+        block.taken = _Block()
+        block.not_taken = _Block()
+        self._fork(block.taken, env, outcomes[0][1], next_f2, cycles, fetch,
+                   old_di)
+        self._fork(block.not_taken, env, outcomes[1][1], next_f2, cycles,
+                   fetch, old_di)
+        return
+      (next_uA, ret) = outcomes[0][1]
+      if next_uA is None:
+        block.exit = _Exit(self.entry, env, cycles, fetch, old_di, False)
+        return
+      uA = next_uA
+      f2 = next_f2
+
+  def _fork(self, block, env, target, f2, cycles, fetch, old_di):
+    (next_uA, ret) = target
+    if next_uA is None:
+      block.exit = _Exit(self.entry, env, cycles, fetch, old_di, False)
+    else:
+      self._path(block, env, next_uA, f2, ret, cycles, fetch)
+
+  def _next(self, uI, uc_addr, ret, condition):
+    """(next uA, return address) after uI, or (None, None) for #decode.
+    Same priority as the RTL select as in ucode_sim.Simulator.step.
+    """
+    flags1 = _get_field(uI, UF_FLAGS1)
+    flags2 = _get_field(uI, UF_FLAGS2)
+    uc_tjsr = flags2 == FLAGS2_TJSR
+    uc_do_ret = flags2 == FLAGS2_RET
+    uc_do_jmp = flags2 == FLAGS2_JSR or (uc_tjsr and condition)
+    uc_decode = flags1 == FLAGS1_DECODE
+    uc_end = flags2 == FLAGS2_END or (uc_tjsr and not condition)
+    uc_halt = flags1 == FLAGS1_HALT
+    if uc_do_jmp:
+      ret = (uc_addr + 1) & 0xff
+
+    sel = (uc_do_ret, bool(uc_do_jmp), uc_decode, uc_end)
+    if sel == (True, False, False, False):
+      if ret is None:
+        raise CompileError("opcode %02Xh: #ret before any JSR" % self.ir)
+      return (ret, ret)
+    elif sel == (False, True, False, False):
+      return (ucode_asm._get_jump_target(uI), ret)
+    elif sel == (False, False, False, False):
+      return ((uc_addr + 1) & 0xff, ret)
+    elif sel == (False, False, False, True):
+      return (HALT_UA if uc_halt else FETCH_UA, ret)
+    elif uc_decode:
+      return (None, None)
+    raise CompileError("opcode %02Xh: uI at uA %d jumps to data_in without "
+                       "#decode" % (self.ir, uc_addr))
+
+  def _field2(self, uI, rd_addr):
+    flags1 = _get_field(uI, UF_FLAGS1)
+    flags2 = _get_field(uI, UF_FLAGS2)
+    return (
+      ((uI >> 2) & 0xf == 0b1011) << F2_DO_CY_OP |
+      (uI & 1) << F2_DO_CPC |
+      (flags2 == FLAGS2_END) << F2_CLR_T2 |
+      (flags1 == FLAGS1_CLRT1) << F2_CLR_T1 |
+      (flags2 == FLAGS2_SETACY) << F2_SET_AUX |
+      (flags1 == FLAGS1_AUXCY) << F2_USE_AUX |
+      rd_addr << F2_RB_ADDR |
+      (uI & 0x7fff))
+
+  def _alu(self, env, f2):
+    """Operation 2 of the uI f2 was taken from: ALU, flags, RB and DO
+    writes. Return the registers it updates at the clock edge."""
+    op = self._op
+    ir = self.ir
+    t1 = env["t1"]
+    t2 = env["t2"]
+    flags = env["flags"]
+    cy = op("%s & 1", flags)
+    new = {}
+
+    alu_fn = f2 & 3
+    use_logic = f2 & 4
+    mux_fn = (f2 >> 3) & 3
+    alu_op6 = f2 & 0x3f
+    do_daa = (f2 >> 2) & 0xf == 0b1010
+    use_psw = (f2 >> 4) & 3 == 3
+    clr_acy = (f2 >> F2_CLR_ACY) & 1
+
+    aux_cy_in = 1 if (f2 >> F2_SET_AUX) & 1 else env["aux"]
+    cy_in = aux_cy_in if (f2 >> F2_USE_AUX) & 1 else cy
+    cy_in_gated = cy_in if alu_fn & 1 else 0
+    if alu_fn & 2:
+      op2_sgn = op("0x100 | (~%s & 0xff)", t1)
+      cy_in_sgn = op("%s ^ 1", cy_in_gated)
+    else:
+      op2_sgn = t1
+      cy_in_sgn = cy_in_gated
+    terms = [v for v in (t2, op2_sgn, cy_in_sgn) if v != 0] or [0]
+    arith_res = op("(%s) & 0x1ff" % " + ".join(["%s"] * len(terms)), *terms)
+    cy_adder = op("%s >> 8", arith_res)
+
+    # DAA adjustment is computed every cycle and registered.
+    low_gt9 = op("1 if (%s & 0x0f) > 9 else 0", t1)
+    high = op("%s >> 4", t1)
+    adjust_low = op("6 if %s or %s & " + str(FLAG_AC) + " else 0",
+                    low_gt9, flags)
+    adjust_high = op("0x60 if %s > 9 or %s or (%s == 9 and %s) else 0",
+                     high, cy, high, low_gt9)
+    new["daa"] = op("(%s + (%s | %s)) & 0x1ff", t1, adjust_low, adjust_high)
+    if do_daa:
+      arith_daa_res = op("%s & 0xff", env["daa"])
+      cy_arith = op("1 if %s or %s else 0", cy, low_gt9)
+    else:
+      arith_daa_res = op("%s & 0xff", arith_res)
+      cy_arith = cy_adder
+
+    if alu_fn == 0:
+      logic_res = op("%s & %s", t1, t2)
+    elif alu_fn == 1:
+      logic_res = op("%s ^ %s", t1, t2)
+    elif alu_fn == 2:
+      logic_res = op("%s | %s", t1, t2)
+    else:
+      logic_res = self._not(t1)
+
+    if alu_fn & 1:
+      bit7 = op("%s & 1", t1) if alu_fn == 1 else cy_in
+      shift_res = op("(%s >> 1) | (%s << 7)", t1, bit7)
+      cy_shifter = op("%s & 1", t1)
+    else:
+      bit0 = op("%s >> 7", t1) if alu_fn == 0 else cy_in
+      shift_res = op("((%s << 1) & 0xfe) | %s", t1, bit0)
+      cy_shifter = op("%s >> 7", t1)
+
+    alu_mux1 = logic_res if use_logic else shift_res
+    if mux_fn == 0:
+      alu_output = alu_mux1
+    elif mux_fn == 1:
+      alu_output = arith_daa_res
+    elif mux_fn == 2:
+      alu_output = self._not(alu_mux1)
+    else:
+      alu_output = ir & 0x38
+
+    # Flags.
+    set_ac = clr_acy and alu_op6 == 0b000100
+    clear_ac = clr_acy and not set_ac
+    if set_ac and not do_daa:
+      flag_ac = op("((%s | %s) & 0x08) << 1", t1, t2)
+    elif clear_ac:
+      flag_ac = 0
+    elif do_daa:
+      flag_ac = op("%d if %%s else 0" % FLAG_AC, low_gt9)
+    else:
+      flag_ac = op("(%s ^ %s ^ %s) & " + str(FLAG_AC), t2, op2_sgn, alu_output)
+    if (f2 >> F2_DO_CY_OP) & 1:
+      flag_cy = 1 if (f2 >> F2_DO_CPC) & 1 else op("%s ^ 1", cy)
+    elif clr_acy:
+      flag_cy = 0
+    elif use_logic:
+      flag_cy = cy_arith
+    else:
+      flag_cy = cy_shifter
+
+    we_rb = (f2 >> F2_WE_RB) & 1
+    rbank_wr_addr = (f2 >> F2_RB_ADDR) & 0xf
+    load_psw = we_rb and rbank_wr_addr == RB_F
+    flag_pattern = (f2 >> 8) & 3
+    if flag_pattern & 2:
+      if load_psw:
+        new_flags = op("%s & " + str(FLAG_S | FLAG_Z | FLAG_AC | FLAG_P),
+                       alu_output)
+      else:
+        new_flags = op("(%s & %d) | (%d if %s == 0 else 0) | %s | PARITY[%s]",
+                       alu_output, FLAG_S, FLAG_Z, alu_output, flag_ac,
+                       alu_output)
+      flags = op("(%s & 1) | %s | " + str(FLAG_CONST), flags, new_flags)
+    if flag_pattern & 1:
+      new_c = op("%s & 1", alu_output) if load_psw else flag_cy
+      flags = op("(%s & 0xfe) | %s", flags, new_c)
+
+    if we_rb:
+      new["r%d" % rbank_wr_addr] = alu_output
+    if (f2 >> F2_LOAD_DO) & 1:
+      new["do"] = flags if use_psw else alu_output
+    new["aux"] = cy_adder
+    new["flags"] = flags
+    return new
+
+  def _not(self, value):
+    """Complement of a byte; complementing it back gives the byte itself."""
+    if value in self.inverted:
+      return self.inverted[value]
+    result = self._op("~%s & 0xff", value)
+    if isinstance(result, str):
+      self.inverted[result] = value
+    return result
+
+  def _op(self, fmt, *args, **kwargs):
+    """Value of the expression fmt % args: a constant if all of args are,
+    else a new local assigned the expression.
+    Expressions with side effects are passed pure=False, statements run only
+    for them statement=True.
+    """
+    statement = kwargs.get("statement", False)
+    pure = kwargs.get("pure", True) and not statement
+    expr = fmt % args
+    reads = set(a for a in args if isinstance(a, str))
+    if pure and not reads and not _RUNTIME_RE.search(fmt):
+      return eval(expr, {"PARITY": PARITY})
+    target = None
+    if not statement:
+      target = "v%d" % self.count
+      self.count += 1
+    self.block.code.append([target, expr, reads, pure, True])
+    return target
+
+  def _liveness(self, block, live_out):
+    """Mark the statements of the tree that are needed; return the registers
+    read before being written (the live-in set)."""
+    if block.exit:
+      live = self._exit_reads(block.exit, live_out)
+    else:
+      live = (self._liveness(block.taken, live_out) |
+              self._liveness(block.not_taken, live_out))
+      if isinstance(block.cond, str): live.add(block.cond)
+    for stmt in reversed(block.code):
+      (target, expr, reads, pure) = stmt[:4]
+      stmt[4] = not pure or target in live
+      if stmt[4]:
+        live.discard(target)
+        live |= reads
+    return live
+
+  def _exit_reads(self, ex, live_out):
+    values = [v for (r, v) in ex.stores(live_out)]
+    values += [ex.fetch, ex.next_op]
+    return set(v for v in values if isinstance(v, str))
+
+  def _function_body(self, root):
+    """Source lines of a function from its tree of blocks."""
+    live_out = self.live_out
+    live_in = self._liveness(root, live_out)
+    uses = {}
+    self._count_uses(root, live_out, uses)
+    inline = {}
+    lines = []
+    for r in _REGISTERS:
+      if r not in live_in: continue
+      if r.startswith("r"):
+        lines.append("    %s = rb[%s]" % (r, r[1:]))
+      else:
+        lines.append("    %s = st.%s" % (r, r))
+    self._block_lines(root, "    ", lines, uses, inline)
+    return lines
+
+  def _count_uses(self, block, live_out, uses):
+    reads = []
+    for stmt in block.code:
+      if stmt[4]: reads.extend(stmt[2])
+    if block.exit:
+      ex = block.exit
+      reads.extend(v for (r, v) in ex.stores(live_out))
+      reads += [ex.fetch, ex.next_op]
+    else:
+      reads.append(block.cond)
+      self._count_uses(block.taken, live_out, uses)
+      self._count_uses(block.not_taken, live_out, uses)
+    for r in reads:
+      if isinstance(r, str): uses[r] = uses.get(r, 0) + 1
+
+  def _block_lines(self, block, indent, lines, uses, inline):
+    def expand(value):
+      if not isinstance(value, str): return str(value)
+      return _LOCAL_RE.sub(lambda m: "(%s)" % inline[m.group(0)]
+                           if m.group(0) in inline else m.group(0), value)
+
+    for (target, expr, reads, pure, needed) in block.code:
+      if not needed: continue
+      expr = expand(expr)
+      # A value used once is computed where it is used, unless it is a
+      # memory read that must stay ahead of later writes.
+      if pure and uses.get(target) == 1 and "mem[" not in expr:
+        inline[target] = expr
+      elif target:
+        lines.append("%s%s = %s" % (indent, target, expr))
+      else:
+        lines.append(indent + expr)
+    if block.exit:
+      ex = block.exit
+      for (r, value) in ex.stores(self.live_out):
+        if r.startswith("r"):
+          lines.append("%srb[%s] = %s" % (indent, r[1:], expand(value)))
+        else:
+          lines.append("%sst.%s = %s" % (indent, r, expand(value)))
+      lines.append("%sst.fetch = %s" % (indent, expand(ex.fetch)
+                                        if ex.fetch is not None else "None"))
+      lines.append("%sst.cycles += %d" % (indent, ex.cycles))
+      if ex.halt:
+        lines.append("%sst.halted = True" % indent)
+        lines.append("%sreturn None" % indent)
+      else:
+        lines.append("%sreturn %s" % (indent, expand(ex.next_op)))
+    else:
+      lines.append("%sif %s:" % (indent, expand(block.cond)))
+      self._block_lines(block.taken, indent + "    ", lines, uses,
+                        dict(inline))
+      lines.append("%selse:" % indent)
+      self._block_lines(block.not_taken, indent + "    ", lines, uses,
+                        dict(inline))
+
+
+def microcode_digest(uinstructions):
+  """Digest of a uI table, recorded in the modules translated from it."""
+  return hashlib.sha1(",".join("%x" % uI for uI in uinstructions)).hexdigest()
+
+
+def translate(uinstructions, name="<microcode>"):
+  """Return the source of the module translated from a uI table."""
+  return Translator(uinstructions).translate(name)
+
+
+def load(uinstructions, name="<microcode>"):
+  """Translate a uI table and return it as a module object."""
+  source = translate(uinstructions, name)
+  module = imp.new_module("ucode_compiled")
+  exec compile(source, name, "exec") in module.__dict__
+  return module
+
+
+def load_module(filename, uinstructions=None):
+  """Import a module written by ucode_compile.py. If uinstructions is given,
+  check that the module was translated from them.
+  """
+  name = os.path.splitext(os.path.basename(filename))[0]
+  module = imp.load_source(name, filename)
+  if uinstructions is not None:
+    if getattr(module, "UCODE_DIGEST", None) != microcode_digest(uinstructions):
+      raise CompileError("%s was not translated from this microcode"
+                         % filename)
+  return module
+
+
+class _State(object):
+  """Registers passed between the functions of a translated module."""
+  __slots__ = SCALARS + ['cycles', 'fetch', 'halted']
+
+
+class CompiledSimulator(object):
+  """Runs a translated module with the interface of ucode_sim.Simulator.
+  The core state is only complete at instruction boundaries, so run()
+  checks max_cycles and stop() once per instruction, after the fetch of the
+  next opcode; that fetch is not counted nor traced when stop() was called.
+  """
+
+  def __init__(self, module, memory, io_read=None, io_write=None):
+    self.opcodes = module.OPCODES
+    self.memory = memory
+    self.mem_mask = len(memory) - 1
+    self.io_read = io_read or (lambda port: 0)
+    self.io_write = io_write or (lambda port, value: None)
+    self.reset()
+
+  def reset(self):
+    """Put the core in the state it is in when reset is released."""
+    st = _State()
+    for r in SCALARS: setattr(st, r, 0)
+    st.flags = FLAG_CONST
+    st.aux = 1
+    st.cycles = 0
+    st.fetch = None
+    st.halted = False
+    self.state = st
+    self.rbank = [0] * 16
+    self.next_op = RESET
+    self.instructions = 0
+    self.stopped = False
+
+  @property
+  def cycles(self):
+    return self.state.cycles
+
+  @property
+  def halted(self):
+    return self.state.halted
+
+  @property
+  def flags(self):
+    return self.state.flags
+
+  def register(self, name):
+    """Value of register bank register by name ('b'..'sl'), or 'pc'/'sp'."""
+    rb = self.rbank
+    if name == 'pc': return (rb[8] << 8) | rb[9]
+    if name == 'sp': return (rb[14] << 8) | rb[15]
+    return rb[RB_NAMES.index(name)]
+
+  def run(self, max_cycles=MAX_CYCLES, trace=None):
+    """Run until the CPU halts, stop() is called or max_cycles elapse.
+    Fetch addresses are passed to trace(address) if given.
+    Return the number of cycles run.
+    """
+    opcodes = self.opcodes
+    rb = self.rbank
+    mem = self.memory
+    mask = self.mem_mask
+    st = self.state
+    io_read = self.io_read
+    io_write = self.io_write
+    op = self.next_op
+    self.stopped = False
+    start = st.cycles
+    end = start + max_cycles
+    while st.cycles < end and not st.halted:
+      op = opcodes[op](rb, mem, mask, st, io_read, io_write)
+      if self.stopped:
+        break
+      if st.fetch is not None:
+        self.instructions += 1
+        if trace: trace(st.fetch)
+    self.next_op = op
+    return st.cycles - start
+
+  def stop(self):
+    """Stop run() at the end of the current instruction."""
+    self.stopped = True
+
+
+def _parse_command_line():
+  """Get cmd line params."""
+  default_src = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "src", "ucode", "light8080.m80")
+  parser = optparse.OptionParser(usage='%prog [options] <module file>')
+  parser.add_option("-m", dest="microcode", default=default_src,
+                  help="microcode source FILE.", metavar="FILE")
+  parser.add_option("-O", dest="optimize", action="store_true", default=False,
+                  help="optimize microcode before translating it.")
+
+  (options, args) = parser.parse_args()
+  if len(args) < 1:
+    print >> sys.stderr, "error: missing module file name"
+    parser.print_help()
+    sys.exit(1)
+  return (options, args)
+
+
+def _main():
+
+    (options, filenames) = _parse_command_line()
+
+    try:
+      rom = ucode_asm.uCodeROM(options.microcode, options.optimize)
+      source = translate(rom.uInstruction_list,
+                         os.path.basename(options.microcode))
+    except ucode_asm.SyntaxError as e:
+      print >> sys.stderr, "error: %s" % e
+      sys.exit(22)
+    except CompileError as e:
+      print >> sys.stderr, "error: %s" % e
+      sys.exit(1)
+    except EnvironmentError as e:
+      print >> sys.stderr, "error: %s" % e
+      sys.exit(1)
+
+    try:
+      with open(filenames[0], "w") as fo:
+        fo.write(source)
+    except IOError as e:
+      print >> sys.stderr, "error: %s" % e
+      sys.exit(e.errno)
+
+
+if __name__ == "__main__":
+    _main()
+    sys.exit(0)
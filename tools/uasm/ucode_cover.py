@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+################################################################################
+# ucode_cover.py : light8080 opcode and microcode coverage of SW runs
+################################################################################
+# Usage: ucode_cover.py [options] [<hex file> <trace file>]...
+#
+# Measures how much of the microcode a set of SW runs exercises. Each run is
+# given as the Intel HEX object code that was run and the fetch trace it made
+# (hw_sim_log.txt, emu8080.py or ucode_sim.py trace; text, gzipped or
+# trace_bin.py binary). The opcode at each fetched address is taken from the
+# object code and, for conditional instructions, the path (taken or not) from
+# the address of the next fetch. The opcode paths are mapped to the uIs they
+# run with the same walk of the decoding table and JSR/TJSR/#ret graph as the
+# ucode_asm.py timing table.
+#
+# The report has the opcode, opcode path and microword coverage of all the
+# runs together, the __asm entries, opcodes and uIs no run reached, and the
+# smallest set of runs found that reaches the same coverage as all of them.
+#
+# Options:
+#
+# -m FILE     : Microcode source file. Defaults to src/ucode/light8080.m80.
+# -O          : Optimize microcode as ucode_asm.py -O does.
+# -i FILE     : Read the coverage of more runs from FILE, as written by -j.
+#               Can be used more than once.
+# -j FILE     : Write the coverage of every run to FILE in JSON format.
+# -o FILE     : Write report to FILE instead of stdout.
+# --ram-size  : RAM size in bytes, a power of 2. Defaults to 64KB.
+# -h, --help  : Show help, quit.
+#
+################################################################################
+# Each trace is read once, fetch by fetch, in constant memory; all that is
+# kept of a run is the set of opcode paths it executed, so any number of runs
+# can be merged. The coverage files hold opcode paths, not uAs, and can be
+# merged with runs traced on other versions of the microcode.
+# The code bytes come from the object code: code written to RAM at run time
+# is decoded as whatever the HEX file has at its address.
+# The smallest set of runs is chosen greedily, by new opcode paths per
+# instruction run, then runs the others make redundant are dropped; it is
+# small but not guaranteed to be the smallest.
+################################################################################
+
+import sys
+import os
+import json
+import optparse
+
+import ucode_asm
+import ucode_sim
+from ucode_explore import opcode_mix, DEFAULT_MICROCODE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "trace"))
+import trace_bin
+from ucode_sim import build_rom
+
+
+# uIs every run goes through from reset to the first fetch.
+RESET_UAS = frozenset(range(1, ucode_asm.FETCH_UA))
+
+
+class CoverageError(Exception):
+  pass
+
+
+class Run(object):
+  """Opcode paths executed by a SW run."""
+
+  def __init__(self, name, instructions, paths):
+    self.name = name
+    self.instructions = instructions      # Number of fetches
+    self.paths = frozenset(paths)         # (opcode, variant) set
+
+  def to_dict(self):
+    return {
+      'name': self.name,
+      'instructions': self.instructions,
+      'paths': sorted("%02x%s" % p for p in self.paths)
+    }
+
+  @staticmethod
+  def from_dict(d):
+    try:
+      paths = [(int(p[:2], 16), str(p[2:])) for p in d['paths']]
+      return Run(d['name'], int(d['instructions']), paths)
+    except (KeyError, TypeError, ValueError) as e:
+      raise CoverageError("malformed run (%s)" % e)
+
+
+class Coverage(object):
+  """Opcode path and microword coverage of a set of runs on a uCodeROM."""
+
+  def __init__(self, rom):
+    self.rom = rom
+    # uAs run by each opcode path, variant as in instruction_timing.
+    self.path_uAs = {}
+    for row in rom.instruction_timing():
+      self.path_uAs[(row['opcode'], row['variant'])] = frozenset(row['path'])
+    self.reachable = RESET_UAS.union(*self.path_uAs.values())
+    self.runs = []
+
+  def add_trace(self, name, addresses, memory):
+    """Add the run that made the fetch addresses with the code in memory."""
+    mix = opcode_mix(addresses, memory)
+    run = Run(name, sum(mix.values()), mix.keys())
+    self.add_run(run)
+    return run
+
+  def add_run(self, run):
+    # A conditional path the microcode doesn't tell apart runs the opcode's
+    # only path.
+    run.paths = frozenset(p if p in self.path_uAs else (p[0], '')
+                          for p in run.paths)
+    self.runs.append(run)
+
+  def paths(self, runs=None):
+    """Opcode paths executed by any of the runs, all of them by default."""
+    if runs is None: runs = self.runs
+    return frozenset().union(*[r.paths for r in runs])
+
+  def uAs(self, paths):
+    """uAs run by the opcode paths."""
+    if not paths: return frozenset()
+    return RESET_UAS.union(*[self.path_uAs[p] for p in paths
+                             if p in self.path_uAs])
+
+  def minimal_runs(self):
+    """Small list of runs with the same coverage as all of them."""
+    target = self.paths()
+    covered = set()
+    chosen = []
+    candidates = list(self.runs)
+    while covered != target:
+      def gain(run):
+        new = len(run.paths - covered)
+        return (float(new) / max(run.instructions, 1), new)
+      best = max(candidates, key=gain)
+      candidates.remove(best)
+      chosen.append(best)
+      covered |= best.paths
+    # The greedy choice can leave runs others have made redundant.
+    for run in sorted(chosen, key=lambda r: -r.instructions):
+      rest = [r for r in chosen if r is not run]
+      if rest and self.paths(rest) == target:
+        chosen = rest
+    return chosen
+
+  def to_dict(self):
+    return {'source': self.rom.srcfile,
+            'runs': [r.to_dict() for r in self.runs]}
+
+  def write_report(self, fo):
+    rom = self.rom
+    paths = self.paths()
+    uAs = self.uAs(paths)
+    opcodes = set(op for (op, variant) in paths)
+    decoded = rom.opcode_address_dict
+    xref = rom.cross_reference()['uA']
+
+    def pct(n, total):
+      return "%d/%d (%.1f%%)" % (n, total, 100.0 * n / total if total else 0)
+
+    print >> fo, "Microcode: %s" % rom.srcfile
+    print >> fo, "Runs: %d, %d instructions" % (
+      len(self.runs), sum(r.instructions for r in self.runs))
+    print >> fo
+    print >> fo, "Opcodes:      %s" % pct(len(opcodes & set(decoded)),
+                                          len(decoded))
+    print >> fo, "Opcode paths: %s" % pct(len(paths & set(self.path_uAs)),
+                                          len(self.path_uAs))
+    print >> fo, "Microwords:   %s" % pct(len(uAs), len(self.reachable))
+    unreachable = [uA for uA in range(rom.code_size) if uA not in self.reachable]
+    if unreachable:
+      print >> fo, "              %d uIs of the code no opcode reaches" % (
+        len(unreachable))
+
+    print >> fo
+    print >> fo, "UNCOVERED __asm ENTRIES:"
+    entries = [(rom.instr_lineno_dict[instr], instr, uA)
+               for (instr, uA) in rom.instr_address_dict.items()
+               if uA not in uAs]
+    for (lineno, instr, uA) in sorted(entries):
+      print >> fo, "  %4d  uA %03x  %s" % (lineno, uA, instr)
+    if not entries: print >> fo, "  (none)"
+
+    print >> fo
+    print >> fo, "UNCOVERED OPCODE PATHS:"
+    missing = sorted(p for p in self.path_uAs if p not in paths and
+                     p[0] in decoded)
+    for (op, variant) in missing:
+      taken = {'T': " (taken)", 'N': " (not taken)"}.get(variant, variant)
+      print >> fo, "  %02x  %s%s" % (op, rom.opcode_mnemonic(op), taken)
+    if not missing: print >> fo, "  (none)"
+
+    print >> fo
+    print >> fo, "UNCOVERED MICROWORDS:"
+    ranges = []
+    for uA in sorted(self.reachable - uAs):
+      if ranges and ranges[-1][1] == uA - 1 and \
+         xref[uA]['routine'] == xref[ranges[-1][0]]['routine']:
+        ranges[-1][1] = uA
+      else:
+        ranges.append([uA, uA])
+    for (first, last) in ranges:
+      line = xref[first]['line']
+      print >> fo, "  %03x-%03x  %-24s  line %s" % (
+        first, last, xref[first]['routine'] or "", line if line else "-")
+    if not ranges: print >> fo, "  (none)"
+
+    print >> fo
+    chosen = self.minimal_runs()
+    print >> fo, "MINIMAL RUN SET: %d of %d runs, %d of %d instructions" % (
+      len(chosen), len(self.runs), sum(r.instructions for r in chosen),
+      sum(r.instructions for r in self.runs))
+    for run in chosen:
+      print >> fo, "  %-40s  %10d instructions" % (run.name, run.instructions)
+
+
+def load_coverage(filename):
+  """Read a coverage file written by -j; return the list of its runs."""
+  with open(filename) as f:
+    try:
+      data = json.load(f)
+    except ValueError as e:
+      raise CoverageError("%s: %s" % (filename, e))
+  try:
+    return [Run.from_dict(d) for d in data['runs']]
+  except (KeyError, TypeError) as e:
+    raise CoverageError("%s: malformed coverage file (%s)" % (filename, e))
+  except CoverageError as e:
+    raise CoverageError("%s: %s" % (filename, e))
+
+
+def _parse_command_line():
+  parser = optparse.OptionParser(
+    usage='%prog [options] [<hex file> <trace file>]...')
+  parser.add_option("-m", dest="microcode", default=DEFAULT_MICROCODE,
+                  help="microcode source FILE.", metavar="FILE")
+  parser.add_option("-O", dest="optimize", action="store_true", default=False,
+                  help="optimize microcode.")
+  parser.add_option("-i", dest="inputs", action="append", default=[],
+                  help="read coverage of more runs from FILE.", metavar="FILE")
+  parser.add_option("-j", dest="json", default=None,
+                  help="write coverage of every run to FILE.", metavar="FILE")
+  parser.add_option("-o", dest="output", default=None,
+                  help="write report to FILE.", metavar="FILE")
+  parser.add_option("--ram-size", dest="ram_size", type="int", default=0x10000,
+                  help="RAM size in bytes, a power of 2.", metavar="BYTES")
+
+  (options, args) = parser.parse_args()
+  if len(args) % 2:
+    print >> sys.stderr, "error: HEX and trace files must come in pairs"
+    parser.print_help()
+    sys.exit(1)
+  if not args and not options.inputs:
+    print >> sys.stderr, "error: missing HEX and trace file names"
+    parser.print_help()
+    sys.exit(1)
+  return (options, args)
+
+
+def _main():
+
+    (options, filenames) = _parse_command_line()
+
+    try:
+        rom = ucode_asm.uCodeROM(options.microcode, options.optimize,
+                                 verbose=False)
+        coverage = Coverage(rom)
+        for filename in options.inputs:
+            for run in load_coverage(filename):
+                coverage.add_run(run)
+        for i in range(0, len(filenames), 2):
+            (hex_file, trace_file) = filenames[i:i + 2]
+            memory = ucode_sim.load_memory(hex_file, options.ram_size)
+            coverage.add_trace(trace_file, trace_bin.read_trace(trace_file),
+                               memory)
+    except ucode_asm.SyntaxError as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(22)
+    except (CoverageError, trace_bin.TraceFormatError, build_rom.BuildRomError,
+            EnvironmentError) as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(1)
+
+    if options.output:
+        with open(options.output, "w") as fo:
+            coverage.write_report(fo)
+    else:
+        coverage.write_report(sys.stdout)
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(coverage.to_dict(), f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    _main()
+    sys.exit(0)
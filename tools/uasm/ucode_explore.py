@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+################################################################################
+# ucode_explore.py : light8080 microcode variant explorer
+################################################################################
+# Usage: ucode_explore.py [options] <spec file> <trace file>
+#
+# Builds variants of the microcode source by applying the patches of a JSON
+# spec file, assembles them in a process pool and ranks them by the size of
+# the microcode and by the cycles they'd take to run the opcode mix of a SW
+# fetch trace (hw_sim_log.txt, emu8080.py or ucode_sim.py trace; text, gzipped
+# or trace_bin.py binary). The unpatched source is always evaluated as the
+# baseline.
+#
+# Options:
+#
+# -m FILE     : Microcode source file. Defaults to src/ucode/light8080.m80.
+# -x FILE     : Intel HEX object code of the SW that made the trace. Required,
+#               supplies the opcode of each fetch.
+# -k COUNT    : Check each variant by running the SW on ucode_sim.py for COUNT
+#               instructions; variants whose fetches or console output differ
+#               from the baseline's are rejected. Default 0, no check.
+# -j JOBS     : Number of worker processes. Defaults to the number of CPUs.
+# -r KEY      : Rank by 'cycles' (default) or 'words'; ties go by the other.
+# -o FILE     : Write the results to FILE in JSON format too.
+# --ram-size  : RAM size in bytes, a power of 2. Defaults to 64KB.
+# -h, --help  : Show help, quit.
+#
+################################################################################
+# Spec file format:
+#
+# {
+#   "variants": [
+#     {
+#       "name": "mov_${n}",
+#       "optimize": false,
+#       "params": {"n": ["a", "b"]},
+#       "patches": [
+#         {"find": "<regex>", "replace": "<text>", "count": 1}
+#       ]
+#     }
+#   ]
+# }
+#
+# Each patch replaces matches of Python regex 'find' in the whole source
+# (multiline mode: ^ and $ match at line boundaries) with 'replace', which may
+# use backreferences. 'count' limits the number of replacements, 0 or missing
+# means all of them. A patch that matches nothing makes the variant fail, so
+# that specs don't go stale silently. 'optimize' assembles with -O if true or
+# 1, and with -O --fold-jsr if 2.
+#
+# 'params' maps parameter names to lists of values; the variant is expanded
+# once for each combination of values, with ${name} replaced by the value in
+# the name and the patches.
+#
+################################################################################
+# Scoring:
+#
+# Words are the uIs before padding; the variant fails if they don't fit below
+# the decoding table. Cycles are those of the per-opcode timing table of
+# ucode_asm.py weighted by the opcode mix of the trace. Conditional jumps,
+# calls and returns are weighted by path: taken when the next fetch isn't the
+# next instruction.
+################################################################################
+
+import sys
+import os
+import re
+import json
+import string
+import itertools
+import optparse
+import multiprocessing
+import StringIO
+
+import ucode_asm
+import ucode_sim
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "trace"))
+import trace_bin
+from ucode_sim import build_rom
+
+
+# Length of the conditional instructions, whose timing depends on the path.
+CONDITIONAL_LENGTH = {}
+for cc in range(8):
+  CONDITIONAL_LENGTH[0xc0 | (cc << 3)] = 1    # Rcc
+  CONDITIONAL_LENGTH[0xc2 | (cc << 3)] = 3    # Jcc
+  CONDITIONAL_LENGTH[0xc4 | (cc << 3)] = 3    # Ccc
+
+# Name of the unpatched variant.
+BASELINE_NAME = "[baseline]"
+
+# uA of the decoding table; the microcode must fit below it.
+DECODE_TABLE_UA = 0x100
+
+DEFAULT_MICROCODE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "..", "..", "src", "ucode", "light8080.m80")
+
+
+class SpecError(Exception):
+  pass
+
+
+class Variant(object):
+  """Microcode variant: a list of (regex, replacement, count) patches."""
+
+  def __init__(self, name, patches=(), optimize=False):
+    self.name = name
+    self.patches = list(patches)
+    self.optimize = optimize
+
+  def apply(self, source):
+    """Return source text patched. Raise SpecError if a patch doesn't match."""
+    for (n, (find, replace, count)) in enumerate(self.patches, 1):
+      try:
+        (source, matches) = re.subn(find, replace, source, count, re.MULTILINE)
+      except (re.error, IndexError) as e:
+        raise SpecError("patch %d: %s" % (n, e))
+      if matches == 0:
+        raise SpecError("patch %d: no match for '%s'" % (n, find))
+    return source
+
+
+def load_spec(filename):
+  """Read JSON spec file, return list of Variants with params expanded."""
+  try:
+    with open(filename) as f:
+      spec = json.load(f)
+  except ValueError as e:
+    raise SpecError("%s: %s" % (filename, e))
+  variants = []
+  try:
+    for entry in spec["variants"]:
+      params = entry.get("params", {})
+      names = sorted(params)
+      for values in itertools.product(*[params[p] for p in names]):
+        subst = dict(zip(names, [unicode(v) for v in values]))
+        expand = lambda s: string.Template(s).safe_substitute(subst)
+        patches = [(expand(p["find"]), expand(p["replace"]), p.get("count", 0))
+                   for p in entry["patches"]]
+        variants.append(Variant(expand(entry["name"]), patches,
+                                entry.get("optimize", False)))
+  except (KeyError, TypeError, AttributeError) as e:
+    raise SpecError("%s: malformed spec (%s)" % (filename, e))
+  names = [v.name for v in variants]
+  for name in names:
+    if names.count(name) > 1:
+      raise SpecError("%s: variant name '%s' is not unique" % (filename, name))
+  return variants
+
+
+def opcode_mix(addresses, memory):
+  """Count the instructions in an iterable of fetch addresses by opcode and
+  path. Return dict (opcode, path) -> count, where path is '' but for the
+  conditional instructions: 'T' if taken, 'N' if not.
+  """
+  mask = len(memory) - 1
+  counts = [0] * 256
+  taken = [0] * 256
+  prev = None
+  for a in addresses:
+    if prev is not None:
+      op = memory[prev & mask]
+      counts[op] += 1
+      if op in CONDITIONAL_LENGTH and a != (prev + CONDITIONAL_LENGTH[op]) & 0xffff:
+        taken[op] += 1
+    prev = a
+  # The last fetch has no successor; count it as not taken.
+  if prev is not None: counts[memory[prev & mask]] += 1
+  mix = {}
+  for op in range(256):
+    if not counts[op]: continue
+    if op in CONDITIONAL_LENGTH:
+      if taken[op]: mix[(op, 'T')] = taken[op]
+      if counts[op] > taken[op]: mix[(op, 'N')] = counts[op] - taken[op]
+    else:
+      mix[(op, '')] = counts[op]
+  return mix
+
+
+def weighted_cycles(timing, mix):
+  """Total cycles of the opcode mix given the timing table of a uCodeROM.
+  An opcode path missing from the table (e.g. a conditional made
+  unconditional by a variant) is charged the slowest path of the opcode.
+  """
+  cycles = {}
+  slowest = {}
+  for row in timing:
+    cycles[(row['opcode'], row['variant'])] = row['cycles']
+    slowest[row['opcode']] = max(slowest.get(row['opcode'], 0), row['cycles'])
+  total = 0
+  for ((op, path), count) in mix.iteritems():
+    total += count * cycles.get((op, path), slowest[op])
+  return total
+
+
+def run_check(words, memory, count):
+  """Run the SW on the microcode for count instructions.
+  Return (list of fetch addresses, console output).
+  """
+  log = StringIO.StringIO()
+  console = ucode_sim.Console(echo=False, log=log)
+  sim = ucode_sim.Simulator(words, list(memory), console.io_read, console.io_write)
+  console.target = sim
+  fetches = []
+  def trace(address):
+    fetches.append(address)
+    if len(fetches) >= count: sim.stop()
+  # Every instruction takes less than 64 cycles; a variant that runs longer
+  # than that per instruction is broken anyway.
+  sim.run(count * 64, trace)
+  console.flush()
+  return (fetches, log.getvalue())
+
+
+def evaluate(job):
+  """Assemble and score one variant. job is a tuple (variant, source, mix,
+  check) where check is None or (memory, instructions, expected result).
+  Return dict of results, see _main.
+  """
+  (variant, source, mix, check) = job
+  result = {'name': variant.name, 'ok': False, 'words': None, 'cycles': None,
+            'errors': []}
+  try:
+    source = variant.apply(source)
+  except SpecError as e:
+    result['errors'] = [str(e)]
+    return result
+  asm = ucode_asm.assemble(source, variant.optimize, filename=variant.name)
+  result['errors'] = [str(d) for d in asm.errors]
+  if not asm.ok: return result
+  result['words'] = asm.code_size
+  if asm.code_size > DECODE_TABLE_UA:
+    result['errors'] = ["%d uIs don't fit below the decoding table" % asm.code_size]
+    return result
+  try:
+    result['cycles'] = weighted_cycles(asm.rom.instruction_timing(), mix)
+  except ucode_asm.SyntaxError as e:
+    result['errors'] = [str(e)]
+    return result
+  if check:
+    (memory, count, expected) = check
+    (fetches, console) = run_check(asm.words, memory, count)
+    if fetches != expected[0]:
+      diverge = [i for (i, (a, b)) in enumerate(zip(fetches, expected[0])) if a != b]
+      index = diverge[0] if diverge else min(len(fetches), len(expected[0]))
+      result['errors'] = ["fetches diverge from baseline at instruction #%d" % (index + 1)]
+      return result
+    if console != expected[1]:
+      result['errors'] = ["console output differs from baseline"]
+      return result
+  result['ok'] = True
+  return result
+
+
+def explore(variants, source, mix, check=None, jobs=None):
+  """Evaluate the baseline and all the variants, the latter in a pool of
+  worker processes. Return (baseline result, list of variant results).
+  check is None or (memory, instructions to check).
+  """
+  baseline = Variant(BASELINE_NAME)
+  if check:
+    asm = ucode_asm.assemble(source)
+    if not asm.ok:
+      raise SpecError("baseline microcode has errors")
+    (memory, count) = check
+    check = (memory, count, run_check(asm.words, memory, count))
+  jobs_list = [(v, source, mix, check) for v in [baseline] + variants]
+  if jobs == 1 or len(variants) < 2:
+    results = map(evaluate, jobs_list)
+  else:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      results = pool.map(evaluate, jobs_list, chunksize=1)
+    finally:
+      pool.terminate()
+  return (results[0], results[1:])
+
+
+def rank(results, key='cycles'):
+  """Sort results best first: passing variants by key then the other score,
+  then the failed ones by name."""
+  other = 'words' if key == 'cycles' else 'cycles'
+  return sorted(results, key=lambda r: (not r['ok'], r[key], r[other], r['name']))
+
+
+def _write_report(fo, baseline, results, instructions):
+  def delta(r, key):
+    if not baseline['ok'] or r[key] is None: return ""
+    d = r[key] - baseline[key]
+    return "%+d (%+.1f%%)" % (d, 100.0 * d / baseline[key]) if baseline[key] else ""
+
+  print >> fo, "%d instructions in the trace." % instructions
+  print >> fo
+  fmt = "%4s  %-24s %6s %-14s %9s %-14s %6s"
+  print >> fo, fmt % ("rank", "variant", "words", "", "cycles", "", "CPI")
+  for (n, r) in enumerate([baseline] + results):
+    if not r['ok']: continue
+    cpi = "%.3f" % (float(r['cycles']) / instructions) if instructions else "-"
+    print >> fo, fmt % ("-" if n == 0 else n, r['name'], r['words'],
+                        delta(r, 'words'), r['cycles'], delta(r, 'cycles'), cpi)
+  failed = [r for r in [baseline] + results if not r['ok']]
+  if failed:
+    print >> fo
+    print >> fo, "FAILED VARIANTS:"
+    for r in failed:
+      print >> fo, "%s:" % r['name']
+      for e in r['errors']:
+        print >> fo, "  %s" % e
+
+
+def _parse_command_line():
+  parser = optparse.OptionParser(usage='%prog [options] <spec file> <trace file>')
+  parser.add_option("-m", dest="microcode", default=DEFAULT_MICROCODE,
+                  help="microcode source FILE.", metavar="FILE")
+  parser.add_option("-x", dest="hex", default=None,
+                  help="Intel HEX FILE of the traced SW.", metavar="FILE")
+  parser.add_option("-k", dest="check", type="int", default=0,
+                  help="check variants against baseline for COUNT instructions.",
+                  metavar="COUNT")
+  parser.add_option("-j", dest="jobs", type="int", default=None,
+                  help="number of worker processes.", metavar="JOBS")
+  parser.add_option("-r", dest="rank", default="cycles",
+                  choices=["cycles", "words"],
+                  help="rank by 'cycles' or 'words'.", metavar="KEY")
+  parser.add_option("-o", dest="output", default=None,
+                  help="write results to FILE in JSON format.", metavar="FILE")
+  parser.add_option("--ram-size", dest="ram_size", type="int", default=0x10000,
+                  help="RAM size in bytes, a power of 2.", metavar="BYTES")
+
+  (options, args) = parser.parse_args()
+  if len(args) < 2 or not options.hex:
+    print >> sys.stderr, "error: missing spec, trace or HEX file name"
+    parser.print_help()
+    sys.exit(1)
+  if options.jobs is not None and options.jobs < 1:
+    print >> sys.stderr, "error: number of jobs must be 1 or more"
+    sys.exit(1)
+  return (options, args)
+
+
+def _main():
+
+    (options, filenames) = _parse_command_line()
+
+    try:
+        variants = load_spec(filenames[0])
+        with open(options.microcode) as f:
+            source = f.read()
+        memory = ucode_sim.load_memory(options.hex, options.ram_size)
+        mix = opcode_mix(trace_bin.read_trace(filenames[1]), memory)
+        check = (memory, options.check) if options.check > 0 else None
+        (baseline, results) = explore(variants, source, mix, check, options.jobs)
+    except (SpecError, trace_bin.TraceFormatError, build_rom.BuildRomError,
+            EnvironmentError) as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(1)
+
+    results = rank(results, options.rank)
+    _write_report(sys.stdout, baseline, results, sum(mix.values()))
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({'baseline': baseline, 'variants': results,
+                       'instructions': sum(mix.values()), 'rank': options.rank},
+                      f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    _main()
+    sys.exit(0)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+################################################################################
+# ucode_sim.py : light8080 microcode-level simulator
+################################################################################
+# Usage: ucode_sim.py [options] <hex file>
+#
+# Runs an Intel HEX object code file on a model of the light8080 core that
+# executes the microcode assembled by ucode_asm.py cycle by cycle, within a
+# model of the mcu80 SoC: RAM mirrored over the address map and a UART that is
+# always ready to transmit.
+#
+# Options:
+#
+# -m FILE     : Microcode source file. Defaults to src/ucode/light8080.m80.
+# -O          : Optimize microcode as ucode_asm.py -O does before running it.
+# -x          : Translate the microcode to Python with ucode_compile.py and run
+#               that instead of simulating uI by uI. Much faster; -n and EOT
+#               are only checked at the end of each instruction.
+# -t FILE     : Write fetch trace to FILE in the same format as the trace
+#               written by the mcu80 TB (hw_sim_log.txt).
+# -c FILE     : Write UART console output to FILE (as hw_sim_con.txt) besides
+#               echoing it to stdout.
+# -n CYCLES   : Stop after CYCLES clock cycles. Defaults to the length of the
+#               mcu80 TB simulation (70000 cycles).
+# --ram-size  : RAM size in bytes, a power of 2. Defaults to 64KB.
+# -q          : Don't echo console output to stdout or print the summary.
+# -h, --help  : Show help, quit.
+#
+# Simulation ends when the SW writes EOT (04h) to the UART, or when the CPU
+# halts, or after the maximum number of cycles.
+#
+################################################################################
+# The model follows the RTL in light8080.vhdl signal by signal, so that the
+# trace matches the TB trace fetch by fetch. Each call to Simulator.step is one
+# rising clock edge: all the registers are updated from the values they had
+# before the edge.
+# Interrupts are not modelled; intr is never asserted and inte is ignored.
+################################################################################
+
+import sys
+import os
+import optparse
+
+import ucode_asm
+from ucode_asm import _get_field, UF_FLAGS1, UF_FLAGS2, UF_LD_AL, UF_LD_ADDR
+from ucode_asm import UF_LD_T1, UF_LD_T2, UF_MUX_IN, UF_RB_ADDR_SEL, UF_RB_ADDR
+from ucode_asm import FLAGS1_DECODE, FLAGS1_IO, FLAGS1_AUXCY, FLAGS1_HALT
+from ucode_asm import FLAGS2_END, FLAGS2_JSR, FLAGS2_RET, FLAGS2_TJSR
+from ucode_asm import FLAGS2_RD, FLAGS2_WR, FLAGS2_SETACY, FETCH_UA
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "build_rom", "src"))
+import build_rom
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "emu8080"))
+from mcu80_soc import Console, load_memory
+
+FLAGS1_DI = ucode_asm.FLAGS["#di"][1]
+FLAGS1_EI = ucode_asm.FLAGS["#ei"][1]
+FLAGS1_CLRT1 = ucode_asm.FLAGS["#clrt1"][1]
+
+# uA of the halt uI, the target of #end when #halt is set.
+HALT_UA = 7
+
+# Register bank index of the F register; writing it loads the flags (POP PSW).
+RB_F = 6
+
+# Names of the register bank registers by index.
+RB_NAMES = ['b', 'c', 'd', 'e', 'h', 'l', 'f', 'a',
+            'ph', 'pl', 'x', 'y', 'z', 'w', 'sh', 'sl']
+
+# Pipelined uI field 2 (ucode_field2 in the RTL), bit positions.
+F2_DO_CY_OP =     24
+F2_DO_CPC =       23
+F2_CLR_T2 =       22
+F2_CLR_T1 =       21
+F2_SET_AUX =      20
+F2_USE_AUX =      19
+F2_RB_ADDR =      15              # 4 bits, RB address read in cycle 1
+F2_CLR_ACY =      14
+F2_LOAD_DO =       7
+F2_WE_RB =         6
+
+# F register bits.
+FLAG_S =  0x80
+FLAG_Z =  0x40
+FLAG_AC = 0x10
+FLAG_P =  0x04
+FLAG_C =  0x01
+# Bits 5 and 3 of the F register always read as 0 and bit 1 as 1.
+FLAG_CONST = 0x02
+
+# Parity flag of every byte value.
+PARITY = [FLAG_P if bin(v).count("1") % 2 == 0 else 0 for v in range(256)]
+
+# Default simulation length; same as the mcu80 TB MAX_SIM_LENGTH.
+MAX_CYCLES = 70000
+
+
+class Simulator(object):
+  """Cycle-level model of the light8080 core running a microcode ROM.
+  The memory is a bytearray; IO accesses are passed to optional callbacks:
+    io_read(port) -> byte
+    io_write(port, byte)
+  An IO read with no callback returns 00h, an IO write is ignored.
+  """
+
+  def __init__(self, uinstructions, memory, io_read=None, io_write=None):
+    self.rom = list(uinstructions)    # uI table indexed by 9-bit uA
+    self.memory = memory              # RAM, mirrored over the address map
+    self.mem_mask = len(memory) - 1
+    self.io_read = io_read
+    self.io_write = io_write
+    self.reset()
+
+  def reset(self):
+    """Put the core in the state it is in when reset is released.
+    Execution starts at the reset uIs, uA 1.
+    """
+    self.uc_addr = 1                  # uA of current uI, 8 bits as in RTL
+    self.uc_rom_addr = 1              # ROM index of current uI, 9 bits
+    self.ucode = self.rom[1]          # Current uI
+    self.uc_ret_addr = 0
+    self.field2 = 0                   # Pipelined field 2 of previous uI
+    self.rbank = [0] * 16
+    self.t1 = 0
+    self.t2 = 0
+    self.do = 0
+    self.di = 0                       # data_in as seen in current cycle
+    self.ir = 0
+    self.addr_low = 0
+    self.flags = FLAG_CONST           # F register
+    self.reg_aux_cy = 1
+    self.condition_reg = 0
+    self.daa_res9 = 0
+    self.halted = False
+    self.cycles = 0
+    self.instructions = 0             # Number of opcode fetches
+
+  def register(self, name):
+    """Value of register bank register by name ('b'..'sl'), or 'pc'/'sp'."""
+    rb = self.rbank
+    if name == 'pc': return (rb[8] << 8) | rb[9]
+    if name == 'sp': return (rb[14] << 8) | rb[15]
+    return rb[RB_NAMES.index(name)]
+
+  def step(self):
+    """Simulate one clock cycle.
+    Return the address of the opcode fetched in this cycle, or None.
+    """
+    uI = self.ucode
+    f2 = self.field2
+    rb = self.rbank
+    t1 = self.t1
+    t2 = self.t2
+    di = self.di
+    ir = self.ir
+    flags = self.flags
+    cy = flags & FLAG_C
+
+    # Microcode sequencer ------------------------------------------------------
+    flags1 = _get_field(uI, UF_FLAGS1)
+    flags2 = _get_field(uI, UF_FLAGS2)
+    uc_tjsr = flags2 == FLAGS2_TJSR
+    uc_do_ret = flags2 == FLAGS2_RET
+    uc_do_jmp = flags2 == FLAGS2_JSR or (uc_tjsr and self.condition_reg)
+    uc_decode = flags1 == FLAGS1_DECODE
+    uc_end = flags2 == FLAGS2_END or (uc_tjsr and not self.condition_reg)
+    uc_halt = flags1 == FLAGS1_HALT
+
+    # Same priority as the RTL select: exactly one of the 4 flags or none.
+    sel = (uc_do_ret, bool(uc_do_jmp), uc_decode, uc_end)
+    if sel == (True, False, False, False):
+      next_uc_addr = self.uc_ret_addr
+    elif sel == (False, True, False, False):
+      next_uc_addr = ucode_asm._get_jump_target(uI)
+    elif sel == (False, False, False, False):
+      next_uc_addr = (self.uc_addr + 1) & 0xff
+    elif sel == (False, False, False, True):
+      next_uc_addr = HALT_UA if uc_halt else FETCH_UA
+    else:
+      next_uc_addr = 0x100 | di
+
+    # Operation 1: register bank read, T1/T2 loads -----------------------------
+    rb_addr_sel = _get_field(uI, UF_RB_ADDR_SEL)
+    ra_field = _get_field(uI, UF_RB_ADDR)
+    if rb_addr_sel == 0:
+      rbank_rd_addr = ra_field
+    elif rb_addr_sel == 1:
+      rbank_rd_addr = ir & 7
+    elif rb_addr_sel == 2:
+      rbank_rd_addr = (ir >> 3) & 7
+    else:
+      p_field = (ir >> 4) & 3
+      rbank_rd_addr = (8 if p_field == 3 else 0) | (p_field << 1) | (ra_field & 1)
+    rbank_data = rb[rbank_rd_addr]
+    addr_out = (rbank_data << 8) | self.addr_low
+    alu_input = rbank_data if _get_field(uI, UF_MUX_IN) else di
+
+    # Operation 2 of previous uI: ALU ------------------------------------------
+    alu_fn = f2 & 3
+    use_logic = f2 & 4
+    mux_fn = (f2 >> 3) & 3
+    alu_op6 = f2 & 0x3f
+    do_daa = (f2 >> 2) & 0xf == 0b1010
+    use_psw = (f2 >> 4) & 3 == 3
+    clr_acy = (f2 >> F2_CLR_ACY) & 1
+
+    aux_cy_in = 1 if (f2 >> F2_SET_AUX) & 1 else self.reg_aux_cy
+    cy_in = aux_cy_in if (f2 >> F2_USE_AUX) & 1 else cy
+    cy_in_gated = cy_in & alu_fn
+    if alu_fn & 2:
+      op2_sgn = 0x100 | (~t1 & 0xff)
+      cy_in_sgn = cy_in_gated ^ 1
+    else:
+      op2_sgn = t1
+      cy_in_sgn = cy_in_gated
+    arith_res = (t2 + op2_sgn + cy_in_sgn) & 0x1ff
+    cy_adder = arith_res >> 8
+
+    # DAA adjustment is computed every cycle and registered.
+    low_gt9 = (t1 & 0x0f) > 9
+    high = t1 >> 4
+    daa_adjust = 0
+    if low_gt9 or flags & FLAG_AC:
+      daa_adjust |= 0x06
+    if high > 9 or cy or (high == 9 and (cy or low_gt9)):
+      daa_adjust |= 0x60
+    if do_daa:
+      arith_daa_res = self.daa_res9 & 0xff
+      cy_arith = 1 if (cy or low_gt9) else 0
+    else:
+      arith_daa_res = arith_res & 0xff
+      cy_arith = cy_adder
+
+    if alu_fn == 0:
+      logic_res = t1 & t2
+    elif alu_fn == 1:
+      logic_res = t1 ^ t2
+    elif alu_fn == 2:
+      logic_res = t1 | t2
+    else:
+      logic_res = ~t1 & 0xff
+
+    if alu_fn & 1:
+      shift_res = t1 >> 1
+      bit7 = (t1 & 1) if alu_fn == 1 else cy_in
+      shift_res |= bit7 << 7
+      cy_shifter = t1 & 1
+    else:
+      shift_res = (t1 << 1) & 0xfe
+      shift_res |= (t1 >> 7) if alu_fn == 0 else cy_in
+      cy_shifter = t1 >> 7
+
+    alu_mux1 = logic_res if use_logic else shift_res
+    if mux_fn == 0:
+      alu_output = alu_mux1
+    elif mux_fn == 1:
+      alu_output = arith_daa_res
+    elif mux_fn == 2:
+      alu_output = ~alu_mux1 & 0xff
+    else:
+      alu_output = ir & 0x38
+
+    # Flags.
+    set_ac = clr_acy and alu_op6 == 0b000100
+    clear_ac = clr_acy and not set_ac
+    if set_ac and not do_daa:
+      flag_ac = ((t1 | t2) & 0x08) << 1
+    elif clear_ac:
+      flag_ac = 0
+    elif do_daa:
+      flag_ac = FLAG_AC if low_gt9 else 0
+    else:
+      flag_ac = (t2 ^ op2_sgn ^ alu_output) & FLAG_AC
+    if (f2 >> F2_DO_CY_OP) & 1:
+      flag_cy = 1 if (f2 >> F2_DO_CPC) & 1 else cy ^ 1
+    elif clr_acy:
+      flag_cy = 0
+    elif use_logic:
+      flag_cy = cy_arith
+    else:
+      flag_cy = cy_shifter
+
+    we_rb = (f2 >> F2_WE_RB) & 1
+    rbank_wr_addr = (f2 >> F2_RB_ADDR) & 0xf
+    load_psw = we_rb and rbank_wr_addr == RB_F
+    flag_pattern = (f2 >> 8) & 3
+    if flag_pattern & 2:
+      if load_psw:
+        new_flags = alu_output & (FLAG_S | FLAG_Z | FLAG_AC | FLAG_P)
+      else:
+        new_flags = (alu_output & FLAG_S) | (FLAG_Z if alu_output == 0 else 0)
+        new_flags |= flag_ac | PARITY[alu_output]
+      flags = (flags & FLAG_C) | new_flags | FLAG_CONST
+    if flag_pattern & 1:
+      new_c = alu_output & 1 if load_psw else flag_cy
+      flags = (flags & ~FLAG_C) | new_c
+
+    # Condition selected by IR ddd field; registered.
+    cond_sel = (ir >> 3) & 7
+    cond_flag = [FLAG_Z, FLAG_C, FLAG_P, FLAG_S][cond_sel >> 1]
+    condition = 1 if self.flags & cond_flag else 0
+    if not cond_sel & 1: condition ^= 1
+
+    # Bus cycle ----------------------------------------------------------------
+    vma = _get_field(uI, UF_LD_ADDR)
+    io = flags1 == FLAGS1_IO
+    rd = flags2 == FLAGS2_RD
+    wr = flags2 == FLAGS2_WR
+    fetch = None
+    if vma and self.uc_addr < 16:
+      fetch = addr_out
+      self.instructions += 1
+    ram_addr = addr_out & self.mem_mask
+    # The BRAM reads every cycle; the read is done before the write.
+    next_di = self.memory[ram_addr]
+    if io and rd:
+      next_di = self.io_read(addr_out & 0xff) if self.io_read else 0
+    if wr:
+      if io:
+        if self.io_write: self.io_write(addr_out & 0xff, self.do)
+      else:
+        self.memory[ram_addr] = self.do
+
+    # Clock edge: update all registers ---------------------------------------
+    if we_rb:
+      rb[rbank_wr_addr] = alu_output
+    if (f2 >> F2_LOAD_DO) & 1:
+      self.do = flags if use_psw else alu_output
+    if uc_decode or (f2 >> F2_CLR_T1) & 1:
+      self.t1 = 0
+    elif _get_field(uI, UF_LD_T1):
+      self.t1 = alu_input
+    if uc_decode or (f2 >> F2_CLR_T2) & 1:
+      self.t2 = 0
+    elif _get_field(uI, UF_LD_T2):
+      self.t2 = alu_input
+    if uc_decode:
+      self.ir = di
+      self.reg_aux_cy = 1
+    else:
+      self.reg_aux_cy = cy_adder
+    if _get_field(uI, UF_LD_AL):
+      self.addr_low = rbank_data
+    if uc_do_jmp:
+      self.uc_ret_addr = (self.uc_addr + 1) & 0xff
+    if uc_halt:
+      self.halted = True
+    self.flags = flags
+    self.condition_reg = condition
+    self.daa_res9 = (t1 + daa_adjust) & 0x1ff
+    self.di = next_di
+    self.field2 = (
+      ((uI >> 2) & 0xf == 0b1011) << F2_DO_CY_OP |
+      (uI & 1) << F2_DO_CPC |
+      (flags2 == FLAGS2_END) << F2_CLR_T2 |
+      (flags1 == FLAGS1_CLRT1) << F2_CLR_T1 |
+      (flags2 == FLAGS2_SETACY) << F2_SET_AUX |
+      (flags1 == FLAGS1_AUXCY) << F2_USE_AUX |
+      rbank_rd_addr << F2_RB_ADDR |
+      (uI & 0x7fff))
+    self.ucode = self.rom[next_uc_addr]
+    self.uc_rom_addr = next_uc_addr
+    self.uc_addr = next_uc_addr & 0xff
+    self.cycles += 1
+
+    return fetch
+
+  def run(self, max_cycles=MAX_CYCLES, trace=None):
+    """Run until the CPU halts, stop() is called or max_cycles elapse.
+    Fetch addresses are passed to trace(address) if given.
+    Return the number of cycles run.
+    """
+    self.stopped = False
+    start = self.cycles
+    while self.cycles - start < max_cycles:
+      address = self.step()
+      if address is not None and trace:
+        trace(address)
+      if self.halted or self.stopped:
+        break
+    return self.cycles - start
+
+  def stop(self):
+    """Stop run() at the end of the current cycle. Meant for IO callbacks."""
+    self.stopped = True
+
+
+def _parse_command_line():
+  """Get cmd line params."""
+  default_src = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "src", "ucode", "light8080.m80")
+  parser = optparse.OptionParser(usage='%prog [options] <hex file>')
+  parser.add_option("-m", dest="microcode", default=default_src,
+                  help="microcode source FILE.", metavar="FILE")
+  parser.add_option("-O", dest="optimize", action="store_true", default=False,
+                  help="optimize microcode before running it.")
+  parser.add_option("-x", dest="compiled", action="store_true",
+                  default=False,
+                  help="run the microcode translated to Python.")
+  parser.add_option("-t", dest="trace", default=None,
+                  help="write fetch trace to FILE.", metavar="FILE")
+  parser.add_option("-c", dest="console", default=None,
+                  help="write console output to FILE.", metavar="FILE")
+  parser.add_option("-n", dest="max_cycles", type="int", default=MAX_CYCLES,
+                  help="stop after CYCLES clock cycles.", metavar="CYCLES")
+  parser.add_option("--ram-size", dest="ram_size", type="int", default=0x10000,
+                  help="RAM size in bytes, a power of 2.", metavar="BYTES")
+  parser.add_option("-q", dest="quiet", action="store_true", default=False,
+                  help="don't echo console output or print summary.")
+
+  (options, args) = parser.parse_args()
+  if len(args) < 1:
+    print >> sys.stderr, "error: missing object code file name"
+    parser.print_help()
+    sys.exit(1)
+  size = options.ram_size
+  if size <= 0 or size > 0x10000 or size & (size - 1):
+    print >> sys.stderr, "error: RAM size must be a power of 2 up to 64KB"
+    sys.exit(1)
+  return (options, args)
+
+
+def _main():
+
+    (options, filenames) = _parse_command_line()
+
+    try:
+      rom = ucode_asm.uCodeROM(options.microcode, options.optimize)
+    except ucode_asm.SyntaxError as e:
+      print >> sys.stderr, "error: %s" % e
+      sys.exit(22)
+    except EnvironmentError as e:
+      print >> sys.stderr, "error: %s" % e
+      sys.exit(1)
+    try:
+      memory = load_memory(filenames[0], options.ram_size)
+    except (build_rom.BuildRomError, EnvironmentError) as e:
+      print >> sys.stderr, "error: %s" % e
+      sys.exit(1)
+
+    trace_file = open(options.trace, "w") if options.trace else None
+    con_file = open(options.console, "w") if options.console else None
+    console = Console(echo=not options.quiet, log=con_file)
+    if options.compiled:
+      import ucode_compile
+      try:
+        module = ucode_compile.load(rom.uInstruction_list,
+                                    os.path.basename(options.microcode))
+      except ucode_compile.CompileError as e:
+        print >> sys.stderr, "error: %s" % e
+        sys.exit(1)
+      sim = ucode_compile.CompiledSimulator(module, memory,
+                                            console.io_read, console.io_write)
+    else:
+      sim = Simulator(rom.uInstruction_list, memory,
+                      console.io_read, console.io_write)
+    console.target = sim
+
+    trace = None
+    if trace_file:
+      trace = lambda address: trace_file.write("%04X: \n" % address)
+    sim.run(options.max_cycles, trace)
+    console.flush()
+
+    if trace_file: trace_file.close()
+    if con_file: con_file.close()
+
+    if not options.quiet:
+      if console.eot:
+        end = "Execution terminated by SW -- EOT written to UART_DATA."
+      elif sim.halted:
+        end = "CPU halted at PC=%04Xh." % sim.register('pc')
+      else:
+        end = "Simulation timed out."
+      print end
+      print "%d cycles, %d instructions." % (sim.cycles, sim.instructions)
+
+
+if __name__ == "__main__":
+    _main()
+    sys.exit(0)